@@ -0,0 +1,168 @@
+"""
+Comando: bench_assistant
+Benchmark de carga y latencia de extremo a extremo del asistente.
+
+Lanza peticiones a chat_api y/o chat_stream_api dentro del mismo proceso
+(con el Client de Django, sin servidor HTTP delante) con la concurrencia
+indicada, y muestra p50/p95/p99 del tiempo hasta el primer token, de la
+latencia total y el throughput.
+
+Con --fake-ollama arranca un fake_ollama en un hilo, así el LLM tiene un
+coste fijo y conocido y cualquier regresión en retrieval, construcción del
+prompt o persistencia se ve aislada:
+
+    python manage.py bench_assistant --fake-ollama --requests 200 --concurrency 16
+"""
+import json
+import math
+import statistics
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from django.test import Client
+
+from assistant_chat.services import llm_ollama
+from assistant_chat.services.history_writer import flush as flush_history
+from .fake_ollama import make_server
+
+ENDPOINTS = {
+    "chat": "/assistant/api/chat/",
+    "stream": "/assistant/api/stream/",
+}
+
+
+def percentile(values: list, percent: float) -> float:
+    """Percentil por el método del rango más cercano (valores en segundos)."""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, math.ceil(percent / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+
+class Command(BaseCommand):
+    help = "Mesura la latència i el throughput de l'assistent (chat_api i chat_stream_api)"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--requests", type=int, default=100, help="Peticions per endpoint")
+        parser.add_argument("--concurrency", type=int, default=8, help="Peticions simultànies")
+        parser.add_argument(
+            "--endpoint",
+            choices=["chat", "stream", "both"],
+            default="both",
+            help="Endpoint a mesurar"
+        )
+        parser.add_argument(
+            "--message",
+            default="Vull un concert de jazz aquest cap de setmana",
+            help="Missatge base de les peticions"
+        )
+        parser.add_argument(
+            "--identical",
+            action="store_true",
+            help="Envia sempre el mateix missatge (per mesurar la coalescència de peticions)"
+        )
+        parser.add_argument(
+            "--user",
+            help="Username amb qui fer les peticions (per mesurar també la persistència de l'historial)"
+        )
+        parser.add_argument("--ollama-url", help="URL de /api/generate a utilitzar")
+        parser.add_argument(
+            "--fake-ollama",
+            action="store_true",
+            help="Arrenca un fake_ollama en un fil i l'utilitza"
+        )
+        parser.add_argument("--tokens-per-second", type=float, default=30.0, help="Velocitat del fake_ollama")
+        parser.add_argument("--first-token-delay", type=float, default=0.4, help="Retard del primer token del fake_ollama")
+
+    def handle(self, *args, **options):
+        user = None
+        if options["user"]:
+            try:
+                user = get_user_model().objects.get(username=options["user"])
+            except get_user_model().DoesNotExist:
+                raise CommandError(f"No existeix l'usuari '{options['user']}'")
+
+        server = None
+        if options["fake_ollama"]:
+            server = make_server("127.0.0.1", 0, options["tokens_per_second"], options["first_token_delay"])
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+            host, port = server.server_address[:2]
+            llm_ollama.OLLAMA_URL = f"http://{host}:{port}/api/generate"
+        elif options["ollama_url"]:
+            llm_ollama.OLLAMA_URL = options["ollama_url"]
+
+        self.stdout.write(f"🎯 Ollama: {llm_ollama.OLLAMA_URL}")
+
+        endpoints = ["chat", "stream"] if options["endpoint"] == "both" else [options["endpoint"]]
+
+        try:
+            for endpoint in endpoints:
+                self._run(endpoint, options, user)
+        finally:
+            if server is not None:
+                server.shutdown()
+                server.server_close()
+
+    def _run(self, endpoint: str, options: dict, user) -> None:
+        """Lanza todas las peticiones de un endpoint y muestra el informe."""
+        total_requests = options["requests"]
+        concurrency = options["concurrency"]
+
+        def one_request(index: int):
+            client = Client(SERVER_NAME="localhost")
+            if user is not None:
+                client.force_login(user)
+
+            message = options["message"]
+            if not options["identical"]:
+                # Mensajes distintos para que no se agrupen en una sola generación
+                message = f"{message} #{index}"
+
+            body = json.dumps({"message": message, "only_future": True})
+
+            inicio = time.perf_counter()
+            response = client.post(ENDPOINTS[endpoint], body, content_type="application/json")
+
+            first_token = None
+            if response.streaming:
+                for chunk in response.streaming_content:
+                    if first_token is None and chunk.startswith(b"data: ") and not chunk.startswith(b"data: META:"):
+                        first_token = time.perf_counter() - inicio
+            total = time.perf_counter() - inicio
+
+            return {
+                "ok": response.status_code == 200,
+                "ttft": first_token if first_token is not None else total,
+                "total": total,
+            }
+
+        self.stdout.write(f"\n🚀 {endpoint}: {total_requests} peticions, concurrència {concurrency}")
+
+        inicio = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            results = list(executor.map(one_request, range(total_requests)))
+        wall_time = time.perf_counter() - inicio
+
+        # L'historial s'escriu en segon pla: el buidem perquè compti dins del benchmark
+        flush_history()
+
+        ok = [result for result in results if result["ok"]]
+        ttft = [result["ttft"] for result in ok]
+        total = [result["total"] for result in ok]
+
+        self.stdout.write(
+            f"   • Correctes: {len(ok)}/{len(results)}\n"
+            f"   • Throughput: {len(ok) / wall_time:.2f} peticions/s ({wall_time:.2f} s en total)\n"
+            f"   • Primer token (ms): p50={percentile(ttft, 50) * 1000:.1f} "
+            f"p95={percentile(ttft, 95) * 1000:.1f} p99={percentile(ttft, 99) * 1000:.1f}\n"
+            f"   • Latència total (ms): p50={percentile(total, 50) * 1000:.1f} "
+            f"p95={percentile(total, 95) * 1000:.1f} p99={percentile(total, 99) * 1000:.1f} "
+            f"mitjana={statistics.fmean(total) * 1000 if total else 0:.1f}"
+        )
+
+        if len(ok) < len(results):
+            self.stdout.write(self.style.WARNING(f"   ⚠️  {len(results) - len(ok)} peticions han fallat"))
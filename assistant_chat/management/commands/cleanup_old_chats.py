@@ -1,7 +1,10 @@
+import time
+from datetime import timedelta
+
 from django.core.management.base import BaseCommand
 from django.utils import timezone
-from datetime import timedelta
-from assistant_chat.models import ChatSession
+
+from assistant_chat.models import ChatSession, ChatMessage
 
 
 class Command(BaseCommand):
@@ -10,39 +13,123 @@ class Command(BaseCommand):
 
     Se ejecuta con:
         python manage.py cleanup_old_chats
+        python manage.py cleanup_old_chats --batch-size 500 --sleep 0.2
+        python manage.py cleanup_old_chats --dry-run
 
     En producción se programaría con cron (Linux) o Task Scheduler (Windows)
     para ejecutarse automáticamente cada día.
+
+    Borra por lotes de ids de sesión (paginación por id, sin OFFSET): primero
+    los mensajes del lote y después las sesiones. Como los mensajes ya no
+    están, el colector de CASCADE de Django no tiene que cargarlos en memoria.
+    Los borrados vuelven a filtrar por last_activity: una sesión que el
+    history_writer usa entre la selección y el borrado no se borra (ni sus
+    mensajes).
     """
 
     # Descripción que aparece al ejecutar: python manage.py help cleanup_old_chats
     help = "Elimina les sessions de xat amb més de 15 dies d'inactivitat"
 
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--days",
+            type=int,
+            default=15,
+            help="Dies d'inactivitat a partir dels quals s'elimina una sessió"
+        )
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=500,
+            help="Sessions a eliminar per lot"
+        )
+        parser.add_argument(
+            "--sleep",
+            type=float,
+            default=0.0,
+            help="Segons d'espera entre lots per no saturar la BD"
+        )
+        parser.add_argument(
+            "--dry-run",
+            action="store_true",
+            help="Només compta el que s'eliminaria, sense esborrar res"
+        )
+
     def handle(self, *args, **options):
         """
         Método principal que se ejecuta cuando llamamos al comando.
         Django llama a este método automáticamente.
         """
 
-        # Calculamos la fecha límite: hoy menos 15 días
-        # Las sesiones con last_activity anterior a esta fecha serán eliminadas
-        expiration_date = timezone.now() - timedelta(days=15)
+        batch_size = max(1, options["batch_size"])
+        pause = max(0.0, options["sleep"])
+        dry_run = options["dry_run"]
 
-        # Buscamos todas las sesiones con última actividad anterior a la fecha límite
-        # Gracias al CASCADE de ChatMessage, al borrar la sesión
-        # se borran también todos sus mensajes automáticamente
+        # Calculamos la fecha límite: hoy menos N días
+        # Las sesiones con last_activity anterior a esta fecha serán eliminadas
+        expiration_date = timezone.now() - timedelta(days=options["days"])
         old_sessions = ChatSession.objects.filter(last_activity__lt=expiration_date)
 
-        # Guardamos el número de sesiones antes de borrar para el informe
-        total_deleted = old_sessions.count()
+        if dry_run:
+            self.stdout.write(self.style.WARNING("ℹ️  Mode --dry-run: no s'esborrarà res"))
+
+        total_sessions = 0
+        total_messages = 0
+        batch_number = 0
+        last_id = 0
+        inicio = time.perf_counter()
+
+        while True:
+            # Siguiente lote de ids por orden, a partir del último procesado
+            ids = list(
+                old_sessions.filter(id__gt=last_id)
+                .order_by("id")
+                .values_list("id", flat=True)[:batch_size]
+            )
+            if not ids:
+                break
+
+            batch_number += 1
+            last_id = ids[-1]
+
+            messages = ChatMessage.objects.filter(session_id__in=ids, session__last_activity__lt=expiration_date)
+            sessions = old_sessions.filter(id__in=ids)
+
+            if dry_run:
+                deleted_messages = messages.count()
+                deleted_sessions = len(ids)
+            else:
+                # Nada depende de ChatMessage: Django lo borra con una sola consulta
+                deleted_messages, _ = messages.delete()
+                _, deleted = sessions.delete()
+                deleted_sessions = deleted.get(ChatSession._meta.label, 0)
+                # Mensajes que se hayan añadido entre los dos borrados (en cascada)
+                deleted_messages += deleted.get(ChatMessage._meta.label, 0)
+
+            total_sessions += deleted_sessions
+            total_messages += deleted_messages
+
+            elapsed = time.perf_counter() - inicio
+            self.stdout.write(
+                f"   Lot {batch_number}: {deleted_sessions} sessions, {deleted_messages} missatges "
+                f"(total {total_sessions} sessions, {total_messages} missatges, "
+                f"{total_messages / elapsed if elapsed else 0:.0f} missatges/s)"
+            )
+
+            if len(ids) < batch_size:
+                break
+
+            if pause:
+                time.sleep(pause)
 
-        # Eliminamos todas las sesiones antiguas de una sola consulta a la BD
-        old_sessions.delete()
+        elapsed = time.perf_counter() - inicio
+        action = "S'eliminarien" if dry_run else "Eliminades"
 
         # Mostramos un mensaje de confirmación en la terminal
         # self.stdout.write es la forma correcta de imprimir en comandos Django
         self.stdout.write(
             self.style.SUCCESS(
-                f"✅ Eliminades {total_deleted} sessions de xat antigues."
+                f"✅ {action} {total_sessions} sessions de xat antigues "
+                f"i {total_messages} missatges en {elapsed:.2f} s."
             )
-        )
\ No newline at end of file
+        )
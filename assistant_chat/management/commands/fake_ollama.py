@@ -0,0 +1,156 @@
+"""
+Comando: fake_ollama
+Servidor HTTP local que imita /api/generate de Ollama, para poder medir
+el asistente sin una máquina con GPU ejecutando llama3.1.
+
+Se ejecuta con:
+    python manage.py fake_ollama --port 11435 --tokens-per-second 30 --first-token-delay 0.4
+
+Y se apunta el asistente a él con la variable de entorno:
+    OLLAMA_URL=http://127.0.0.1:11435/api/generate
+"""
+import json
+import re
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from django.core.management.base import BaseCommand
+
+# Ids de los candidatos en el prompt compacto: una línea "id|títol|data|..."
+_CANDIDATE_ID_RE = re.compile(r"^(\d+)\|", re.MULTILINE)
+
+
+def build_answer(prompt: str) -> str:
+    """Respuesta JSON como la que pedimos al modelo, recomendando los 3 primeros candidatos."""
+    ids = [int(match) for match in _CANDIDATE_ID_RE.findall(prompt)][:3]
+    return json.dumps({
+        "answer": "Et recomano aquests esdeveniments, que encaixen amb el que busques.",
+        "recommended_ids": ids,
+        "follow_up": "Vols que filtri per data o categoria?",
+    }, ensure_ascii=False)
+
+
+def split_tokens(text: str) -> list[str]:
+    """Parte el texto en trozos parecidos a tokens (palabras con su espacio y signos sueltos)."""
+    return re.findall(r"\s*\w+|\s*[^\w\s]", text)
+
+
+def make_handler(tokens_per_second: float, first_token_delay: float):
+    """Crea la clase del handler HTTP con la velocidad de generación configurada."""
+
+    token_interval = 1.0 / tokens_per_second if tokens_per_second > 0 else 0.0
+
+    class FakeOllamaHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, format, *args):
+            # Sin logs por petición: en un benchmark ensucian la salida
+            pass
+
+        def do_POST(self):
+            if self.path != "/api/generate":
+                self.send_error(404)
+                return
+
+            length = int(self.headers.get("Content-Length") or 0)
+            payload = json.loads(self.rfile.read(length) or b"{}")
+
+            prompt = payload.get("prompt", "")
+            tokens = split_tokens(build_answer(prompt))
+            # Contexto de mentira: un id por token del prompt y de la respuesta
+            context = list(range(len(split_tokens(prompt)) + len(tokens)))
+
+            # Tiempo de procesado del prompt antes del primer token
+            time.sleep(first_token_delay)
+
+            if payload.get("stream", True):
+                self._send_stream(payload, tokens, context)
+            else:
+                time.sleep(token_interval * len(tokens))
+                self._send_json({
+                    "model": payload.get("model"),
+                    "response": "".join(tokens),
+                    "done": True,
+                    "context": context,
+                })
+
+        def _send_json(self, data: dict):
+            body = json.dumps(data, ensure_ascii=False).encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def _send_stream(self, payload: dict, tokens: list, context: list):
+            # NDJSON por chunks, igual que Ollama: una línea por token y una final con done=true
+            self.send_response(200)
+            self.send_header("Content-Type", "application/x-ndjson")
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+
+            for index, token in enumerate(tokens):
+                if index:
+                    time.sleep(token_interval)
+                self._write_chunk({"model": payload.get("model"), "response": token, "done": False})
+
+            self._write_chunk({"model": payload.get("model"), "response": "", "done": True, "context": context})
+            self.wfile.write(b"0\r\n\r\n")
+            self.wfile.flush()
+
+        def _write_chunk(self, data: dict):
+            line = json.dumps(data, ensure_ascii=False).encode("utf-8") + b"\n"
+            self.wfile.write(f"{len(line):X}\r\n".encode("ascii") + line + b"\r\n")
+            self.wfile.flush()
+
+    return FakeOllamaHandler
+
+
+def make_server(host: str, port: int, tokens_per_second: float, first_token_delay: float) -> ThreadingHTTPServer:
+    """Crea el servidor (sin arrancarlo). Con port=0 el sistema elige un puerto libre."""
+    server = ThreadingHTTPServer((host, port), make_handler(tokens_per_second, first_token_delay))
+    server.daemon_threads = True
+    return server
+
+
+class Command(BaseCommand):
+    help = "Arrenca un servidor local que imita l'API /api/generate d'Ollama"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--host", default="127.0.0.1", help="Adreça on escoltar")
+        parser.add_argument("--port", type=int, default=11435, help="Port on escoltar")
+        parser.add_argument(
+            "--tokens-per-second",
+            type=float,
+            default=30.0,
+            help="Velocitat de generació simulada (0 = sense espera)"
+        )
+        parser.add_argument(
+            "--first-token-delay",
+            type=float,
+            default=0.4,
+            help="Segons de processat del prompt abans del primer token"
+        )
+
+    def handle(self, *args, **options):
+        server = make_server(
+            options["host"],
+            options["port"],
+            options["tokens_per_second"],
+            options["first_token_delay"],
+        )
+        host, port = server.server_address[:2]
+
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"🤖 Fake Ollama escoltant a http://{host}:{port}/api/generate "
+                f"({options['tokens_per_second']} tokens/s, primer token en {options['first_token_delay']} s)"
+            )
+        )
+
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            self.stdout.write("Aturant el servidor...")
+        finally:
+            server.server_close()
@@ -76,6 +76,10 @@ class ChatMessage(models.Model):
     class Meta:
         # Ordenar por timestamp, más antiguo primero (orden natural de conversación)
         ordering = ["timestamp"]
+        # Índice compuesto para paginar el historial de una sesión por (timestamp, id)
+        indexes = [
+            models.Index(fields=["session", "timestamp"], name="assistant_msg_session_ts"),
+        ]
 
     def __str__(self):
         return f"[{self.role}] {self.text[:50]}..."
\ No newline at end of file
@@ -0,0 +1,113 @@
+"""
+Circuit breaker para las llamadas a Ollama.
+
+Si Ollama está caído o va muy lento, cada petición al asistente se quedaba
+bloqueada hasta el timeout y acababa ocupando todos los workers.
+El circuit breaker vigila las últimas llamadas y, si fallan demasiadas
+(un error o una llamada más lenta que SLOW_CALL_SECONDS cuentan como fallo),
+"abre el circuito": durante OPEN_SECONDS las llamadas fallan al instante
+con CircuitOpenError y la vista responde con una alternativa sin LLM.
+
+Pasado ese tiempo el circuito queda "medio abierto" y deja pasar una sola
+llamada de prueba: si va bien se cierra, si falla se vuelve a abrir.
+"""
+import threading
+import time
+from collections import deque
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class CircuitOpenError(Exception):
+    """Se lanza cuando el circuito está abierto y no se debe llamar al servicio."""
+
+
+class CircuitBreaker:
+    def __init__(self, window: int = 20, min_calls: int = 5, failure_rate: float = 0.5,
+                 slow_call_seconds: float = 10.0, open_seconds: float = 30.0, clock=time.monotonic):
+        """
+        Args:
+            window: Número de llamadas recientes que se tienen en cuenta
+            min_calls: Llamadas mínimas en la ventana antes de poder abrir el circuito
+            failure_rate: Proporción de fallos (0-1) a partir de la cual se abre
+            slow_call_seconds: Una llamada más lenta que esto cuenta como fallo
+            open_seconds: Tiempo que el circuito permanece abierto antes de probar
+            clock: Función que devuelve el instante actual en segundos (los tests la sustituyen)
+        """
+        self.min_calls = min_calls
+        self.failure_rate = failure_rate
+        self.slow_call_seconds = slow_call_seconds
+        self.open_seconds = open_seconds
+        self.clock = clock
+
+        self._lock = threading.Lock()
+        self._outcomes = deque(maxlen=window)  # True = fallo
+        self._state = CLOSED
+        self._opened_at = 0.0
+        self._probe_in_flight = False
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            self._refresh_state()
+            return self._state
+
+    def before_call(self) -> None:
+        """
+        Se llama antes de cada petición. Lanza CircuitOpenError si no se debe llamar.
+        En estado medio abierto solo deja pasar una llamada de prueba a la vez.
+        """
+        with self._lock:
+            self._refresh_state()
+
+            if self._state == OPEN:
+                raise CircuitOpenError("Ollama no disponible (circuit obert)")
+
+            if self._state == HALF_OPEN:
+                if self._probe_in_flight:
+                    raise CircuitOpenError("Ollama no disponible (provant recuperació)")
+                self._probe_in_flight = True
+
+    def record_success(self, latency: float) -> None:
+        """Registra una llamada terminada. Si ha sido demasiado lenta cuenta como fallo."""
+        if latency > self.slow_call_seconds:
+            self.record_failure()
+            return
+
+        with self._lock:
+            if self._state == HALF_OPEN:
+                # La prueba ha ido bien: cerramos y empezamos de cero
+                self._state = CLOSED
+                self._outcomes.clear()
+                self._probe_in_flight = False
+                return
+
+            self._outcomes.append(False)
+
+    def record_failure(self) -> None:
+        """Registra una llamada fallida y abre el circuito si hay demasiados fallos."""
+        with self._lock:
+            if self._state == HALF_OPEN:
+                # La prueba ha fallado: volvemos a abrir
+                self._open()
+                return
+
+            self._outcomes.append(True)
+
+            calls = len(self._outcomes)
+            failures = sum(self._outcomes)
+            if calls >= self.min_calls and failures / calls >= self.failure_rate:
+                self._open()
+
+    def _open(self) -> None:
+        self._state = OPEN
+        self._opened_at = self.clock()
+        self._probe_in_flight = False
+
+    def _refresh_state(self) -> None:
+        """Pasa de abierto a medio abierto cuando ha pasado open_seconds."""
+        if self._state == OPEN and self.clock() - self._opened_at >= self.open_seconds:
+            self._state = HALF_OPEN
+            self._probe_in_flight = False
@@ -0,0 +1,48 @@
+"""
+Respuesta alternativa cuando el LLM no está disponible.
+
+Si el circuit breaker de Ollama está abierto (o Ollama falla antes de
+generar nada), construimos una respuesta con plantilla a partir de los
+eventos que ya ha encontrado el retrieval, con el mismo formato JSON
+que devolvería el modelo.
+"""
+
+# Eventos que se mencionan en la respuesta alternativa
+MAX_FALLBACK_EVENTS = 3
+
+
+def build_fallback_answer(candidates: list) -> dict:
+    """
+    Construye {"answer", "recommended_ids", "follow_up"} sin llamar al LLM.
+
+    Args:
+        candidates: Eventos candidatos del retrieval, ordenados por relevancia
+    """
+
+    if not candidates:
+        return {
+            "answer": (
+                "L'assistent no està disponible ara mateix i no he trobat cap "
+                "esdeveniment que encaixi amb la teva consulta."
+            ),
+            "recommended_ids": [],
+            "follow_up": "Pots provar amb altres paraules o tornar-ho a intentar d'aquí a una estona.",
+        }
+
+    selected = candidates[:MAX_FALLBACK_EVENTS]
+
+    lines = []
+    for candidate in selected:
+        date = (candidate.get("scheduled_date") or "")[:10]
+        lines.append(f"- {candidate['title']}" + (f" ({date})" if date else ""))
+
+    answer = (
+        "L'assistent no està disponible ara mateix, però aquests són els esdeveniments "
+        "que millor encaixen amb la teva consulta:\n" + "\n".join(lines)
+    )
+
+    return {
+        "answer": answer,
+        "recommended_ids": [candidate["id"] for candidate in selected],
+        "follow_up": "",
+    }
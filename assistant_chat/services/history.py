@@ -0,0 +1,74 @@
+"""
+Paginación del historial del asistente por cursor (keyset pagination).
+
+En lugar de OFFSET, cada página se pide "antes de" el mensaje más antiguo
+que ya tiene el cliente, identificado por (timestamp, id). Así cada página
+cuesta lo mismo sin importar lo largo que sea el historial, y usa el índice
+compuesto (session, timestamp) de ChatMessage.
+"""
+from datetime import datetime, timedelta, timezone as dt_timezone
+
+from django.db.models import Q
+
+# Mensajes que cargamos al renderizar la página y en cada página anterior
+HISTORY_PAGE_SIZE = 20
+
+_EPOCH = datetime(1970, 1, 1, tzinfo=dt_timezone.utc)
+
+
+def encode_cursor(message: dict) -> str:
+    """
+    Convierte (timestamp, id) de un mensaje en un cursor opaco apto para URLs:
+    "<microsegundos desde epoch>_<id>"
+    """
+    microseconds = (message["timestamp"] - _EPOCH) // timedelta(microseconds=1)
+    return f"{microseconds}_{message['id']}"
+
+
+def decode_cursor(cursor: str):
+    """
+    Operación inversa de encode_cursor.
+
+    Returns:
+        tuple: (timestamp, id), o None si el cursor no es válido
+    """
+    try:
+        microseconds, message_id = cursor.split("_", 1)
+        return _EPOCH + timedelta(microseconds=int(microseconds)), int(message_id)
+    except (AttributeError, ValueError, OverflowError):
+        return None
+
+
+def get_history_page(session, before=None, limit: int = HISTORY_PAGE_SIZE):
+    """
+    Devuelve una página del historial de una sesión.
+
+    Args:
+        session: ChatSession del usuario
+        before: Cursor (de encode_cursor) del mensaje más antiguo ya cargado, o None
+                para cargar los más recientes
+        limit: Número máximo de mensajes de la página
+
+    Returns:
+        tuple: (mensajes en orden cronológico, cursor para la página anterior o None)
+    """
+    queryset = session.messages.all()
+
+    position = decode_cursor(before) if before else None
+    if position:
+        timestamp, message_id = position
+        queryset = queryset.filter(
+            Q(timestamp__lt=timestamp) | Q(timestamp=timestamp, id__lt=message_id)
+        )
+
+    # Pedimos uno de más para saber si quedan páginas anteriores
+    page = list(
+        queryset.order_by("-timestamp", "-id").values("id", "role", "text", "timestamp")[:limit + 1]
+    )
+
+    has_more = len(page) > limit
+    page = page[:limit]
+    page.reverse()
+
+    next_cursor = encode_cursor(page[0]) if has_more else None
+    return page, next_cursor
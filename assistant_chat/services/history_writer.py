@@ -0,0 +1,162 @@
+"""
+Escritura diferida del historial del asistente.
+
+Las vistas ya no guardan los mensajes antes de responder: dejan cada intercambio
+(mensaje del usuario + respuesta del asistente) en una cola en memoria y un hilo
+en segundo plano los guarda por lotes:
+
+- Una sola consulta para encontrar las sesiones de todos los usuarios del lote
+- Un bulk_create con todos los mensajes del lote
+- Un único update de last_activity por lote (en lugar de un save() por mensaje)
+
+Al cerrar el proceso (atexit) se vacía la cola para no perder mensajes.
+"""
+import atexit
+import logging
+import queue
+import threading
+
+from django.db import close_old_connections
+from django.utils import timezone
+
+from ..models import ChatSession, ChatMessage
+
+logger = logging.getLogger(__name__)
+
+# Máximo de intercambios por lote
+BATCH_SIZE = 200
+
+# Segundos que esperamos a que se acumulen más intercambios antes de escribir
+FLUSH_INTERVAL = 0.5
+
+# Máximo de intercambios pendientes; si se llena, escribimos en el mismo hilo
+MAX_PENDING = 10000
+
+# Segundos que esperamos al hilo al cerrar el proceso
+SHUTDOWN_TIMEOUT = 10
+
+_queue = queue.Queue(maxsize=MAX_PENDING)
+_lock = threading.Lock()
+_worker = None
+_stopping = threading.Event()
+
+
+def record_exchange(user_id, user_text: str, assistant_text: str) -> None:
+    """
+    Encola un intercambio para guardarlo más tarde. No toca la BD
+    salvo que la cola esté llena (en ese caso escribe directamente).
+    """
+    if not user_id:
+        return
+
+    item = (user_id, user_text, assistant_text)
+
+    if _stopping.is_set():
+        # Si ya estamos cerrando, no hay hilo que lo recoja
+        _write_batch([item])
+        return
+
+    _ensure_worker()
+
+    try:
+        _queue.put_nowait(item)
+    except queue.Full:
+        logger.warning("Cua d'historial plena: escrivint de forma síncrona")
+        _write_batch([item])
+
+
+def flush() -> None:
+    """Guarda inmediatamente todo lo que haya pendiente en la cola."""
+    while True:
+        batch = _drain(BATCH_SIZE)
+        if not batch:
+            return
+        _write_batch(batch)
+
+
+def _ensure_worker() -> None:
+    """Arranca el hilo de escritura la primera vez que se necesita."""
+    global _worker
+
+    if _worker is not None and _worker.is_alive():
+        return
+
+    with _lock:
+        if _worker is None or not _worker.is_alive():
+            _worker = threading.Thread(target=_run, name="assistant-history-writer", daemon=True)
+            _worker.start()
+
+
+def _drain(limit: int) -> list:
+    """Saca de la cola hasta `limit` elementos sin bloquear."""
+    items = []
+    while len(items) < limit:
+        try:
+            items.append(_queue.get_nowait())
+        except queue.Empty:
+            break
+    return items
+
+
+def _run() -> None:
+    """Bucle del hilo: espera al primer elemento, agrupa los siguientes y escribe el lote."""
+    while not _stopping.is_set():
+        try:
+            first = _queue.get(timeout=FLUSH_INTERVAL)
+        except queue.Empty:
+            continue
+
+        # Damos un momento para que lleguen más intercambios y escribirlos juntos
+        _stopping.wait(FLUSH_INTERVAL)
+        batch = [first] + _drain(BATCH_SIZE - 1)
+
+        try:
+            _write_batch(batch)
+        finally:
+            # Este hilo no pasa por el ciclo request/response de Django
+            close_old_connections()
+
+
+def _write_batch(batch: list) -> None:
+    """Guarda un lote de intercambios con el mínimo de consultas."""
+    if not batch:
+        return
+
+    try:
+        user_ids = {user_id for user_id, _, _ in batch}
+
+        # Sesión más reciente de cada usuario (ordering = -last_activity)
+        sessions = {}
+        for session in ChatSession.objects.filter(user_id__in=user_ids):
+            sessions.setdefault(session.user_id, session)
+
+        for user_id in user_ids - sessions.keys():
+            sessions[user_id] = ChatSession.objects.create(user_id=user_id)
+
+        messages = []
+        for user_id, user_text, assistant_text in batch:
+            session = sessions[user_id]
+            messages.append(ChatMessage(session=session, role=ChatMessage.ROLE_USER, text=user_text))
+            messages.append(ChatMessage(session=session, role=ChatMessage.ROLE_ASSISTANT, text=assistant_text))
+
+        # Una sola actualización de last_activity para todas las sesiones del lote.
+        # Antes de insertar: así cleanup_old_chats ya no las considera antiguas
+        ChatSession.objects.filter(
+            pk__in=[session.pk for session in sessions.values()]
+        ).update(last_activity=timezone.now())
+
+        ChatMessage.objects.bulk_create(messages)
+
+    except Exception:
+        logger.exception("Error guardant %s intercanvis de l'assistent", len(batch))
+
+
+@atexit.register
+def _shutdown() -> None:
+    """Al cerrar el proceso, paramos el hilo y guardamos lo que quede pendiente."""
+    _stopping.set()
+
+    if _worker is not None and _worker.is_alive():
+        _worker.join(timeout=SHUTDOWN_TIMEOUT)
+
+    flush()
@@ -1,47 +1,110 @@
+import os
 import requests
 import json
+import time
+
+from .circuit_breaker import CircuitBreaker
 
 # URL de la API de Ollama que corre localmente en tu máquina
-OLLAMA_URL = "http://localhost:11434/api/generate"
+# (se puede cambiar con la variable de entorno OLLAMA_URL, p. ej. para usar fake_ollama)
+OLLAMA_URL = os.environ.get("OLLAMA_URL", "http://localhost:11434/api/generate")
 
 # Modelo que usaremos, puedes cambiarlo por "mistral:7b" para comparar
 OLLAMA_MODEL = "llama3.1:8b"
 # OLLAMA_MODEL = "mistral:7b"
 
+# Tamaño del contexto en tokens y máximo de tokens que puede generar el modelo.
+# El prompt tiene que caber en NUM_CTX - NUM_PREDICT (ver prompts.PROMPT_TOKEN_BUDGET)
+NUM_CTX = 2048
+NUM_PREDICT = 512
 
-def generate(prompt: str) -> str:
-    """
-    Envía un prompt al modelo LLM local (Ollama) y devuelve su respuesta completa.
-    Versión sin stream: espera a que el modelo termine antes de devolver nada.
+# Tiempo que Ollama mantiene el modelo cargado en memoria tras cada petición.
+# Así los turnos siguientes de una conversación no pagan la carga del modelo
+OLLAMA_KEEP_ALIVE = "30m"
 
-    Args:
-        prompt: El texto completo que le enviamos al modelo
+# Una llamada que tarda más que esto (en streaming, hasta el primer token)
+# cuenta como fallo para el circuit breaker
+SLOW_CALL_SECONDS = 10.0
 
-    Returns:
-        str: La respuesta generada por el modelo en texto plano
+# Timeouts de requests: (conexión, lectura). Si Ollama no acepta la conexión
+# en unos segundos no tiene sentido esperar más. La lectura no espera más de lo
+# que el circuit breaker considera lento: un Ollama colgado libera el worker
+# (y cuenta como fallo) a los SLOW_CALL_SECONDS, no al cabo de un minuto
+OLLAMA_TIMEOUT = (3, SLOW_CALL_SECONDS)
+
+# Circuit breaker compartido por todas las llamadas a Ollama de este proceso.
+# Para el streaming la latencia que se mide es el tiempo hasta el primer token
+breaker = CircuitBreaker(slow_call_seconds=SLOW_CALL_SECONDS)
+
+
+def _build_payload(prompt: str, stream: bool, context: list | None = None) -> dict:
+    """
+    Construye el cuerpo de la petición a /api/generate.
+
+    Si recibimos el `context` que Ollama devolvió en el turno anterior,
+    lo reenviamos para que el modelo continúe la conversación sin
+    volver a procesar el prompt del sistema.
     """
 
     payload = {
         "model": OLLAMA_MODEL,
         "prompt": prompt,
-        "stream": False,             # Espera la respuesta completa de una vez
+        "stream": stream,
+        "keep_alive": OLLAMA_KEEP_ALIVE,
         "options": {
             "temperature": 0.1,      # Temperatura baja = menos alucinaciones
             "top_p": 0.9,            # Diversidad del vocabulario
-            "num_ctx": 2048          # Tamaño del contexto en tokens
+            "num_ctx": NUM_CTX,      # Tamaño del contexto en tokens
+            "num_predict": NUM_PREDICT  # Límite de tokens de la respuesta
         }
     }
 
-    # Enviamos la petición HTTP POST a Ollama
-    respuesta = requests.post(OLLAMA_URL, json=payload, timeout=60)
-    respuesta.raise_for_status()
+    if context:
+        payload["context"] = context
+
+    return payload
+
+
+def generate(prompt: str, context: list | None = None, result: dict | None = None) -> str:
+    """
+    Envía un prompt al modelo LLM local (Ollama) y devuelve su respuesta completa.
+    Versión sin stream: espera a que el modelo termine antes de devolver nada.
+
+    Args:
+        prompt: El texto completo que le enviamos al modelo
+        context: Tokens de contexto devueltos por Ollama en el turno anterior (opcional)
+        result: Diccionario opcional donde guardamos el nuevo `context` devuelto por Ollama
+
+    Returns:
+        str: La respuesta generada por el modelo en texto plano
+    """
+
+    payload = _build_payload(prompt, stream=False, context=context)
+
+    # Si el circuito está abierto, falla al instante con CircuitOpenError
+    breaker.before_call()
+    inicio = time.perf_counter()
+
+    try:
+        # Enviamos la petición HTTP POST a Ollama
+        respuesta = requests.post(OLLAMA_URL, json=payload, timeout=OLLAMA_TIMEOUT)
+        respuesta.raise_for_status()
+
+        # Ollama devuelve: {"response": "texto generado", "context": [...], ...}
+        datos = respuesta.json()
+    except Exception:
+        breaker.record_failure()
+        raise
+
+    breaker.record_success(time.perf_counter() - inicio)
+
+    if result is not None:
+        result["context"] = datos.get("context")
 
-    # Ollama devuelve: {"response": "texto generado", "model": ..., ...}
-    datos = respuesta.json()
     return datos.get("response", "").strip()
 
 
-def generate_stream(prompt: str):
+def generate_stream(prompt: str, context: list | None = None, result: dict | None = None):
     """
     Versión con stream: genera tokens uno a uno usando un generador de Python.
     En lugar de esperar la respuesta completa, envía cada palabra
@@ -49,41 +112,54 @@ def generate_stream(prompt: str):
 
     Args:
         prompt: El texto completo que le enviamos al modelo
+        context: Tokens de contexto devueltos por Ollama en el turno anterior (opcional)
+        result: Diccionario opcional donde guardamos el nuevo `context`
+                (Ollama solo lo envía en el último chunk, con done=True)
 
     Yields:
         str: Cada token (palabra o fragmento) generado por el modelo
     """
 
-    payload = {
-        "model": OLLAMA_MODEL,
-        "prompt": prompt,
-        "stream": True,              # Activamos el stream
-        "options": {
-            "temperature": 0.1,
-            "top_p": 0.9,
-            "num_ctx": 2048
-        }
-    }
-
-    # stream=True en requests significa que lee la respuesta línea a línea
-    # sin esperar a que llegue completa
-    with requests.post(OLLAMA_URL, json=payload, timeout=60, stream=True) as resposta:
-        resposta.raise_for_status()
-
-        # Ollama envía una línea JSON por cada token generado
-        # Ejemplo línea: {"response": "Hola", "done": false}
-        for linea in resposta.iter_lines():
-            if linea:
-                # Convertimos la línea JSON a diccionario
-                chunk = json.loads(linea.decode("utf-8"))
-
-                # Extraemos el token generado
-                token = chunk.get("response", "")
-
-                if token:
-                    # yield envía el token inmediatamente sin esperar al siguiente
-                    yield token
-
-                # Cuando done=True, el modelo ha terminado de generar
-                if chunk.get("done", False):
-                    break
\ No newline at end of file
+    payload = _build_payload(prompt, stream=True, context=context)
+
+    # Si el circuito está abierto, falla al instante con CircuitOpenError
+    breaker.before_call()
+    inicio = time.perf_counter()
+    primer_token = None
+
+    try:
+        # stream=True en requests significa que lee la respuesta línea a línea
+        # sin esperar a que llegue completa
+        with requests.post(OLLAMA_URL, json=payload, timeout=OLLAMA_TIMEOUT, stream=True) as resposta:
+            resposta.raise_for_status()
+
+            # Ollama envía una línea JSON por cada token generado
+            # Ejemplo línea: {"response": "Hola", "done": false}
+            for linea in resposta.iter_lines():
+                if linea:
+                    # Convertimos la línea JSON a diccionario
+                    chunk = json.loads(linea.decode("utf-8"))
+
+                    # Extraemos el token generado
+                    token = chunk.get("response", "")
+
+                    if token:
+                        if primer_token is None:
+                            primer_token = time.perf_counter() - inicio
+                        # yield envía el token inmediatamente sin esperar al siguiente
+                        yield token
+
+                    # Cuando done=True, el modelo ha terminado de generar
+                    if chunk.get("done", False):
+                        if result is not None:
+                            result["context"] = chunk.get("context")
+                        break
+    except GeneratorExit:
+        # El consumidor ha dejado de leer: Ollama respondía, así que no es un fallo
+        breaker.record_success(primer_token if primer_token is not None else time.perf_counter() - inicio)
+        raise
+    except Exception:
+        breaker.record_failure()
+        raise
+
+    breaker.record_success(primer_token if primer_token is not None else time.perf_counter() - inicio)
@@ -1,30 +1,137 @@
-import json
+import math
+import re
 
+from .llm_ollama import NUM_CTX, NUM_PREDICT
 
-def build_prompt(user_message: str, candidates: list) -> str:
+# Presupuesto total para el prompt: lo que queda del contexto tras reservar la respuesta
+PROMPT_TOKEN_BUDGET = NUM_CTX - NUM_PREDICT
+
+# Límites por campo para que un solo evento no se coma el presupuesto
+MAX_TITLE_CHARS = 80
+MAX_TAGS_CHARS = 60
+MAX_USER_MESSAGE_TOKENS = 256
+
+# Palabras (o números) y signos de puntuación sueltos
+_TOKEN_RE = re.compile(r"\w+|[^\w\s]")
+
+INSTRUCTIONS = """Ets un assistent de recomanació d'esdeveniments.
+Només pots recomanar events del context proporcionat.
+Si no hi ha matches, digues-ho i pregunta criteris.
+Respon SEMPRE en català.
+Respon ÚNICAMENT amb aquest JSON (sense text addicional fora del JSON):
+{"answer": "text amb la recomanació", "recommended_ids": [1, 2, 3], "follow_up": ""}"""
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    Estimación barata del número de tokens de un texto, sin cargar el tokenizer.
+
+    Cada signo de puntuación cuenta como un token y cada palabra como
+    un token por cada 4 caracteres (los tokenizers BPE parten las palabras largas).
+    Tiende a sobrestimar un poco, que es lo que queremos para no desbordar num_ctx.
+    """
+    if not text:
+        return 0
+    return sum(math.ceil(len(piece) / 4) for piece in _TOKEN_RE.findall(text))
+
+
+def _truncate(text: str, max_chars: int) -> str:
+    """Recorta un texto a max_chars caracteres añadiendo '…' si hace falta."""
+    text = (text or "").strip()
+    if len(text) <= max_chars:
+        return text
+    return text[:max_chars - 1].rstrip() + "…"
+
+
+def _truncate_tags(tags: str, max_chars: int) -> str:
+    """Recorta la lista de etiquetas sin partir ninguna etiqueta por la mitad."""
+    kept = []
+    length = 0
+    for tag in (tags or "").split(","):
+        tag = tag.strip()
+        if not tag:
+            continue
+        extra = len(tag) + (1 if kept else 0)
+        if length + extra > max_chars:
+            break
+        kept.append(tag)
+        length += extra
+    return ",".join(kept)
+
+
+def encode_candidate(candidate: dict) -> str:
+    """
+    Codificación compacta de un candidato en una sola línea:
+    id|títol|data|categoria|etiquetes
+
+    La URL y el score no se envían: el modelo no los necesita para recomendar.
+    """
+    scheduled_date = (candidate.get("scheduled_date") or "")[:16].replace("T", " ")
+    fields = [
+        str(candidate["id"]),
+        _truncate(candidate.get("title"), MAX_TITLE_CHARS),
+        scheduled_date,
+        candidate.get("category") or "",
+        _truncate_tags(candidate.get("tags"), MAX_TAGS_CHARS),
+    ]
+    # El separador no puede aparecer dentro de los campos
+    return "|".join(field.replace("|", "/").replace("\n", " ") for field in fields)
+
+
+def _fit_candidates(candidates: list, budget: int) -> str:
     """
-    Construye el prompt siguiendo exactamente las indicaciones del enunciado.
+    Codifica los candidatos uno por línea hasta agotar el presupuesto de tokens.
+    Los candidatos llegan ordenados por relevancia, así que si no caben
+    se descartan empezando por los últimos.
     """
+    lines = []
+    used = 0
+    for candidate in candidates:
+        line = encode_candidate(candidate)
+        cost = estimate_tokens(line) + 1  # +1 por el salto de línea
+        if used + cost > budget:
+            break
+        lines.append(line)
+        used += cost
 
-    context_json = json.dumps(candidates, ensure_ascii=False, indent=2)
+    return "\n".join(lines) if lines else "(cap esdeveniment)"
 
-    prompt = f"""
-    Ets un assistent de recomanació d'esdeveniments.
-    Només pots recomanar events del context proporcionat.
-    Si no hi ha matches, digues-ho i pregunta criteris.
-    Respon SEMPRE en català.
 
-    Respon ÚNICAMENT amb aquest JSON (sense text addicional fora del JSON):
-    {{
-    "answer": "text amb la recomanació",
-    "recommended_ids": [1, 2, 3],
-    "follow_up": ""
-    }}
+def _clean_user_message(user_message: str) -> str:
+    """Limpia el mensaje del usuario y lo recorta si es demasiado largo."""
+    user_message = (user_message or "").strip()
+    if estimate_tokens(user_message) > MAX_USER_MESSAGE_TOKENS:
+        # Aproximación: ~4 caracteres por token
+        user_message = _truncate(user_message, MAX_USER_MESSAGE_TOKENS * 4)
+    return user_message
+
+
+def build_prompt(user_message: str, candidates: list, max_tokens: int = PROMPT_TOKEN_BUDGET) -> str:
+    """
+    Construye el prompt siguiendo exactamente las indicaciones del enunciado,
+    respetando un presupuesto de tokens.
+    """
+
+    header = f"{INSTRUCTIONS}\n\nCONTEXT (id|títol|data|categoria|etiquetes):\n"
+    footer = f"\n\nUsuari: {_clean_user_message(user_message)}"
+
+    budget = max_tokens - estimate_tokens(header) - estimate_tokens(footer)
+    context = _fit_candidates(candidates, budget)
+
+    return f"{header}{context}{footer}"
+
+
+def build_followup_prompt(user_message: str, candidates: list, max_tokens: int = PROMPT_TOKEN_BUDGET) -> str:
+    """
+    Prompt para los turnos siguientes de una conversación que reutiliza
+    el `context` de Ollama: las instrucciones ya están en el contexto del modelo,
+    así que solo enviamos los candidatos nuevos y el mensaje del usuario.
+    """
 
-    CONTEXT:
-    {context_json}
+    header = "CONTEXT (id|títol|data|categoria|etiquetes):\n"
+    footer = f"\n\nUsuari: {_clean_user_message(user_message)}"
 
-    Usuari: {user_message}
-    """.strip()
+    budget = max_tokens - estimate_tokens(header) - estimate_tokens(footer)
+    context = _fit_candidates(candidates, budget)
 
-    return prompt
\ No newline at end of file
+    return f"{header}{context}{footer}"
@@ -1,7 +1,13 @@
+import time
+
+import numpy as np
 from django.utils import timezone
 from events.models import Event
 from semantic_search.services.embeddings import embed_text
-from semantic_search.services.ranker import cosine_top_k
+from semantic_search.services.ranker import cosine_scores, top_k_indices
+
+# Score mínimo de similitud para considerar un evento relevante
+MIN_SCORE = 0.25
 
 
 def build_event_text(event: Event) -> str:
@@ -18,49 +24,72 @@ def build_event_text(event: Event) -> str:
     ]).strip()
 
 
-def retrieve_events(query: str, only_future: bool = True, k: int = 8):
+def retrieve_events(query: str, only_future: bool = True, k: int = 8, stats: dict | None = None):
     """
     Dado un texto de consulta del usuario, busca los eventos más relevantes.
-    
-    Proceso:
+
+    Proceso (una sola pasada por la colección):
     1. Convierte la consulta del usuario a un vector (embedding)
-    2. Busca primero entre eventos futuros
-    3. Si no encuentra nada, amplía la búsqueda a todos los eventos
-    4. Descarta eventos con score bajo (menos de 0.25)
+    2. Lee una vez todos los eventos con embedding y calcula todos los scores
+       de golpe (producto matriz-vector)
+    3. Descarta eventos con score bajo (menos de MIN_SCORE)
+    4. Si only_future=True, se queda con los K mejores eventos futuros;
+       si no hay ninguno, usa los K mejores de todos los eventos
+       (calculados en la misma pasada, sin volver a consultar la BD)
     5. Retorna los K más similares
+
+    Args:
+        stats: Diccionario opcional donde dejamos los tiempos del retrieval
+               (embed_ms, scan_ms, rank_ms, total_ms) y cuántos eventos se han comparado
     """
 
+    inicio = time.perf_counter()
+
     # Paso 1: Convertir la consulta a vector
     query_vector = embed_text(query)
+    despues_embedding = time.perf_counter()
 
-    def search_in_queryset(queryset):
-        """Función auxiliar que busca en un queryset dado."""
-        items = []
-        for event in queryset.only("id", "title", "scheduled_date", "category", "tags", "embedding"):
-            event_embedding = getattr(event, "embedding", None)
-            # Solo incluimos eventos que tengan embedding válido
-            if isinstance(event_embedding, list) and len(event_embedding) > 0:
-                items.append((event, event_embedding))
+    # Paso 2: Una sola lectura de la colección
+    events = []
+    vectors = []
+    future_flags = []
+    now = timezone.now()
 
-        # Calculamos cosine similarity y obtenemos los más relevantes
-        ranked_events = cosine_top_k(query_vector, items, k=max(k, 20))
+    queryset = Event.objects.only("id", "title", "scheduled_date", "category", "tags", "embedding")
+    for event in queryset:
+        event_embedding = getattr(event, "embedding", None)
+        # Solo incluimos eventos que tengan embedding válido y de la misma dimensión
+        if isinstance(event_embedding, list) and len(event_embedding) == len(query_vector) > 0:
+            events.append(event)
+            vectors.append(event_embedding)
+            future_flags.append(bool(event.scheduled_date and event.scheduled_date >= now))
+    despues_scan = time.perf_counter()
 
-        # Filtramos por score mínimo
-        ranked_events = [(event, similitud) for (event, similitud) in ranked_events if similitud >= 0.25]
+    # Paso 3: Calculamos cosine similarity para todos a la vez y filtramos por score mínimo
+    scores = cosine_scores(query_vector, vectors)
+    valid = scores >= MIN_SCORE
 
-        return ranked_events[:k]
-
-    # Paso 2: Buscar primero en eventos futuros si only_future=True
+    # Paso 4: Top-K de futuros y, si hace falta, top-K de todos
+    fallback_all = False
+    indices = []
     if only_future:
-        future_queryset = Event.objects.filter(scheduled_date__gte=timezone.now())
-        resultado = search_in_queryset(future_queryset)
-
-        # Paso 3: Si no hay resultados futuros, ampliar a todos los eventos
-        if not resultado:
-            all_queryset = Event.objects.all()
-            resultado = search_in_queryset(all_queryset)
-    else:
-        # Si only_future=False, buscar directamente en todos
-        resultado = search_in_queryset(Event.objects.all())
-
-    return resultado[:3]
\ No newline at end of file
+        indices = top_k_indices(scores, valid & np.asarray(future_flags, dtype=bool), k)
+        fallback_all = not indices
+
+    if not only_future or fallback_all:
+        indices = top_k_indices(scores, valid, k)
+
+    resultado = [(events[i], float(scores[i])) for i in indices]
+    final = time.perf_counter()
+
+    if stats is not None:
+        stats.update({
+            "embed_ms": round((despues_embedding - inicio) * 1000, 2),
+            "scan_ms": round((despues_scan - despues_embedding) * 1000, 2),
+            "rank_ms": round((final - despues_scan) * 1000, 2),
+            "total_ms": round((final - inicio) * 1000, 2),
+            "scanned": len(events),
+            "fallback_all": fallback_all,
+        })
+
+    return resultado
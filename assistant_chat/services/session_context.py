@@ -0,0 +1,96 @@
+"""
+Reutilización del contexto de Ollama entre turnos de una conversación.
+
+Ollama devuelve en cada respuesta de /api/generate una lista `context` con los
+tokens ya procesados (prompt + respuesta). Si la reenviamos en el turno siguiente,
+el modelo no vuelve a procesar las instrucciones del sistema y solo paga
+los tokens nuevos, lo que reduce el tiempo hasta el primer token.
+
+Guardamos ese contexto en memoria por usuario (una conversación por usuario,
+igual que ChatSession), con un máximo de entradas y una caducidad alineada
+con el keep_alive de Ollama.
+"""
+import threading
+import time
+from collections import OrderedDict
+
+from .prompts import PROMPT_TOKEN_BUDGET, build_prompt, build_followup_prompt, estimate_tokens
+
+# Número máximo de conversaciones que guardamos en memoria (LRU)
+MAX_SESSIONS = 1000
+
+# Segundos de inactividad tras los que descartamos el contexto (igual que OLLAMA_KEEP_ALIVE)
+CONTEXT_TTL_SECONDS = 30 * 60
+
+# Candidatos que deben caber en el prompt de seguimiento: los que la vista muestra como tarjetas
+MIN_FOLLOWUP_CANDIDATES = 3
+
+_lock = threading.Lock()
+_contexts = OrderedDict()  # key -> (expires_at, context)
+
+
+def get_context(key) -> list | None:
+    """Devuelve el contexto guardado para una conversación, o None si no hay o ha caducado."""
+    if key is None:
+        return None
+
+    with _lock:
+        entry = _contexts.get(key)
+        if entry is None:
+            return None
+
+        expires_at, context = entry
+        if expires_at < time.monotonic():
+            del _contexts[key]
+            return None
+
+        # Marcamos la entrada como usada recientemente
+        _contexts.move_to_end(key)
+        return context
+
+
+def save_context(key, context: list | None) -> None:
+    """Guarda el contexto devuelto por Ollama para el siguiente turno."""
+    if key is None or not context:
+        return
+
+    with _lock:
+        _contexts[key] = (time.monotonic() + CONTEXT_TTL_SECONDS, context)
+        _contexts.move_to_end(key)
+
+        # Expulsamos las conversaciones menos usadas si superamos el máximo
+        while len(_contexts) > MAX_SESSIONS:
+            _contexts.popitem(last=False)
+
+
+def clear_context(key) -> None:
+    """Olvida el contexto de una conversación (por ejemplo, al borrar su historial)."""
+    with _lock:
+        _contexts.pop(key, None)
+
+
+def prompt_for_turn(key, user_message: str, candidates: list):
+    """
+    Decide qué prompt enviar en este turno.
+
+    Si hay contexto previo, enviamos solo el prompt de seguimiento junto con
+    el contexto, con los candidatos que quepan en lo que queda de la ventana.
+    Si ahí no caben ni los primeros MIN_FOLLOWUP_CANDIDATES (el modelo
+    respondería sin los eventos que se muestran), empezamos de cero con el
+    prompt completo.
+
+    Returns:
+        tuple: (prompt, context) donde context es None si empezamos de cero
+    """
+    context = get_context(key)
+
+    if context:
+        required = build_followup_prompt(user_message, candidates[:MIN_FOLLOWUP_CANDIDATES])
+        if len(context) + estimate_tokens(required) <= PROMPT_TOKEN_BUDGET:
+            prompt = build_followup_prompt(user_message, candidates, max_tokens=PROMPT_TOKEN_BUDGET - len(context))
+            return prompt, context
+
+        # La conversación ya no cabe en num_ctx: empezamos una nueva
+        clear_context(key)
+
+    return build_prompt(user_message, candidates), None
@@ -0,0 +1,127 @@
+"""
+Coalescencia de peticiones idénticas (patrón "single-flight").
+
+Cuando muchos usuarios hacen la misma pregunta a la vez, solo la primera
+petición (el "líder") ejecuta el trabajo caro (embedding, retrieval y LLM).
+Las que llegan mientras está en marcha se suscriben al mismo vuelo y reciben
+los mismos tokens, incluidos los que ya se habían generado antes de llegar.
+
+El trabajo se ejecuta en un hilo propio, así que si el cliente líder se
+desconecta, los demás suscriptores siguen recibiendo la respuesta.
+"""
+import logging
+import threading
+
+from django.db import close_old_connections
+
+logger = logging.getLogger(__name__)
+
+
+class Flight:
+    """
+    Un trabajo en curso: guarda los elementos producidos (tokens) para
+    repartirlos a todos los suscriptores, y datos extra en `data`.
+    """
+
+    def __init__(self):
+        self.data = {}
+        self.subscribers = 0
+        self._items = []
+        self._done = False
+        self._error = None
+        self._condition = threading.Condition()
+
+    def push(self, item) -> None:
+        """Añade un elemento y despierta a los suscriptores que estén esperando."""
+        with self._condition:
+            self._items.append(item)
+            self._condition.notify_all()
+
+    def finish(self, error: Exception | None = None) -> None:
+        """Marca el trabajo como terminado (con error o sin él)."""
+        with self._condition:
+            self._done = True
+            self._error = error
+            self._condition.notify_all()
+
+    def subscribe(self):
+        """
+        Generador que devuelve todos los elementos del trabajo, desde el primero,
+        esperando a los nuevos hasta que el trabajo termina.
+        Si el trabajo ha fallado, relanza la excepción al final.
+        """
+        index = 0
+        while True:
+            with self._condition:
+                while index >= len(self._items) and not self._done:
+                    self._condition.wait()
+
+                pending = self._items[index:]
+                index = len(self._items)
+                done = self._done
+                error = self._error
+
+            yield from pending
+
+            # Si ya estaba terminado, `pending` contenía todo lo que quedaba
+            if done:
+                if error is not None:
+                    raise error
+                return
+
+
+class SingleFlight:
+    """Registro de trabajos en curso indexados por clave."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._flights = {}
+
+    def run(self, key, producer):
+        """
+        Devuelve el Flight en curso para `key`, o arranca uno nuevo ejecutando
+        `producer(flight)` en un hilo. Con key=None nunca se comparte.
+
+        Returns:
+            tuple: (flight, leader) donde leader=True si esta petición ha arrancado el trabajo
+        """
+        with self._lock:
+            if key is not None and key in self._flights:
+                flight = self._flights[key]
+                flight.subscribers += 1
+                return flight, False
+
+            flight = Flight()
+            flight.subscribers = 1
+            if key is not None:
+                self._flights[key] = flight
+
+        thread = threading.Thread(
+            target=self._execute,
+            args=(key, flight, producer),
+            name="assistant-singleflight",
+            daemon=True,
+        )
+        thread.start()
+        return flight, True
+
+    def _execute(self, key, flight, producer) -> None:
+        """Ejecuta el trabajo y lo quita del registro al acabar."""
+        error = None
+        try:
+            producer(flight)
+        except Exception as exc:
+            logger.exception("Error en una petició de l'assistent")
+            error = exc
+        finally:
+            # A partir de aquí, una petición nueva con la misma clave arranca otro trabajo
+            with self._lock:
+                if key is not None and self._flights.get(key) is flight:
+                    del self._flights[key]
+            flight.finish(error)
+            close_old_connections()
+
+
+def normalize_query(text: str) -> str:
+    """Normaliza una consulta para detectar peticiones idénticas (minúsculas, espacios)."""
+    return " ".join((text or "").lower().split())
@@ -11,11 +11,11 @@ function scrollToBottom() {
   chatBox.scrollTop = chatBox.scrollHeight;
 }
 
-// Función para añadir una burbuja de mensaje al chat
+// Función para crear una burbuja de mensaje (sin añadirla al chat)
 // role: "user" o "assistant"
 // text: contenido del mensaje
-// Devuelve la burbuja para poder modificarla después (útil en streaming)
-function addBubble(role, text) {
+// Devuelve [wrapper, bubble]
+function createBubble(role, text) {
   const wrapper = document.createElement("div");
   const bubble = document.createElement("div");
 
@@ -32,12 +32,65 @@ function addBubble(role, text) {
   bubble.style.maxWidth = "75%";
   bubble.innerText = text;
   wrapper.appendChild(bubble);
+  return [wrapper, bubble];
+}
+
+// Función para añadir una burbuja de mensaje al final del chat
+// Devuelve la burbuja para poder modificarla después (útil en streaming)
+function addBubble(role, text) {
+  const [wrapper, bubble] = createBubble(role, text);
   chatBox.appendChild(wrapper);
 
   scrollToBottom();
   return bubble;
 }
 
+// Historial paginado: al llegar arriba del todo pedimos los mensajes anteriores
+let historyCursor = chatBox.dataset.historyCursor || "";
+let loadingHistory = false;
+
+// Si el panel aún no tiene scroll, el usuario no puede llegar arriba para pedir más
+function historyFillsPanel() {
+  return chatBox.scrollHeight > chatBox.clientHeight;
+}
+
+async function loadOlderHistory() {
+  if (!historyCursor || loadingHistory) return;
+  loadingHistory = true;
+  let loaded = false;
+
+  try {
+    const url = `${chatBox.dataset.historyUrl}?before=${encodeURIComponent(historyCursor)}`;
+    const response = await fetch(url);
+    if (!response.ok) throw new Error("Error carregant l'historial");
+    const data = await response.json();
+
+    // Insertamos los mensajes arriba manteniendo la posición del scroll
+    const previousHeight = chatBox.scrollHeight;
+    const fragment = document.createDocumentFragment();
+    data.messages.forEach(message => {
+      const [wrapper] = createBubble(message.role, message.text);
+      fragment.appendChild(wrapper);
+    });
+    chatBox.insertBefore(fragment, chatBox.firstChild);
+    chatBox.scrollTop += chatBox.scrollHeight - previousHeight;
+
+    historyCursor = data.next_cursor || "";
+    loaded = true;
+  } catch (error) {
+    console.error("Error:", error);
+  } finally {
+    loadingHistory = false;
+  }
+
+  // Seguimos pidiendo páginas hasta llenar el panel (o acabar el historial)
+  if (loaded && historyCursor && !historyFillsPanel()) loadOlderHistory();
+}
+
+chatBox.addEventListener("scroll", () => {
+  if (chatBox.scrollTop < 50) loadOlderHistory();
+});
+
 // Función para renderizar las cards de eventos recomendados
 function renderEventCards(events) {
   eventsBox.innerHTML = "";
@@ -153,6 +206,10 @@ async function sendMessage() {
           scrollToBottom();
           break;
 
+        } else if (data.startsWith("META:")) {
+          // Metadatos de la respuesta (tiempos del retrieval), solo para depurar
+          console.debug("Meta:", JSON.parse(data.slice(5)));
+
         } else if (data.startsWith("EVENTS:")) {
           // Evento especial con los datos de los eventos en JSON
           const eventsData = JSON.parse(data.slice(7));
@@ -186,4 +243,5 @@ userMessageInput.addEventListener("keydown", (event) => {
 });
 
 // Al cargar la página, hacer scroll al último mensaje del historial
-scrollToBottom();
\ No newline at end of file
+scrollToBottom();
+if (!historyFillsPanel()) loadOlderHistory();
\ No newline at end of file
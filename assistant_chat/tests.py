@@ -1,3 +1,153 @@
-from django.test import TestCase
+import io
+from datetime import timedelta
+from unittest import mock
 
-# Create your tests here.
+from django.contrib.auth import get_user_model
+from django.core.management import call_command
+from django.test import SimpleTestCase, TestCase
+from django.utils import timezone
+
+from .models import ChatMessage, ChatSession
+
+from .management.commands.bench_assistant import percentile
+from .services import llm_ollama, session_context
+from .services.prompts import PROMPT_TOKEN_BUDGET, encode_candidate
+from .services.circuit_breaker import CLOSED, HALF_OPEN, OPEN, CircuitBreaker, CircuitOpenError
+
+
+class CircuitBreakerTest(SimpleTestCase):
+    """Transiciones del circuit breaker con un reloj inyectado."""
+
+    def setUp(self):
+        self.now = 1000.0
+        self.breaker = CircuitBreaker(window=4, min_calls=2, failure_rate=0.5,
+                                      slow_call_seconds=5.0, open_seconds=30.0,
+                                      clock=lambda: self.now)
+
+    def open_circuit(self):
+        self.breaker.record_failure()
+        self.breaker.record_failure()
+        self.assertEqual(self.breaker.state, OPEN)
+
+    def test_opens_after_too_many_failures(self):
+        self.breaker.record_success(0.1)
+        self.breaker.record_failure()
+        self.assertEqual(self.breaker.state, OPEN)
+        with self.assertRaises(CircuitOpenError):
+            self.breaker.before_call()
+
+    def test_slow_call_counts_as_failure(self):
+        self.breaker.record_success(6.0)
+        self.breaker.record_success(6.0)
+        self.assertEqual(self.breaker.state, OPEN)
+
+    def test_half_open_lets_one_probe_through(self):
+        self.open_circuit()
+
+        self.now += 29.9
+        self.assertEqual(self.breaker.state, OPEN)
+
+        self.now += 0.1
+        self.assertEqual(self.breaker.state, HALF_OPEN)
+        self.breaker.before_call()
+        # Mientras la prueba está en curso las demás llamadas fallan al instante
+        with self.assertRaises(CircuitOpenError):
+            self.breaker.before_call()
+
+    def test_successful_probe_closes(self):
+        self.open_circuit()
+        self.now += 30
+        self.breaker.before_call()
+        self.breaker.record_success(0.1)
+
+        self.assertEqual(self.breaker.state, CLOSED)
+        # Empieza de cero: un solo fallo no llega a min_calls
+        self.breaker.record_failure()
+        self.assertEqual(self.breaker.state, CLOSED)
+
+    def test_ollama_read_timeout_matches_slow_calls(self):
+        # Un Ollama colgado no retiene el worker más de lo que el breaker considera lento
+        self.assertEqual(llm_ollama.OLLAMA_TIMEOUT[1], llm_ollama.breaker.slow_call_seconds)
+
+    def test_failed_probe_reopens(self):
+        self.open_circuit()
+        self.now += 30
+        self.breaker.before_call()
+        self.breaker.record_failure()
+
+        self.assertEqual(self.breaker.state, OPEN)
+        self.now += 29
+        self.assertEqual(self.breaker.state, OPEN)
+        self.now += 1
+        self.assertEqual(self.breaker.state, HALF_OPEN)
+
+
+class PromptForTurnTest(SimpleTestCase):
+    """El prompt de seguimiento solo se usa si caben los eventos que se mostrarán."""
+
+    KEY = "test-prompt-for-turn"
+
+    def setUp(self):
+        self.candidates = [
+            {"id": pk, "title": f"Concert de prova número {pk}", "scheduled_date": "2026-10-20T20:00:00",
+             "category": "music", "tags": "rock,directe,barcelona"}
+            for pk in range(1, 9)
+        ]
+        self.addCleanup(session_context.clear_context, self.KEY)
+
+    def test_followup_when_context_leaves_room(self):
+        session_context.save_context(self.KEY, [0] * 100)
+        prompt, context = session_context.prompt_for_turn(self.KEY, "I de rock?", self.candidates)
+
+        self.assertEqual(len(context), 100)
+        for candidate in self.candidates[:session_context.MIN_FOLLOWUP_CANDIDATES]:
+            self.assertIn(encode_candidate(candidate), prompt)
+
+    def test_full_prompt_when_candidates_do_not_fit(self):
+        session_context.save_context(self.KEY, [0] * (PROMPT_TOKEN_BUDGET - 60))
+        prompt, context = session_context.prompt_for_turn(self.KEY, "I de rock?", self.candidates)
+
+        self.assertIsNone(context)
+        self.assertNotIn("(cap esdeveniment)", prompt)
+        self.assertIn(encode_candidate(self.candidates[0]), prompt)
+        self.assertIsNone(session_context.get_context(self.KEY))
+
+
+class PercentileTest(SimpleTestCase):
+    """Percentil por rango más cercano de bench_assistant."""
+
+    def test_nearest_rank(self):
+        self.assertEqual(percentile(list(range(1, 11)), 50), 5)
+        self.assertEqual(percentile(list(range(1, 101)), 99), 99)
+        self.assertEqual(percentile(list(range(1, 101)), 100), 100)
+        self.assertEqual(percentile([3.0], 95), 3.0)
+        self.assertEqual(percentile([], 50), 0.0)
+
+
+class CleanupOldChatsTest(TestCase):
+    """cleanup_old_chats no borra una sesión que se usa mientras se ejecuta."""
+
+    def setUp(self):
+        user = get_user_model().objects.create_user(username="usuari", password="contrasenya123")
+        other = get_user_model().objects.create_user(username="altre", password="contrasenya123")
+        self.old = ChatSession.objects.create(user=user)
+        self.touched = ChatSession.objects.create(user=other)
+        for session in (self.old, self.touched):
+            ChatMessage.objects.create(session=session, role=ChatMessage.ROLE_USER, text="Hola")
+        ChatSession.objects.update(last_activity=timezone.now() - timedelta(days=30))
+
+    def test_session_touched_during_cleanup_survives(self):
+        original_filter = ChatMessage.objects.filter
+
+        def touch_then_filter(*args, **kwargs):
+            # El history_writer escribe en la sesión después de seleccionar el lote
+            ChatSession.objects.filter(pk=self.touched.pk).update(last_activity=timezone.now())
+            ChatMessage.objects.create(session=self.touched, role=ChatMessage.ROLE_USER, text="Torno a ser aquí")
+            return original_filter(*args, **kwargs)
+
+        with mock.patch.object(ChatMessage.objects, "filter", side_effect=touch_then_filter):
+            call_command("cleanup_old_chats", stdout=io.StringIO())
+
+        self.assertFalse(ChatSession.objects.filter(pk=self.old.pk).exists())
+        self.assertTrue(ChatSession.objects.filter(pk=self.touched.pk).exists())
+        self.assertEqual(ChatMessage.objects.filter(session=self.touched).count(), 2)
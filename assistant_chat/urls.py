@@ -1,5 +1,5 @@
 from django.urls import path
-from .views import chat_page, chat_api, chat_stream_api
+from .views import chat_page, chat_api, chat_stream_api, chat_history_api
 
 # Nombre del espacio de la app para usar en templates con {% url %}
 app_name = "assistant_chat"
@@ -13,4 +13,7 @@ urlpatterns = [
 
     # Endpoint con stream (POST) -> devuelve tokens uno a uno via SSE
     path("assistant/api/stream/", chat_stream_api, name="api_stream"),
+
+    # Historial paginado por cursor (GET) -> mensajes anteriores al hacer scroll
+    path("assistant/api/history/", chat_history_api, name="api_history"),
 ]
\ No newline at end of file
@@ -1,32 +1,145 @@
 import json
+import requests
 from django.http import JsonResponse, StreamingHttpResponse
 from django.shortcuts import render
 from django.views.decorators.csrf import csrf_exempt
-from django.utils import timezone
 
-from .models import ChatSession, ChatMessage
+from .models import ChatSession
+from .services.circuit_breaker import CircuitOpenError
+from .services.fallback import build_fallback_answer
+from .services.history import get_history_page
+from .services.history_writer import record_exchange
 from .services.retriever import retrieve_events
-from .services.prompts import build_prompt
-from .services.llm_ollama import generate, generate_stream
+from .services.llm_ollama import generate_stream
+from .services.session_context import get_context, prompt_for_turn, save_context
+from .services.singleflight import SingleFlight, normalize_query
+
+# Peticiones al asistente en curso, compartidas entre chat_api y chat_stream_api
+_flights = SingleFlight()
 
 
 def chat_page(request):
     """
     Vista que renderiza la página HTML del chat.
-    Si el usuario está autenticado, carga su historial de mensajes.
+    Si el usuario está autenticado, carga los mensajes más recientes de su historial;
+    los anteriores se piden al hacer scroll (ver chat_history_api).
     """
 
     history = []
+    history_cursor = None
 
     if request.user.is_authenticated:
         # Buscamos la sesión más reciente del usuario
         session = ChatSession.objects.filter(user=request.user).first()
 
         if session:
-            # Obtenemos todos los mensajes ordenados por timestamp
-            history = list(session.messages.values("role", "text", "timestamp"))
+            # Solo la última página de mensajes, en orden cronológico
+            history, history_cursor = get_history_page(session)
+
+    return render(request, "assistant_chat/chat.html", {
+        "history": history,
+        "history_cursor": history_cursor,
+    })
+
+
+def chat_history_api(request):
+    """
+    Endpoint de paginación del historial (GET).
+    Devuelve los mensajes anteriores al cursor, en orden cronológico.
+
+    Query params: ?before=<cursor>
+    Response JSON: {"messages": [...], "next_cursor": "..." | null}
+    """
+
+    if not request.user.is_authenticated:
+        return JsonResponse({"error": "Login required"}, status=401)
+
+    session = ChatSession.objects.filter(user=request.user).first()
+    if not session:
+        return JsonResponse({"messages": [], "next_cursor": None})
+
+    messages, next_cursor = get_history_page(session, before=request.GET.get("before"))
+
+    return JsonResponse({
+        "messages": [
+            {
+                "role": message["role"],
+                "text": message["text"],
+                "timestamp": message["timestamp"].isoformat(),
+            }
+            for message in messages
+        ],
+        "next_cursor": next_cursor,
+    })
+
+
+def _build_candidates(ranked_events) -> list:
+    """Prepara los eventos recuperados como diccionarios para el contexto del LLM y las cards."""
+    candidates = []
+    for event, score in ranked_events:
+        candidates.append({
+            "id": int(event.pk),
+            "title": event.title,
+            "scheduled_date": event.scheduled_date.isoformat() if event.scheduled_date else None,
+            "category": event.category,
+            "tags": event.tags or "",
+            "url": event.get_absolute_url(),
+            "score": round(float(score), 3),
+        })
+    return candidates
 
-    return render(request, "assistant_chat/chat.html", {"history": history})
+
+def _start_answer(user_message: str, only_future: bool, context_key):
+    """
+    Arranca la generación de una respuesta, o se suscribe a una idéntica en curso.
+
+    Las peticiones con el mismo mensaje (normalizado) y el mismo only_future
+    comparten retrieval y generación. Si el usuario tiene una conversación en curso
+    (contexto de Ollama), su respuesta depende de ese contexto y no se comparte.
+
+    Si Ollama no está disponible (circuit breaker abierto), la respuesta es
+    una plantilla construida con los eventos del retrieval.
+
+    Returns:
+        tuple: (flight, leader). Al terminar, flight.data contiene
+               "candidates", "retrieval", "context" y "fallback" si no se ha usado el LLM
+    """
+
+    own_context = get_context(context_key)
+    key = None if own_context else (normalize_query(user_message), only_future)
+
+    def producer(flight):
+        # Paso 1: Recuperar eventos relevantes usando búsqueda semántica
+        retrieval_stats = {}
+        ranked_events = retrieve_events(user_message, only_future=only_future, k=8, stats=retrieval_stats)
+
+        # Paso 2: Preparar los eventos como diccionarios para el contexto del LLM
+        candidates = _build_candidates(ranked_events)
+        flight.data["candidates"] = candidates
+        flight.data["retrieval"] = retrieval_stats
+
+        # Paso 3: Construir el prompt con los eventos como contexto.
+        # Si el usuario ya tiene una conversación en curso, reutilizamos el
+        # contexto de Ollama y solo enviamos el turno nuevo
+        prompt, context = prompt_for_turn(context_key if key is None else None, user_message, candidates)
+
+        # Paso 4: Llamar al LLM y repartir los tokens a todos los suscriptores
+        llm_result = {}
+        generated = False
+        try:
+            for token in generate_stream(prompt, context=context, result=llm_result):
+                generated = True
+                flight.push(token)
+        except (CircuitOpenError, requests.RequestException):
+            # Si Ollama está caído o lento y aún no hemos enviado nada,
+            # respondemos al momento con los eventos del retrieval
+            if generated:
+                raise
+            flight.push(json.dumps(build_fallback_answer(candidates), ensure_ascii=False))
+            flight.data["fallback"] = True
+        flight.data["context"] = llm_result.get("context")
+
+    return _flights.run(key, producer)
 
 
 @csrf_exempt
@@ -36,7 +149,7 @@ def chat_api(request):
     Versión sin stream: devuelve la respuesta completa de una vez.
 
     Request body: {"message": "vull un concert de jazz", "only_future": true}
-    Response JSON: {"answer": "...", "follow_up": "...", "events": [...]}
+    Response JSON: {"answer": "...", "follow_up": "...", "events": [...], "meta": {...}}
     """
 
     if request.method != "POST":
@@ -53,27 +166,13 @@ def chat_api(request):
     if not user_message:
         return JsonResponse({"error": "Empty message"}, status=400)
 
-    # Paso 1: Recuperar eventos relevantes usando búsqueda semántica
-    ranked_events = retrieve_events(user_message, only_future=only_future, k=8)
-
-    # Paso 2: Preparar los eventos como diccionarios para el contexto del LLM
-    candidates = []
-    for event, score in ranked_events:
-        candidates.append({
-            "id": int(event.pk),
-            "title": event.title,
-            "scheduled_date": event.scheduled_date.isoformat() if event.scheduled_date else None,
-            "category": event.category,
-            "tags": event.tags or "",
-            "url": event.get_absolute_url(),
-            "score": round(float(score), 3),
-        })
-
-    # Paso 3: Construir el prompt con los eventos como contexto
-    prompt = build_prompt(user_message, candidates)
+    # Pasos 1-4: retrieval, prompt y LLM (compartidos con peticiones idénticas en curso)
+    context_key = request.user.pk if request.user.is_authenticated else None
+    flight, leader = _start_answer(user_message, only_future, context_key)
 
-    # Paso 4: Llamar al LLM y obtener su respuesta en texto
-    llm_text = generate(prompt)
+    llm_text = "".join(flight.subscribe()).strip()
+    candidates = flight.data["candidates"]
+    save_context(context_key, flight.data.get("context"))
 
     # Paso 5: Intentar parsear la respuesta del LLM como JSON
     try:
@@ -98,29 +197,20 @@ def chat_api(request):
     if not event_cards:
         event_cards = candidates[:3]
 
-    # Paso 8: Guardar historial en BD solo si el usuario está autenticado
+    # Paso 8: Guardar historial solo si el usuario está autenticado.
+    # No escribimos aquí: lo encolamos y se guarda por lotes en segundo plano
     if request.user.is_authenticated:
-        session, created = ChatSession.objects.get_or_create(user=request.user)
-
-        ChatMessage.objects.create(
-            session=session,
-            role=ChatMessage.ROLE_USER,
-            text=user_message,
-        )
-
-        ChatMessage.objects.create(
-            session=session,
-            role=ChatMessage.ROLE_ASSISTANT,
-            text=llm_json.get("answer", ""),
-        )
-
-        session.last_activity = timezone.now()
-        session.save()
+        record_exchange(request.user.pk, user_message, llm_json.get("answer", ""))
 
     return JsonResponse({
         "answer": llm_json.get("answer", ""),
         "follow_up": llm_json.get("follow_up", ""),
         "events": event_cards,
+        "meta": {
+            "retrieval": flight.data["retrieval"],
+            "coalesced": not leader,
+            "fallback": flight.data.get("fallback", False),
+        },
     })
 
 
@@ -134,6 +224,9 @@ def chat_stream_api(request):
     También hace el retrieval de eventos y los devuelve al final
     como un evento SSE especial con formato JSON.
 
+    Si llegan varias peticiones idénticas a la vez, todas reciben
+    los tokens de una única generación.
+
     Request body: {"message": "...", "only_future": true}
     Response: stream de eventos SSE
     """
@@ -152,22 +245,12 @@ def chat_stream_api(request):
     if not user_message:
         return JsonResponse({"error": "Empty message"}, status=400)
 
-    # Retrieval de eventos (igual que en chat_api)
-    ranked_events = retrieve_events(user_message, only_future=only_future, k=8)
-
-    candidates = []
-    for event, score in ranked_events:
-        candidates.append({
-            "id": int(event.pk),
-            "title": event.title,
-            "scheduled_date": event.scheduled_date.isoformat() if event.scheduled_date else None,
-            "category": event.category,
-            "tags": event.tags or "",
-            "url": event.get_absolute_url(),
-            "score": round(float(score), 3),
-        })
+    # Guardamos el user_id antes de entrar al generador
+    # porque dentro del generador no podemos acceder a request.user de forma segura
+    user_id = request.user.pk if request.user.is_authenticated else None
 
-    prompt = build_prompt(user_message, candidates)
+    # Arrancamos ya el retrieval y la generación (o nos unimos a una idéntica en curso)
+    flight, leader = _start_answer(user_message, only_future, user_id)
 
     def event_stream():
         """
@@ -179,48 +262,37 @@ def chat_stream_api(request):
         full_response = ""
 
         # Enviamos cada token del modelo como un evento SSE
-        for token in generate_stream(prompt):
+        for token in flight.subscribe():
             full_response += token
             # Escapamos saltos de línea para no romper el formato SSE
             safe_token = token.replace("\n", "\\n")
             yield f"data: {safe_token}\n\n"
 
-        # Guardamos el historial en BD si el usuario está autenticado
+        # Guardamos el contexto de Ollama para el siguiente turno de la conversación
+        save_context(user_id, flight.data.get("context"))
+
+        # Guardamos el historial si el usuario está autenticado
         # Nota: en SSE no tenemos acceso directo a request.user dentro del generador
-        # por eso guardamos el user_id antes de entrar al generador
-        if user_id:
-            try:
-                from django.contrib.auth import get_user_model
-                User = get_user_model()
-                user = User.objects.get(pk=user_id)
-                session, created = ChatSession.objects.get_or_create(user=user)
-                ChatMessage.objects.create(
-                    session=session,
-                    role=ChatMessage.ROLE_USER,
-                    text=user_message,
-                )
-                ChatMessage.objects.create(
-                    session=session,
-                    role=ChatMessage.ROLE_ASSISTANT,
-                    text=full_response,
-                )
-                session.last_activity = timezone.now()
-                session.save()
-            except Exception:
-                pass
+        # por eso guardamos el user_id antes de entrar al generador.
+        # El intercambio se encola y se guarda por lotes en segundo plano
+        record_exchange(user_id, user_message, full_response)
+
+        # Evento especial con los tiempos del retrieval (prefijo "META:")
+        meta_data = json.dumps({
+            "retrieval": flight.data["retrieval"],
+            "coalesced": not leader,
+            "fallback": flight.data.get("fallback", False),
+        })
+        yield f"data: META:{meta_data}\n\n"
 
         # Evento especial con los eventos candidatos para las cards
         # El frontend lo detecta por el prefijo "EVENTS:"
-        events_data = json.dumps(candidates, ensure_ascii=False)
+        events_data = json.dumps(flight.data["candidates"], ensure_ascii=False)
         yield f"data: EVENTS:{events_data}\n\n"
 
         # Evento final para indicar al frontend que el stream ha acabado
         yield "data: [DONE]\n\n"
 
-    # Guardamos el user_id antes de entrar al generador
-    # porque dentro del generador no podemos acceder a request.user de forma segura
-    user_id = request.user.pk if request.user.is_authenticated else None
-
     # StreamingHttpResponse envía la respuesta chunk a chunk
     response = StreamingHttpResponse(
         event_stream(),
@@ -231,4 +303,4 @@ def chat_stream_api(request):
     response["Cache-Control"] = "no-cache"      # No cachear la respuesta
     response["X-Accel-Buffering"] = "no"        # Desactivar buffering en nginx
 
-    return response
\ No newline at end of file
+    return response
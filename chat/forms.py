@@ -1,5 +1,6 @@
 from django import forms
 from .models import ChatMessage
+from .services.moderation import find_forbidden
 
 class ChatMessageForm(forms.ModelForm):
     class Meta:
@@ -23,20 +24,11 @@ class ChatMessageForm(forms.ModelForm):
                 'El missatge no pot estar buit.'
             )
 
-        forbidden_words = [
-            'idiota',
-            'tonto',
-            'mierda',
-            'puta',
-        ]
-
-        lower_message = message.lower()
-
-        for word in forbidden_words:
-            if word in lower_message:
-                raise forms.ValidationError(
-                    'El missatge conté paraules ofensives.'
-                )
+        # Lèxic compilat una sola vegada (chat/services/moderation.py)
+        if find_forbidden(message):
+            raise forms.ValidationError(
+                'El missatge conté paraules ofensives.'
+            )
 
         if len(message) > 500:
             raise forms.ValidationError(
@@ -0,0 +1,105 @@
+"""
+Comanda: archive_chats
+Arxiva els xats dels esdeveniments finalitzats o cancel·lats fa més de N dies:
+escriu els missatges visibles a la col·lecció freda de l'arxiu (blocs NDJSON
+comprimits, vegeu chat/services/archive.py) i esborra de la BD tots els
+missatges de l'esdeveniment, també els eliminats (is_deleted=True).
+
+    python manage.py archive_chats --days 30
+    python manage.py archive_chats --days 30 --dry-run
+
+Es pot programar amb cron igual que cleanup_old_chats. La data de referència
+és l'última modificació de l'esdeveniment (updated_at), que s'actualitza
+quan passa a finalitzat.
+"""
+import time
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from chat.models import ChatMessage
+from chat.services import archive
+from events.models import Event
+
+
+class Command(BaseCommand):
+    help = "Arxiva els xats dels esdeveniments acabats fa més de N dies i n'esborra els missatges de la BD"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--days',
+            type=int,
+            default=30,
+            help="Dies des que l'esdeveniment va acabar"
+        )
+        parser.add_argument(
+            '--sleep',
+            type=float,
+            default=0.0,
+            help="Segons d'espera entre esdeveniments per no saturar la BD"
+        )
+        parser.add_argument(
+            '--dry-run',
+            action='store_true',
+            help="Només mostra què s'arxivaria, sense escriure ni esborrar res"
+        )
+
+    def handle(self, *args, **options):
+        cutoff = timezone.now() - timedelta(days=options['days'])
+        pause = max(0.0, options['sleep'])
+        dry_run = options['dry_run']
+
+        if dry_run:
+            self.stdout.write(self.style.WARNING("ℹ️  Mode --dry-run: no s'arxivarà res"))
+
+        event_ids = Event.objects.filter(
+            status__in=archive.ARCHIVABLE_STATUSES,
+            updated_at__lt=cutoff,
+        ).order_by('id').values_list('id', flat=True)
+
+        total_events = 0
+        total_archived = 0
+        total_deleted = 0
+        inicio = time.perf_counter()
+
+        for event_id in event_ids.iterator():
+            messages = ChatMessage.objects.filter(event_id=event_id)
+            if not messages.exists():
+                continue
+
+            if archive.is_archived(event_id):
+                # No sobreescrivim un arxiu existent amb un xat parcial
+                self.stdout.write(self.style.WARNING(
+                    f'   ⚠️  Esdeveniment {event_id}: ja està arxivat però té missatges a la BD'
+                ))
+                continue
+
+            if dry_run:
+                visible = messages.filter(is_deleted=False).count()
+                archived, deleted = visible, messages.count()
+            else:
+                try:
+                    archived, deleted = archive.archive_event(event_id)
+                except Exception as error:
+                    self.stdout.write(self.style.ERROR(f'   ✗ Esdeveniment {event_id}: {error}'))
+                    continue
+
+            total_events += 1
+            total_archived += archived
+            total_deleted += deleted
+            self.stdout.write(
+                f'   Esdeveniment {event_id}: {archived} missatges arxivats, '
+                f'{deleted - archived} eliminats esborrats'
+            )
+
+            if pause:
+                time.sleep(pause)
+
+        action = "S'arxivarien" if dry_run else 'Arxivats'
+        self.stdout.write(
+            self.style.SUCCESS(
+                f'✅ {action} {total_events} xats: {total_archived} missatges '
+                f'({total_deleted} esborrats de la BD) en {time.perf_counter() - inicio:.2f} s.'
+            )
+        )
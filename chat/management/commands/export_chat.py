@@ -0,0 +1,57 @@
+"""
+Comanda: export_chat
+Exporta el xat complet d'un esdeveniment en NDJSON o CSV, per lots i sense
+carregar-lo tot en memòria:
+
+    python manage.py export_chat 42 --format csv --gzip --output xat-42.csv.gz
+    python manage.py export_chat 42 > xat-42.ndjson
+"""
+import sys
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from chat.services.export import FORMATS, export_chunks
+from events.models import Event
+
+
+class Command(BaseCommand):
+    help = "Exporta el xat complet d'un esdeveniment (NDJSON o CSV, opcionalment gzip)"
+
+    def add_arguments(self, parser):
+        parser.add_argument('event_id', type=int, help="Id de l'esdeveniment")
+        parser.add_argument('--format', choices=sorted(FORMATS), default='ndjson', help='Format de sortida')
+        parser.add_argument('--gzip', action='store_true', help='Comprimeix la sortida amb gzip')
+        parser.add_argument('--output', default='-', help="Fitxer de sortida ('-' per a la sortida estàndard)")
+        parser.add_argument('--include-deleted', action='store_true', help='Inclou els missatges eliminats')
+
+    def handle(self, *args, **options):
+        if not Event.objects.filter(pk=options['event_id']).exists():
+            raise CommandError(f"No existeix l'esdeveniment {options['event_id']}")
+
+        chunks = export_chunks(
+            options['event_id'],
+            export_format=options['format'],
+            compress=options['gzip'],
+            include_deleted=options['include_deleted'],
+        )
+
+        inicio = time.perf_counter()
+        written = 0
+
+        if options['output'] == '-':
+            output = sys.stdout.buffer
+            for chunk in chunks:
+                output.write(chunk)
+                written += len(chunk)
+            output.flush()
+        else:
+            with open(options['output'], 'wb') as output:
+                for chunk in chunks:
+                    output.write(chunk)
+                    written += len(chunk)
+
+        # Els missatges de progrés van a stderr per no barrejar-se amb l'exportació
+        self.stderr.write(
+            self.style.SUCCESS(f"✅ Exportats {written / 1024:.1f} KB en {time.perf_counter() - inicio:.2f} s.")
+        )
@@ -0,0 +1,129 @@
+"""
+Comanda: reconcile_chat_counters
+Recalcula des de zero els comptadors del xat de cada esdeveniment
+(chat/services/counters.py) a partir dels missatges de la BD i corregeix
+els que s'hagin desquadrat.
+
+    python manage.py reconcile_chat_counters
+    python manage.py reconcile_chat_counters --event 42
+
+Els comptadors es calculen amb dues agregacions de MongoDB (una per als
+totals i una per als usuaris diferents), sense portar els missatges a
+Python. Els esdeveniments arxivats (archive_chats) ja no tenen missatges a
+la BD i conserven els comptadors que tenien.
+"""
+from django.core.management.base import BaseCommand, CommandError
+
+from chat.models import ChatMessage
+from chat.services import counters
+from chat.services.mongo import get_collection
+
+# Escriptures per bulk_write
+WRITE_BATCH_SIZE = 1000
+
+
+def column(field_name):
+    """Nom del camp al document de Mongo (les FK es guarden com <camp>_id)."""
+    return ChatMessage._meta.get_field(field_name).column
+
+
+class Command(BaseCommand):
+    help = "Recalcula els comptadors del xat (total, visibles, destacats, usuaris) des dels missatges"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--event',
+            type=int,
+            help="Només aquest esdeveniment (id)"
+        )
+
+    def handle(self, *args, **options):
+        from pymongo import ReplaceOne, UpdateOne
+
+        if not counters.enabled():
+            raise CommandError("Els comptadors del xat només es guarden amb djongo (MongoDB).")
+
+        event_field = column('event')
+        user_field = column('user')
+        deleted_field = column('is_deleted')
+        highlighted_field = column('is_highlighted')
+
+        match = {}
+        if options['event'] is not None:
+            match[event_field] = options['event']
+
+        messages = get_collection(ChatMessage._meta.db_table)
+        counters_collection = get_collection(counters.COUNTERS_COLLECTION)
+        chatters_collection = get_collection(counters.CHATTERS_COLLECTION)
+
+        self.stdout.write('🔢 Comptant missatges...')
+        computed = {}
+        for row in messages.aggregate([
+            {'$match': match},
+            {'$group': {
+                '_id': f'${event_field}',
+                'total': {'$sum': 1},
+                'visible': {'$sum': {'$cond': [f'${deleted_field}', 0, 1]}},
+                'highlighted': {'$sum': {'$cond': [
+                    {'$and': [{'$not': [f'${deleted_field}']}, f'${highlighted_field}']}, 1, 0
+                ]}},
+            }},
+        ], allowDiskUse=True):
+            computed[row['_id']] = {
+                'total': row['total'],
+                'visible': row['visible'],
+                'highlighted': row['highlighted'],
+                'chatters': 0,
+            }
+
+        self.stdout.write('👥 Comptant usuaris diferents...')
+        writes = []
+        for row in messages.aggregate([
+            {'$match': match},
+            {'$group': {'_id': {'event': f'${event_field}', 'user': f'${user_field}'}}},
+        ], allowDiskUse=True):
+            event_id, user_id = row['_id']['event'], row['_id']['user']
+            if event_id in computed:
+                computed[event_id]['chatters'] += 1
+
+            # Els que ja hi són no es toquen: així un enviament alhora no es compta dues vegades
+            writes.append(UpdateOne(
+                {'_id': counters.chatter_id(event_id, user_id)},
+                {'$setOnInsert': {'event_id': event_id, 'user_id': user_id}},
+                upsert=True,
+            ))
+            if len(writes) >= WRITE_BATCH_SIZE:
+                chatters_collection.bulk_write(writes, ordered=False)
+                writes = []
+        if writes:
+            chatters_collection.bulk_write(writes, ordered=False)
+
+        current = {
+            document['_id']: document
+            for document in counters_collection.find({'_id': {'$in': list(computed)}})
+        }
+
+        fixed = 0
+        writes = []
+        for event_id, counts in computed.items():
+            previous = current.get(event_id, {})
+            differences = [
+                f'{field} {previous.get(field, 0)} → {counts[field]}'
+                for field in counters.FIELDS
+                if previous.get(field, 0) != counts[field]
+            ]
+            if not differences:
+                continue
+
+            fixed += 1
+            self.stdout.write(f"   Esdeveniment {event_id}: {', '.join(differences)}")
+            writes.append(ReplaceOne({'_id': event_id}, counts, upsert=True))
+            if len(writes) >= WRITE_BATCH_SIZE:
+                counters_collection.bulk_write(writes, ordered=False)
+                writes = []
+        if writes:
+            counters_collection.bulk_write(writes, ordered=False)
+
+        self.stdout.write(
+            self.style.SUCCESS(f'✅ {len(computed)} esdeveniments revisats, {fixed} comptadors corregits.')
+        )
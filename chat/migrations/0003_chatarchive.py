@@ -0,0 +1,37 @@
+# Generated by Django 4.1.13 on 2026-10-19 05:06
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('events', '0002_event_embedding_event_embedding_model_and_more'),
+        ('chat', '0002_chatmessage_updated_at'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ChatArchiveBlock',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('first_id', models.IntegerField()),
+                ('data', models.BinaryField()),
+                ('event', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='chat_archive_blocks', to='events.event')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='ChatArchive',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('messages', models.PositiveIntegerField()),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('event', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='chat_archive', to='events.event')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='chatarchiveblock',
+            index=models.Index(fields=['event', 'first_id'], name='chat_chatar_event_i_058e26_idx'),
+        ),
+    ]
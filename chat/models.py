@@ -25,6 +25,12 @@ class ChatMessage(models.Model):
     is_highlighted = models.BooleanField(
         default=False
     )
+    # Última modificació (enviament, eliminació o destacat).
+    # Permet al polling incremental saber què ha canviat des de l'última consulta
+    updated_at = models.DateTimeField(
+        auto_now=True,
+        null=True
+    )
     def __str__(self):
         """
         Representación del objeto
@@ -41,10 +47,11 @@ class ChatMessage(models.Model):
         if user.is_staff:
             return True
 
-        if user == self.user:
+        # Comparem ids per no carregar l'autor ni el creador de l'esdeveniment
+        if user.pk == self.user_id:
             return True
 
-        if user == self.event.creator:
+        if user.pk == self.event.creator_id:
             return True
 
         return False
@@ -62,6 +69,40 @@ class ChatMessage(models.Model):
         return f"fa {timesince(self.created_at)}"
 
 
+class ChatArchive(models.Model):
+    """
+    Xat arxivat d'un esdeveniment (chat/services/archive.py). Es crea quan
+    tots els blocs ja són desats: si existeix, l'arxiu és complet.
+    """
+    event = models.OneToOneField(
+        'events.Event',
+        on_delete=models.CASCADE,
+        related_name='chat_archive'
+    )
+    # Missatges visibles arxivats
+    messages = models.PositiveIntegerField()
+    created_at = models.DateTimeField(
+        auto_now_add=True
+    )
+
+
+class ChatArchiveBlock(models.Model):
+    """
+    Bloc de missatges arxivats: NDJSON comprimit amb gzip, en ordre d'id
+    """
+    event = models.ForeignKey(
+        'events.Event',
+        on_delete=models.CASCADE,
+        related_name='chat_archive_blocks'
+    )
+    # Id del primer missatge del bloc
+    first_id = models.IntegerField()
+    data = models.BinaryField()
+
+    class Meta:
+        indexes = [models.Index(fields=['event', 'first_id'])]
+
+
 class Meta:
     ordering = ['created_at']
     verbose_name = 'Missatge de Xat'
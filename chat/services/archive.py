@@ -0,0 +1,189 @@
+"""
+Arxiu dels xats d'esdeveniments acabats.
+
+Els missatges dels esdeveniments finalitzats o cancel·lats fa temps es
+mouen a una col·lecció freda (ChatArchiveBlock), en blocs de NDJSON
+comprimit (el mateix format que l'exportació), i s'esborren de la col·lecció
+de missatges, inclosos els eliminats (is_deleted=True), que no es guarden a
+l'arxiu. Així els índexs del xat només contenen els xats que encara es
+consulten.
+
+L'arxiu és a la BD i no al disc perquè l'aplicació corre en diverses
+màquines: totes veuen el mateix arxiu, i s'esborra amb l'esdeveniment.
+Les lectures d'un esdeveniment arxivat (últims missatges, historial,
+exportació) surten de l'arxiu de manera transparent.
+
+Cada bloc té ARCHIVE_BLOCK_SIZE missatges i l'id del primer, de manera que
+els últims missatges i cada pàgina de l'historial només llegeixen i
+descomprimeixen un o dos blocs, sigui quina sigui la mida del xat. Un
+ChatArchive marca l'arxiu com a complet quan ja hi són tots els blocs.
+"""
+import gzip
+import json
+
+from django.core.cache import cache
+from django.utils.dateparse import parse_datetime
+from django.utils.timesince import timesince
+
+from ..models import ChatArchive, ChatArchiveBlock, ChatMessage
+from . import export
+
+# Estats dels esdeveniments amb el xat arxivable
+ARCHIVABLE_STATUSES = ('finished', 'cancelled')
+
+# Missatges per bloc comprimit (unitat de lectura de l'historial)
+ARCHIVE_BLOCK_SIZE = 500
+
+# Segons que es recorda a la memòria cau si un esdeveniment està arxivat.
+# Un arxiu no es desfà, però un esdeveniment encara no arxivat ho pot ser en
+# qualsevol moment: amb una memòria cau per procés, durant com a molt
+# NOT_ARCHIVED_TTL segons un altre procés pot llegir el xat (ja buit) de la BD
+ARCHIVED_TTL = 24 * 60 * 60
+NOT_ARCHIVED_TTL = 10
+
+
+def archived_key(event_id):
+    return f'chat:archived:{event_id}'
+
+
+def is_archived(event_id):
+    """
+    Cert si el xat de l'esdeveniment ja és a l'arxiu
+    """
+    key = archived_key(event_id)
+    archived = cache.get(key)
+    if archived is None:
+        archived = ChatArchive.objects.filter(event_id=event_id).exists()
+        cache.set(key, archived, ARCHIVED_TTL if archived else NOT_ARCHIVED_TTL)
+    return archived
+
+
+def _decode(data):
+    """
+    Files d'un bloc de l'arxiu
+    """
+    lines = gzip.decompress(bytes(data)).decode('utf-8').splitlines()
+    return [json.loads(line) for line in lines if line.strip()]
+
+
+def _next_block(blocks, order):
+    """
+    (first_id, files) del primer bloc de `blocks` en l'ordre donat, o None.
+    Es llegeixen d'un en un: només es descomprimeix el que cal.
+    """
+    block = blocks.order_by(order).values_list('first_id', 'data').first()
+    if block is None:
+        return None
+    return block[0], _decode(block[1])
+
+
+def iter_rows(event_id):
+    """
+    Files de l'arxiu d'un esdeveniment, en ordre d'id, sense carregar-lo sencer
+    """
+    blocks = ChatArchiveBlock.objects.filter(event_id=event_id)
+    block = _next_block(blocks, 'first_id')
+    while block is not None:
+        first_id, rows = block
+        yield from rows
+        block = _next_block(blocks.filter(first_id__gt=first_id), 'first_id')
+
+
+def iter_batches(event_id, batch_size=export.EXPORT_BATCH_SIZE):
+    """
+    Files de l'arxiu agrupades en lots, com export.iter_batches
+    """
+    batch = []
+    for row in iter_rows(event_id):
+        batch.append(row)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def to_payload(row):
+    """
+    Fila de l'arxiu en el format JSON que espera chat.js
+    """
+    return {
+        'id': row['id'],
+        'user_id': row['user_id'],
+        'user': row['username'],
+        'display_name': row['display_name'],
+        'message': row['message'],
+        'created_at': f"fa {timesince(parse_datetime(row['created_at']))}",
+        'timestamp': row['created_at'],
+        'can_delete': False,
+        'is_highlighted': row['is_highlighted'],
+    }
+
+
+def _rows_before(event_id, before, limit):
+    """
+    Les `limit` últimes files amb id < before (totes si before és None), en ordre
+    """
+    blocks = ChatArchiveBlock.objects.filter(event_id=event_id)
+    if before is not None:
+        blocks = blocks.filter(first_id__lt=before)
+
+    rows = []
+    block = _next_block(blocks, '-first_id')
+    while block is not None and len(rows) < limit:
+        first_id, block_rows = block
+        if before is not None:
+            block_rows = [row for row in block_rows if row['id'] < before]
+        rows = block_rows + rows
+        block = _next_block(blocks.filter(first_id__lt=first_id), '-first_id')
+    return rows[-limit:]
+
+
+def latest_payloads(event_id, limit):
+    """
+    Últims `limit` missatges arxivats, en ordre cronològic
+    """
+    return [to_payload(row) for row in _rows_before(event_id, None, limit)]
+
+
+def payloads_before(event_id, before, limit):
+    """
+    Pàgina de missatges arxivats amb id < before: (payloads, has_more)
+    """
+    rows = _rows_before(event_id, before, limit + 1)
+
+    has_more = len(rows) > limit
+    if has_more:
+        rows = rows[1:]
+    return [to_payload(row) for row in rows], has_more
+
+
+def archive_event(event_id):
+    """
+    Escriu el xat visible de l'esdeveniment a l'arxiu i esborra tots els seus
+    missatges de la BD. Retorna (arxivats, esborrats).
+    Si l'arxiu no coincideix amb la BD no s'esborra res.
+    """
+    # Blocs d'un intent anterior que no va acabar
+    ChatArchiveBlock.objects.filter(event_id=event_id).delete()
+
+    written = 0
+    for rows in export.iter_batches(event_id, batch_size=ARCHIVE_BLOCK_SIZE):
+        data = b''.join(export.ndjson_chunks([rows]))
+        ChatArchiveBlock.objects.create(event_id=event_id, first_id=rows[0]['id'], data=gzip.compress(data))
+        written += len(rows)
+
+    visible = ChatMessage.objects.filter(event_id=event_id, is_deleted=False).count()
+    if visible != written:
+        ChatArchiveBlock.objects.filter(event_id=event_id).delete()
+        raise RuntimeError(
+            f"L'arxiu de l'esdeveniment {event_id} té {written} missatges i la BD {visible}"
+        )
+
+    # Fins ara les lectures seguien sortint de la BD: a partir d'aquí, de l'arxiu
+    ChatArchive.objects.create(event_id=event_id, messages=written)
+    cache.set(archived_key(event_id), True, ARCHIVED_TTL)
+
+    # Cap model depèn de ChatMessage: Django l'esborra amb una sola consulta
+    deleted, _ = ChatMessage.objects.filter(event_id=event_id).delete()
+    return written, deleted
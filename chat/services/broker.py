@@ -0,0 +1,135 @@
+"""
+Broker pub/sub en memòria per al xat en directe.
+
+Cada connexió SSE (chat_stream) se subscriu a un esdeveniment i rep per una
+cua pròpia tot el que es publica en aquest esdeveniment: missatges nous,
+missatges eliminats i canvis de destacat. Així el client rep els canvis
+en mil·lisegons i no cal fer polling cada 3 segons.
+
+Els avisos es publiquen a través del transport de fan-out (vegeu fanout.py),
+que els fa arribar a tots els processos; cada procés els entrega als seus
+subscriptors amb deliver().
+"""
+import queue
+import threading
+from collections import defaultdict
+
+# Tipus d'avís que es publiquen
+KIND_MESSAGE = 'message'
+KIND_DELETED = 'deleted'
+KIND_HIGHLIGHTED = 'highlighted'
+# L'esdeveniment ha deixat d'estar en directe
+KIND_CLOSED = 'closed'
+
+# Avisos pendents per subscriptor. Si un client és massa lent i s'omple,
+# el desconnectem: en reconnectar-se es posa al dia amb el polling incremental
+MAX_PENDING = 200
+
+
+class Subscription:
+    """
+    Subscripció d'un client a un esdeveniment
+    """
+
+    def __init__(self, event_id):
+        self.event_id = event_id
+        self.queue = queue.Queue(maxsize=MAX_PENDING)
+        self.closed = False
+
+    def get(self, timeout):
+        """
+        Espera el següent avís: (kind, payload).
+        Retorna (None, None) si la subscripció s'ha tancat.
+        Llança queue.Empty si no arriba res en `timeout` segons.
+        """
+        if self.closed and self.queue.empty():
+            return None, None
+        return self.queue.get(timeout=timeout)
+
+
+class ChatBroker:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._subscribers = defaultdict(set)
+        self._transport = None
+        self._listeners = []
+
+    def _get_transport(self):
+        """
+        Transport de fan-out. Es crea (i comença a escoltar) la primera vegada
+        que cal, per no obrir sockets ni change streams en comandes de gestió
+        """
+        if self._transport is None:
+            with self._lock:
+                if self._transport is None:
+                    from .fanout import build_transport
+                    self._transport = build_transport(self)
+        return self._transport
+
+    def subscribe(self, event_id):
+        """
+        Crea una subscripció per a un esdeveniment
+        """
+        # Cal escoltar els avisos dels altres processos abans de tenir subscriptors
+        self._get_transport()
+
+        subscription = Subscription(event_id)
+        with self._lock:
+            self._subscribers[event_id].add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        """
+        Elimina una subscripció (quan el client es desconnecta)
+        """
+        with self._lock:
+            subscribers = self._subscribers.get(subscription.event_id)
+            if subscribers is not None:
+                subscribers.discard(subscription)
+                if not subscribers:
+                    del self._subscribers[subscription.event_id]
+        subscription.closed = True
+
+    def add_listener(self, callback):
+        """
+        Registra una funció callback(event_id, kind, payload) que rep tots els
+        avisos entregats en aquest procés, tinguin o no subscriptors
+        """
+        with self._lock:
+            self._listeners.append(callback)
+
+    def subscriber_count(self, event_id):
+        """
+        Nombre de clients connectats a un esdeveniment en aquest procés
+        """
+        with self._lock:
+            return len(self._subscribers.get(event_id, ()))
+
+    def publish(self, event_id, kind, payload):
+        """
+        Publica un avís per a tots els subscriptors de l'esdeveniment,
+        en tots els processos
+        """
+        self._get_transport().publish(event_id, kind, payload)
+
+    def deliver(self, event_id, kind, payload):
+        """
+        Entrega un avís als subscriptors d'aquest procés
+        """
+        with self._lock:
+            listeners = list(self._listeners)
+            subscribers = list(self._subscribers.get(event_id, ()))
+
+        for callback in listeners:
+            callback(event_id, kind, payload)
+
+        for subscription in subscribers:
+            try:
+                subscription.queue.put_nowait((kind, payload))
+            except queue.Full:
+                # Client massa lent: el desconnectem perquè es torni a sincronitzar
+                self.unsubscribe(subscription)
+
+
+# Broker compartit per tot el procés
+broker = ChatBroker()
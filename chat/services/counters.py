@@ -0,0 +1,161 @@
+"""
+Comptadors del xat de cada esdeveniment, mantinguts en escriure.
+
+Per a cada esdeveniment es guarda un document amb:
+
+- total: missatges enviats (inclosos els eliminats)
+- visible: missatges no eliminats
+- highlighted: missatges visibles destacats
+- chatters: usuaris diferents que hi han escrit
+
+Les vistes d'enviar, eliminar i destacar actualitzen el document amb un sol
+$inc atòmic (upsert), de manera que llegir els comptadors és un find_one per
+_id en lloc de comptar els missatges. En mode write-behind els missatges
+enviats es compten per lots, en desar-los. Per als usuaris diferents es guarda un
+document per parella esdeveniment-usuari: només el primer missatge de cada
+usuari l'insereix i suma 1 a chatters.
+
+Com el write-behind, només funciona amb djongo. Amb altres BD els
+comptadors es calculen amb una consulta. Si es desquadren (caiguda a mig
+escriure, canvis fets a mà), `python manage.py reconcile_chat_counters`
+els recalcula des de zero.
+"""
+import functools
+import logging
+
+from django.db import connections, router
+from django.db.models import Count, Q
+
+from ..models import ChatMessage
+
+logger = logging.getLogger(__name__)
+
+COUNTERS_COLLECTION = 'chat_event_counters'
+CHATTERS_COLLECTION = 'chat_event_chatters'
+
+FIELDS = ('total', 'visible', 'highlighted', 'chatters')
+
+
+def enabled():
+    """
+    Cert si els comptadors es mantenen a MongoDB
+    """
+    return connections[router.db_for_write(ChatMessage)].vendor == 'djongo'
+
+
+def _collection(name):
+    from .mongo import get_collection
+    return get_collection(name, router.db_for_write(ChatMessage))
+
+
+def chatter_id(event_id, user_id):
+    return f'{event_id}:{user_id}'
+
+
+def _inc(event_id, **deltas):
+    _collection(COUNTERS_COLLECTION).update_one(
+        {'_id': event_id},
+        {'$inc': deltas},
+        upsert=True,
+    )
+
+
+def _safely(update):
+    """
+    Un error dels comptadors no ha de fer fallar l'acció de l'usuari:
+    es registra i es corregeix amb reconcile_chat_counters
+    """
+    @functools.wraps(update)
+    def wrapper(*args, **kwargs):
+        if not enabled():
+            return
+        try:
+            update(*args, **kwargs)
+        except Exception:
+            logger.exception('Error actualitzant els comptadors del xat')
+    return wrapper
+
+
+def _new_chatter(event_id, user_id):
+    """
+    Registra l'usuari com a participant del xat. Cert si és el seu primer missatge
+    """
+    result = _collection(CHATTERS_COLLECTION).update_one(
+        {'_id': chatter_id(event_id, user_id)},
+        {'$setOnInsert': {'event_id': event_id, 'user_id': user_id}},
+        upsert=True,
+    )
+    return result.upserted_id is not None
+
+
+@_safely
+def message_sent(event_id, user_id):
+    deltas = {'total': 1, 'visible': 1}
+    if _new_chatter(event_id, user_id):
+        deltas['chatters'] = 1
+    _inc(event_id, **deltas)
+
+
+@_safely
+def messages_sent(senders):
+    """
+    Un lot de missatges desats (write-behind): [(event_id, user_id), ...].
+    Un $inc per esdeveniment i una comprovació per usuari diferent.
+    """
+    deltas = {}
+    for event_id, user_id in senders:
+        event_deltas = deltas.setdefault(event_id, {'total': 0, 'visible': 0, 'users': set()})
+        event_deltas['total'] += 1
+        event_deltas['visible'] += 1
+        event_deltas['users'].add(user_id)
+
+    for event_id, event_deltas in deltas.items():
+        chatters = sum(_new_chatter(event_id, user_id) for user_id in event_deltas.pop('users'))
+        if chatters:
+            event_deltas['chatters'] = chatters
+        _inc(event_id, **event_deltas)
+
+
+@_safely
+def message_deleted(event_id, was_highlighted):
+    deltas = {'visible': -1}
+    if was_highlighted:
+        deltas['highlighted'] = -1
+    _inc(event_id, **deltas)
+
+
+@_safely
+def message_highlighted(event_id, is_highlighted):
+    _inc(event_id, highlighted=1 if is_highlighted else -1)
+
+
+@_safely
+def forget(event_id):
+    """
+    Esborra els comptadors d'un esdeveniment eliminat
+    """
+    _collection(COUNTERS_COLLECTION).delete_one({'_id': event_id})
+    _collection(CHATTERS_COLLECTION).delete_many({'event_id': event_id})
+
+
+def compute_counts(event_id):
+    """
+    Comptadors calculats a partir dels missatges (recorre tot el xat)
+    """
+    return ChatMessage.objects.filter(event_id=event_id).aggregate(
+        total=Count('id'),
+        visible=Count('id', filter=Q(is_deleted=False)),
+        highlighted=Count('id', filter=Q(is_deleted=False, is_highlighted=True)),
+        chatters=Count('user', distinct=True),
+    )
+
+
+def get_counts(event_id):
+    """
+    Comptadors del xat d'un esdeveniment: {'total', 'visible', 'highlighted', 'chatters'}
+    """
+    if not enabled():
+        return compute_counts(event_id)
+
+    document = _collection(COUNTERS_COLLECTION).find_one({'_id': event_id}) or {}
+    return {field: max(0, document.get(field, 0)) for field in FIELDS}
@@ -0,0 +1,148 @@
+"""
+Exportació del xat complet d'un esdeveniment (NDJSON o CSV, opcionalment gzip).
+
+Tot funciona amb generadors: els missatges es llegeixen per lots ordenats
+per id (paginació per id, sense OFFSET), els autors de cada lot es busquen
+amb una sola consulta id__in i cada lot es converteix en bytes i s'entrega
+abans de llegir el següent. La memòria és la d'un lot, sigui quina sigui
+la mida del xat. El fan servir tant la vista chat_export com la comanda
+export_chat.
+"""
+import csv
+import io
+import json
+import zlib
+from collections import OrderedDict
+
+from django.contrib.auth import get_user_model
+
+from ..models import ChatMessage
+
+# Missatges per lot
+EXPORT_BATCH_SIZE = 1000
+
+# Autors recordats entre lots (els xats solen tenir molts missatges de pocs usuaris)
+MAX_CACHED_AUTHORS = 10000
+
+FORMATS = {
+    'ndjson': 'application/x-ndjson',
+    'csv': 'text/csv; charset=utf-8',
+}
+
+COLUMNS = ['id', 'created_at', 'user_id', 'username', 'display_name', 'message', 'is_highlighted', 'is_deleted']
+
+
+def iter_batches(event_id, include_deleted=False, batch_size=EXPORT_BATCH_SIZE):
+    """
+    Lots de files del xat, en ordre d'id, amb el nom de l'autor resolt
+    """
+    queryset = ChatMessage.objects.filter(event_id=event_id)
+    if not include_deleted:
+        queryset = queryset.filter(is_deleted=False)
+
+    authors = OrderedDict()
+    last_id = 0
+
+    while True:
+        batch = list(
+            queryset.filter(id__gt=last_id)
+            .order_by('id')
+            .values('id', 'created_at', 'user_id', 'message', 'is_highlighted', 'is_deleted')[:batch_size]
+        )
+        if not batch:
+            return
+
+        last_id = batch[-1]['id']
+        _resolve_authors(authors, {row['user_id'] for row in batch})
+
+        rows = []
+        for row in batch:
+            username, display_name = authors.get(row['user_id'], ('', ''))
+            rows.append({
+                'id': row['id'],
+                'created_at': row['created_at'].isoformat(),
+                'user_id': row['user_id'],
+                'username': username,
+                'display_name': display_name,
+                'message': row['message'],
+                'is_highlighted': row['is_highlighted'],
+                'is_deleted': row['is_deleted'],
+            })
+        yield rows
+
+        if len(batch) < batch_size:
+            return
+
+
+def _resolve_authors(authors, user_ids):
+    """
+    Afegeix a `authors` els usuaris que falten, amb una sola consulta
+    """
+    missing = [user_id for user_id in user_ids if user_id not in authors]
+    if missing:
+        for user_id, username, display_name in get_user_model().objects.filter(
+            id__in=missing
+        ).values_list('id', 'username', 'display_name'):
+            authors[user_id] = (username, display_name or username)
+
+    for user_id in user_ids:
+        if user_id in authors:
+            authors.move_to_end(user_id)
+
+    while len(authors) > MAX_CACHED_AUTHORS:
+        authors.popitem(last=False)
+
+
+def ndjson_chunks(batches):
+    """
+    Un objecte JSON per línia; un bloc de bytes per lot
+    """
+    for rows in batches:
+        yield ''.join(json.dumps(row, ensure_ascii=False) + '\n' for row in rows).encode('utf-8')
+
+
+def csv_chunks(batches):
+    """
+    CSV amb capçalera; un bloc de bytes per lot
+    """
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=COLUMNS)
+    writer.writeheader()
+    yield buffer.getvalue().encode('utf-8')
+
+    for rows in batches:
+        buffer.seek(0)
+        buffer.truncate()
+        writer.writerows(rows)
+        yield buffer.getvalue().encode('utf-8')
+
+
+def gzip_chunks(chunks, level=6):
+    """
+    Comprimeix al vol amb gzip (wbits=31 afegeix la capçalera gzip)
+    """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def export_chunks(event_id, export_format='ndjson', compress=False, include_deleted=False):
+    """
+    Blocs de bytes de l'exportació completa del xat d'un esdeveniment
+    """
+    from . import archive
+
+    # Els xats arxivats surten del fitxer de l'arxiu
+    if archive.is_archived(event_id):
+        batches = archive.iter_batches(event_id)
+    else:
+        batches = iter_batches(event_id, include_deleted=include_deleted)
+    chunks = csv_chunks(batches) if export_format == 'csv' else ndjson_chunks(batches)
+    return gzip_chunks(chunks) if compress else chunks
+
+
+def export_filename(event_id, export_format='ndjson', compress=False):
+    return f"xat-{event_id}.{export_format}{'.gz' if compress else ''}"
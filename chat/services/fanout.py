@@ -0,0 +1,326 @@
+"""
+Fan-out del xat entre processos.
+
+El broker en memòria només arriba als clients connectats al mateix worker.
+Amb diversos workers (i diverses màquines) cal que cada avís de missatge nou,
+eliminat o destacat arribi a tots els processos, i que cadascun l'entregui
+als seus subscriptors. El transport es tria a settings.CHAT_FANOUT['BACKEND']:
+
+- 'local': sense fan-out, només el procés actual (per defecte, un sol worker)
+- 'multicast': datagrames UDP multicast a la xarxa local. Cada procés
+  entrega els seus avisos directament i ignora els que li tornen
+- 'mongo': change streams de MongoDB sobre la col·lecció chat_chatmessage.
+  Tots els processos, inclòs el que escriu, reben els canvis des de la BD.
+  Els avisos que no surten d'un missatge (esdeveniment tancat) s'insereixen
+  a una col·lecció d'avisos vigilada pel mateix change stream.
+  Necessita un replica set (n'hi ha prou amb un de local d'un sol node)
+"""
+import json
+import logging
+import socket
+import struct
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from datetime import datetime, timezone as dt_timezone
+
+from django.conf import settings
+from django.db import close_old_connections
+from django.utils import timezone
+from django.utils.timesince import timesince
+
+from .broker import KIND_MESSAGE, KIND_DELETED, KIND_HIGHLIGHTED
+
+# Avisos que el transport 'mongo' obté del change stream de chat_chatmessage
+STREAM_KINDS = (KIND_MESSAGE, KIND_DELETED, KIND_HIGHLIGHTED)
+
+logger = logging.getLogger(__name__)
+
+DEFAULTS = {
+    'BACKEND': 'local',
+    'MULTICAST_GROUP': '239.255.42.99',
+    'MULTICAST_PORT': 42099,
+    'MULTICAST_TTL': 1,
+    'MONGO_COLLECTION': 'chat_chatmessage',
+    'MONGO_NOTICES_COLLECTION': 'chat_fanout_notices',
+    # Segons que es guarden els avisos a la col·lecció (índex TTL)
+    'MONGO_NOTICES_TTL': 3600,
+}
+
+
+def get_config():
+    """
+    Configuració del fan-out amb els valors per defecte
+    """
+    return {**DEFAULTS, **getattr(settings, 'CHAT_FANOUT', {})}
+
+
+class LocalTransport:
+    """
+    Sense fan-out: entrega només als subscriptors d'aquest procés
+    """
+
+    def __init__(self, broker, config):
+        self.broker = broker
+
+    def start(self):
+        pass
+
+    def publish(self, event_id, kind, payload):
+        self.broker.deliver(event_id, kind, payload)
+
+
+class MulticastTransport:
+    """
+    Fan-out per UDP multicast. Cada avís porta l'identificador del procés
+    que l'ha enviat per no entregar-lo dues vegades.
+    """
+
+    def __init__(self, broker, config):
+        self.broker = broker
+        self.group = config['MULTICAST_GROUP']
+        self.port = config['MULTICAST_PORT']
+        self.origin = uuid.uuid4().hex
+
+        self._send_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+        self._send_socket.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, config['MULTICAST_TTL'])
+
+    def start(self):
+        threading.Thread(target=self._listen, name='chat-fanout-multicast', daemon=True).start()
+
+    def publish(self, event_id, kind, payload):
+        # Primer als nostres subscriptors, després a la resta de processos
+        self.broker.deliver(event_id, kind, payload)
+
+        data = json.dumps({
+            'origin': self.origin,
+            'event_id': event_id,
+            'kind': kind,
+            'payload': payload,
+        }).encode('utf-8')
+        try:
+            self._send_socket.sendto(data, (self.group, self.port))
+        except OSError:
+            logger.exception("No s'ha pogut enviar l'avís del xat per multicast")
+
+    def _listen(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if hasattr(socket, 'SO_REUSEPORT'):
+            # Diversos workers a la mateixa màquina escolten el mateix port
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        sock.bind(('', self.port))
+
+        membership = struct.pack('4sl', socket.inet_aton(self.group), socket.INADDR_ANY)
+        sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, membership)
+
+        while True:
+            data, _ = sock.recvfrom(65535)
+            try:
+                notice = json.loads(data.decode('utf-8'))
+            except ValueError:
+                continue
+
+            if notice.get('origin') == self.origin:
+                continue
+
+            self.broker.deliver(notice['event_id'], notice['kind'], notice['payload'])
+
+
+class MongoChangeStreamTransport:
+    """
+    Fan-out amb change streams de MongoDB: cada procés vigila la col·lecció
+    de missatges i converteix les insercions i actualitzacions en avisos.
+    Els altres avisos (KIND_CLOSED) s'insereixen a la col·lecció d'avisos,
+    que vigila el mateix change stream.
+    Si la BD no admet change streams (no és un replica set), es queda en local.
+    """
+
+    # Segons d'espera abans de tornar a obrir el change stream després d'un error
+    RETRY_SECONDS = 2
+
+    # Noms d'usuari guardats com a molt (els menys usats surten primer) i
+    # segons que es fan servir abans de tornar-los a llegir (canvis de nom)
+    MAX_USER_NAMES = 1000
+    USER_NAMES_TTL = 60
+
+    def __init__(self, broker, config):
+        self.broker = broker
+        self.collection_name = config['MONGO_COLLECTION']
+        self.notices_collection_name = config['MONGO_NOTICES_COLLECTION']
+        self.notices_ttl = config['MONGO_NOTICES_TTL']
+        self.available = True
+        # user_id -> (caducitat, username, display_name)
+        self._users = OrderedDict()
+        # On es va quedar el change stream, per reprendre'l sense perdre canvis
+        self._resume_token = None
+
+    def start(self):
+        threading.Thread(target=self._watch, name='chat-fanout-mongo', daemon=True).start()
+
+    def publish(self, event_id, kind, payload):
+        # Amb change streams l'avís arriba a tots els processos (inclòs aquest) des de la BD
+        if not self.available:
+            self.broker.deliver(event_id, kind, payload)
+            return
+
+        if kind in STREAM_KINDS:
+            # Ja surt del canvi a la col·lecció de missatges
+            return
+
+        from pymongo.errors import PyMongoError
+        from .mongo import get_collection
+
+        try:
+            get_collection(self.notices_collection_name).insert_one({
+                'event_id': event_id,
+                'kind': kind,
+                'payload': payload,
+                'created_at': datetime.now(dt_timezone.utc),
+            })
+        except PyMongoError:
+            logger.exception("No s'ha pogut difondre l'avís %s: només arriba a aquest procés", kind)
+            self.broker.deliver(event_id, kind, payload)
+
+    def _watch(self):
+        from pymongo.errors import OperationFailure, PyMongoError
+        from .mongo import get_collection, get_database
+
+        pipeline = [{'$match': {
+            'operationType': {'$in': ['insert', 'update']},
+            'ns.coll': {'$in': [self.collection_name, self.notices_collection_name]},
+        }}]
+
+        try:
+            # Els avisos antics s'esborren sols
+            get_collection(self.notices_collection_name).create_index(
+                'created_at', expireAfterSeconds=self.notices_ttl
+            )
+        except PyMongoError:
+            logger.exception("No s'ha pogut crear l'índex TTL dels avisos del xat")
+
+        while True:
+            try:
+                database = get_database()
+                with database.watch(
+                    pipeline, full_document='updateLookup', resume_after=self._resume_token
+                ) as stream:
+                    self.available = True
+                    for change in stream:
+                        if change['ns']['coll'] == self.notices_collection_name:
+                            self._handle_notice(change)
+                        else:
+                            self._handle(change)
+                        self._resume_token = stream.resume_token
+            except OperationFailure:
+                if self._resume_token is not None:
+                    # El punt de represa ja no és a l'oplog: es perden els canvis
+                    # del tall (els clients es posen al dia amb el polling)
+                    logger.exception("No s'ha pogut reprendre el change stream del xat: es torna a obrir")
+                    self._resume_token = None
+                    continue
+                logger.exception('MongoDB no admet change streams: el xat només arribarà a aquest procés')
+                self.available = False
+                return
+            except PyMongoError:
+                logger.exception('Error al change stream del xat, reintentant')
+                time.sleep(self.RETRY_SECONDS)
+            finally:
+                close_old_connections()
+
+    def _handle_notice(self, change):
+        notice = change.get('fullDocument')
+        if notice and change['operationType'] == 'insert':
+            self.broker.deliver(notice['event_id'], notice['kind'], notice['payload'])
+
+    def _handle(self, change):
+        document = change.get('fullDocument')
+        if not document:
+            return
+
+        event_id = document['event_id']
+
+        if change['operationType'] == 'insert':
+            if not document.get('is_deleted'):
+                self.broker.deliver(event_id, KIND_MESSAGE, self._message_payload(document))
+            return
+
+        updated_fields = change.get('updateDescription', {}).get('updatedFields', {})
+        if document.get('is_deleted'):
+            if 'is_deleted' in updated_fields:
+                self.broker.deliver(event_id, KIND_DELETED, {'id': document['id']})
+        elif 'is_highlighted' in updated_fields:
+            self.broker.deliver(event_id, KIND_HIGHLIGHTED, {
+                'id': document['id'],
+                'is_highlighted': document['is_highlighted'],
+            })
+
+    def _message_payload(self, document):
+        """
+        Construeix el mateix JSON que _serialize_message a partir del document de Mongo
+        """
+        username, display_name = self._user_names(document['user_id'])
+
+        # djongo crea el client sense tz_aware: les dates arriben sense zona, però són UTC
+        created_at = document['created_at']
+        if timezone.is_naive(created_at):
+            created_at = timezone.make_aware(created_at, dt_timezone.utc)
+
+        return {
+            'id': document['id'],
+            'user_id': document['user_id'],
+            'user': username,
+            'display_name': display_name,
+            'message': document['message'],
+            'created_at': f"fa {timesince(created_at)}",
+            'timestamp': created_at.isoformat(),
+            'can_delete': False,
+            'is_highlighted': document.get('is_highlighted', False),
+        }
+
+    def _user_names(self, user_id):
+        """
+        (username, display_name) d'un usuari. Es guarden com a molt
+        USER_NAMES_TTL segons, de manera que els canvis de nom acaben arribant.
+        """
+        now = time.monotonic()
+        entry = self._users.get(user_id)
+        if entry is not None and entry[0] > now:
+            self._users.move_to_end(user_id)
+            return entry[1:]
+
+        from django.contrib.auth import get_user_model
+        user = get_user_model().objects.filter(pk=user_id).only('username', 'display_name').first()
+        if user is None:
+            self._users.pop(user_id, None)
+            return '', ''
+
+        names = (user.username, getattr(user, 'display_name', None) or user.username)
+        self._users[user_id] = (now + self.USER_NAMES_TTL, *names)
+        self._users.move_to_end(user_id)
+        while len(self._users) > self.MAX_USER_NAMES:
+            self._users.popitem(last=False)
+        return names
+
+
+TRANSPORTS = {
+    'local': LocalTransport,
+    'multicast': MulticastTransport,
+    'mongo': MongoChangeStreamTransport,
+}
+
+
+def build_transport(broker):
+    """
+    Crea i arrenca el transport configurat a settings.CHAT_FANOUT
+    """
+    config = get_config()
+    try:
+        transport_class = TRANSPORTS[config['BACKEND']]
+    except KeyError:
+        raise ValueError(f"CHAT_FANOUT['BACKEND'] desconegut: {config['BACKEND']!r}")
+
+    transport = transport_class(broker, config)
+    transport.start()
+    return transport
@@ -0,0 +1,25 @@
+"""
+Accés directe a MongoDB (pymongo) a través de la connexió de djongo.
+
+Per a les operacions que l'ORM no pot expressar (change streams,
+actualitzacions atòmiques, índexs...) fem servir la mateixa connexió
+que Django en lloc d'obrir-ne una de nova.
+"""
+from django.db import connections
+
+
+def get_database(alias='default'):
+    """
+    Retorna l'objecte pymongo Database de la connexió `alias`.
+    Amb djongo, connection.connection és directament la base de dades de pymongo.
+    """
+    connection = connections[alias]
+    connection.ensure_connection()
+    return connection.connection
+
+
+def get_collection(name, alias='default'):
+    """
+    Retorna una col·lecció de pymongo (el nom de la taula de Django: app_model)
+    """
+    return get_database(alias)[name]
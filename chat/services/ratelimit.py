@@ -0,0 +1,145 @@
+"""
+Limitació de missatges del xat amb token buckets.
+
+Cada usuari té un bucket (missatges que pot enviar de cop i ritme al qual
+es recupera) i cada esdeveniment en té un altre per al total del xat. Així
+uns quants usuaris enviant spam no poden saturar l'escriptura ni els
+polls de tots els espectadors. Les comprovacions es fan en memòria abans
+de validar el formulari o tocar la BD.
+
+La configuració és a settings.CHAT_RATE_LIMITS:
+
+    CHAT_RATE_LIMITS = {
+        'BACKEND': 'memory',   # o 'cache' per compartir els buckets entre processos
+        'USER_RATE': 1.0,      # missatges per segon per usuari
+        'USER_BURST': 5,       # missatges seguits permesos per usuari
+        'EVENT_RATE': 20.0,    # missatges per segon per esdeveniment
+        'EVENT_BURST': 60,
+        'CREATORS': {          # límits propis dels esdeveniments d'un creador (per id)
+            42: {'USER_RATE': 0.2, 'USER_BURST': 2},
+        },
+    }
+
+Amb 'cache' els buckets són a la memòria cau de Django (compartida si ho és
+la memòria cau). La lectura i l'escriptura no són atòmiques: el límit és
+aproximat quan diversos processos consumeixen alhora del mateix bucket.
+"""
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import cache
+
+DEFAULTS = {
+    'BACKEND': 'memory',
+    'USER_RATE': 1.0,
+    'USER_BURST': 5,
+    'EVENT_RATE': 20.0,
+    'EVENT_BURST': 60,
+    'CREATORS': {},
+}
+
+# Buckets en memòria com a màxim (els menys usats surten primer)
+MAX_BUCKETS = 100000
+
+
+def get_config(creator_id=None):
+    """
+    Límits que s'apliquen als esdeveniments d'un creador
+    """
+    config = {**DEFAULTS, **getattr(settings, 'CHAT_RATE_LIMITS', {})}
+    overrides = config['CREATORS'].get(creator_id, {})
+    return {**config, **overrides}
+
+
+class MemoryBuckets:
+    """
+    Buckets en memòria d'aquest procés
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._buckets = OrderedDict()
+
+    def consume(self, limits):
+        """
+        Intenta gastar un token de cada bucket de `limits` [(clau, rate, burst), ...].
+        Només es gasta si tots en tenen. Retorna 0 si s'ha pogut, o els segons
+        que cal esperar fins que tots en tinguin un
+        """
+        now = time.monotonic()
+
+        with self._lock:
+            states = [self._buckets.get(key, (burst, now)) for key, _, burst in limits]
+            tokens, wait = _take(states, limits, now)
+            if wait:
+                return wait
+
+            for (key, _, _), remaining in zip(limits, tokens):
+                self._buckets[key] = (remaining, now)
+                self._buckets.move_to_end(key)
+            while len(self._buckets) > MAX_BUCKETS:
+                self._buckets.popitem(last=False)
+
+        return 0.0
+
+
+class CacheBuckets:
+    """
+    Buckets a la memòria cau de Django (aproximat entre processos)
+    """
+
+    def consume(self, limits):
+        now = time.time()
+        cache_keys = [f'chat:ratelimit:{key}' for key, _, _ in limits]
+
+        stored = cache.get_many(cache_keys)
+        states = [stored.get(cache_key, (burst, now)) for cache_key, (_, _, burst) in zip(cache_keys, limits)]
+        tokens, wait = _take(states, limits, now)
+        if wait:
+            return wait
+
+        # Quan el bucket s'ha tornat a omplir ja no cal guardar-lo
+        for cache_key, (_, rate, burst), remaining in zip(cache_keys, limits, tokens):
+            cache.set(cache_key, (remaining, now), timeout=int(burst / rate) + 1)
+        return 0.0
+
+
+def _take(states, limits, now):
+    """
+    Recarrega cada bucket segons el temps passat i, si tots tenen un token,
+    en treu un de cada. Retorna (tokens de cada bucket, segons d'espera)
+    """
+    tokens = [
+        min(burst, stored + (now - updated) * rate)
+        for (stored, updated), (_, rate, burst) in zip(states, limits)
+    ]
+    wait = max(
+        ((1 - available) / rate for available, (_, rate, _) in zip(tokens, limits) if available < 1),
+        default=0.0,
+    )
+    if wait:
+        return tokens, wait
+    return [available - 1 for available in tokens], 0.0
+
+
+_backends = {
+    'memory': MemoryBuckets(),
+    'cache': CacheBuckets(),
+}
+
+
+def check_send(user_id, event_id, creator_id):
+    """
+    Comprova si un usuari pot enviar un missatge a un esdeveniment.
+    Retorna 0 si pot, o els segons que ha d'esperar (per a Retry-After).
+    """
+    config = get_config(creator_id)
+    buckets = _backends[config['BACKEND']]
+
+    # Un missatge rebutjat per l'esdeveniment no gasta el token de l'usuari (ni al revés)
+    return buckets.consume([
+        (f'user:{user_id}', config['USER_RATE'], config['USER_BURST']),
+        (f'event:{event_id}', config['EVENT_RATE'], config['EVENT_BURST']),
+    ])
@@ -0,0 +1,265 @@
+"""
+Missatges recents dels esdeveniments en directe, en memòria.
+
+Tots els clients d'un esdeveniment en directe demanen els mateixos últims
+missatges. Per a cada esdeveniment en directe guardem un buffer circular amb
+els últims RING_SIZE missatges ja serialitzats i un registre dels canvis
+recents (eliminats i destacats). El buffer s'omple des de la BD la primera
+vegada que es demana i després s'actualitza amb els avisos del broker, de
+manera que chat_load_messages respon sense consultar la BD.
+
+El buffer desapareix quan l'esdeveniment deixa d'estar en directe (avís
+KIND_CLOSED) o quan caduca, i es torna a omplir des de la BD si cal.
+"""
+import threading
+import time
+from collections import OrderedDict, deque
+from datetime import timedelta
+
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from django.utils.timesince import timesince
+
+from .broker import broker, KIND_MESSAGE, KIND_DELETED, KIND_HIGHLIGHTED, KIND_CLOSED
+
+# Missatges guardats per esdeveniment (més dels que es retornen, perquè
+# algunes eliminacions no obliguin a tornar a consultar la BD)
+RING_SIZE = 100
+
+# Esdeveniments en directe amb buffer alhora (els menys usats surten primer)
+MAX_LIVE_EVENTS = 200
+
+# Canvis (eliminats/destacats) recordats per esdeveniment
+MAX_CHANGES = 500
+
+# Segons que dura un buffer abans de tornar-lo a omplir des de la BD.
+# Cobreix els canvis d'estat que no passen pels signals (p. ex. un update() massiu)
+BUFFER_TTL_SECONDS = 300
+
+# Marge pels rellotges de diferents processos en comparar el cursor `since`
+CLOCK_SLACK = timedelta(seconds=2)
+
+
+class EventBuffer:
+    """
+    Buffer d'un esdeveniment en directe: últims missatges visibles (ordenats
+    per id) i registre de canvis des que es va crear
+    """
+
+    def __init__(self, event_id, creator_id):
+        self.event_id = event_id
+        self.creator_id = creator_id
+        self.loaded = False
+        # Cert si el buffer conté tots els missatges visibles de l'esdeveniment
+        self.complete = False
+        self.expires = time.monotonic() + BUFFER_TTL_SECONDS
+
+        self._lock = threading.Lock()
+        # (id, created_at, payload)
+        self._messages = deque(maxlen=RING_SIZE)
+        # (moment, kind, payload)
+        self._changes = deque(maxlen=MAX_CHANGES)
+        # Els canvis anteriors a aquest moment ja no es poden respondre des de memòria
+        self._changes_floor = timezone.now()
+
+    def load(self, payloads, complete):
+        """
+        Omple el buffer amb els missatges llegits de la BD (ordenats per id).
+        Conserva el que hagi arribat pel broker mentre es consultava.
+        """
+        with self._lock:
+            entries = {payload['id']: _entry(payload) for payload in payloads}
+            for entry in self._messages:
+                entries[entry[0]] = entry
+
+            for _, kind, payload in self._changes:
+                if kind == KIND_DELETED:
+                    entries.pop(payload['id'], None)
+                elif kind == KIND_HIGHLIGHTED and payload['id'] in entries:
+                    message_id, created_at, message = entries[payload['id']]
+                    entries[message_id] = (message_id, created_at, {**message, 'is_highlighted': payload['is_highlighted']})
+
+            ordered = [entries[message_id] for message_id in sorted(entries)]
+            self._messages = deque(ordered[-RING_SIZE:], maxlen=RING_SIZE)
+            self.complete = complete and len(ordered) <= RING_SIZE
+            self.loaded = True
+
+    def apply(self, kind, payload):
+        """
+        Aplica un avís del broker
+        """
+        with self._lock:
+            if kind == KIND_MESSAGE:
+                self._add(payload)
+                return
+
+            self._log(kind, payload)
+
+            if kind == KIND_DELETED:
+                self._messages = deque(
+                    (entry for entry in self._messages if entry[0] != payload['id']),
+                    maxlen=RING_SIZE
+                )
+            elif kind == KIND_HIGHLIGHTED:
+                for index, (message_id, created_at, message) in enumerate(self._messages):
+                    if message_id == payload['id']:
+                        self._messages[index] = (
+                            message_id, created_at, {**message, 'is_highlighted': payload['is_highlighted']}
+                        )
+                        break
+
+    def snapshot(self, limit):
+        """
+        Últims `limit` missatges. None si el buffer en té menys i no els té tots
+        (per exemple després de moltes eliminacions): cal tornar a la BD.
+        """
+        with self._lock:
+            if len(self._messages) < limit and not self.complete:
+                return None
+            return [_render(entry) for entry in list(self._messages)[-limit:]]
+
+    def changes_since(self, after, since, limit):
+        """
+        Missatges amb id > after i canvis des de `since`, com el polling incremental.
+        Retorna (messages, deleted, highlighted) o None si el buffer no pot
+        respondre (el cursor és massa antic o hi ha missatges fora del buffer).
+        """
+        since = since - CLOCK_SLACK
+
+        with self._lock:
+            if since < self._changes_floor:
+                return None
+
+            if self._messages and self._messages[0][0] > after and not self.complete:
+                # Hi pot haver missatges entre `after` i el primer del buffer
+                return None
+
+            entries = [entry for entry in self._messages if entry[0] > after]
+
+            deleted = []
+            highlighted = []
+            for moment, kind, payload in self._changes:
+                if moment < since or payload['id'] > after:
+                    continue
+                if kind == KIND_DELETED:
+                    deleted.append(payload['id'])
+                elif kind == KIND_MESSAGE:
+                    # Ha arribat desordenat amb un id que el client ja ha deixat enrere
+                    entries.extend(entry for entry in self._messages if entry[0] == payload['id'])
+                else:
+                    highlighted.append(payload)
+
+            entries.sort(key=lambda entry: entry[0])
+            messages = [_render(entry) for entry in entries][:limit]
+
+        return messages, deleted, highlighted
+
+    def _add(self, payload):
+        entry = _entry(payload)
+
+        if any(existing[0] == entry[0] for existing in self._messages):
+            return
+
+        if not self._messages or self._messages[-1][0] < entry[0]:
+            if len(self._messages) == RING_SIZE:
+                self.complete = False
+            self._messages.append(entry)
+            return
+
+        # Ha arribat desordenat (d'un altre procés): el col·loquem al seu lloc i
+        # l'apuntem als canvis, perquè els clients amb un cursor més alt el rebin
+        self._log(KIND_MESSAGE, {'id': entry[0]})
+        ordered = sorted([*self._messages, entry], key=lambda item: item[0])
+        if len(ordered) > RING_SIZE:
+            self.complete = False
+        self._messages = deque(ordered[-RING_SIZE:], maxlen=RING_SIZE)
+
+    def _log(self, kind, payload):
+        if len(self._changes) == MAX_CHANGES:
+            self._changes_floor = self._changes[0][0]
+        self._changes.append((timezone.now(), kind, payload))
+
+
+class RecentMessages:
+    """
+    Buffers dels esdeveniments en directe, amb un màxim de MAX_LIVE_EVENTS
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._buffers = OrderedDict()
+
+    def get(self, event_id):
+        """
+        Buffer ja omplert d'un esdeveniment, o None
+        """
+        with self._lock:
+            buffer = self._buffers.get(event_id)
+            if buffer is None:
+                return None
+            if buffer.expires < time.monotonic():
+                del self._buffers[event_id]
+                return None
+            self._buffers.move_to_end(event_id)
+
+        return buffer if buffer.loaded else None
+
+    def get_or_create(self, event_id, creator_id):
+        """
+        Retorna (buffer, created). Si created és cert, cal omplir-lo amb load().
+        Es registra abans de consultar la BD perquè no es perdi cap avís.
+        """
+        with self._lock:
+            buffer = self._buffers.get(event_id)
+            if buffer is not None and buffer.expires >= time.monotonic():
+                self._buffers.move_to_end(event_id)
+                return buffer, False
+
+            buffer = EventBuffer(event_id, creator_id)
+            self._buffers[event_id] = buffer
+            while len(self._buffers) > MAX_LIVE_EVENTS:
+                self._buffers.popitem(last=False)
+
+        return buffer, True
+
+    def evict(self, event_id):
+        """
+        Oblida el buffer d'un esdeveniment
+        """
+        with self._lock:
+            self._buffers.pop(event_id, None)
+
+    def on_deliver(self, event_id, kind, payload):
+        """
+        Listener del broker: manté els buffers al dia
+        """
+        if kind == KIND_CLOSED:
+            self.evict(event_id)
+            return
+
+        with self._lock:
+            buffer = self._buffers.get(event_id)
+
+        if buffer is not None:
+            buffer.apply(kind, payload)
+
+
+def _entry(payload):
+    """
+    Entrada del buffer: el payload sense dades del visitant
+    """
+    shared = {key: value for key, value in payload.items() if key != 'can_delete'}
+    return payload['id'], parse_datetime(payload['timestamp']), shared
+
+
+def _render(entry):
+    """
+    Payload d'una entrada amb el temps relatiu actualitzat
+    """
+    _, created_at, payload = entry
+    return {**payload, 'created_at': f"fa {timesince(created_at)}"}
+
+
+# Buffers compartits per tot el procés
+recent_messages = RecentMessages()
+broker.add_listener(recent_messages.on_deliver)
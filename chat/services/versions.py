@@ -0,0 +1,31 @@
+"""
+Versió del xat de cada esdeveniment, per a les ETags de chat_load_messages.
+
+S'incrementa amb cada avís que entrega el broker (missatge nou, eliminat,
+destacat o esdeveniment tancat). Com que el fan-out entrega els avisos a
+tots els processos, cada worker manté la seva versió al dia.
+"""
+from events.services.versions import get_version, bump_version
+
+from .broker import broker
+
+
+def chat_version_key(event_id):
+    return f'chat:version:{event_id}'
+
+
+def get_chat_version(event_id):
+    """
+    Versió actual del xat d'un esdeveniment
+    """
+    return get_version(chat_version_key(event_id))
+
+
+def on_deliver(event_id, kind, payload):
+    """
+    Listener del broker: qualsevol avís canvia la versió del xat
+    """
+    bump_version(chat_version_key(event_id))
+
+
+broker.add_listener(on_deliver)
@@ -0,0 +1,267 @@
+"""
+Escriptura diferida (write-behind) dels missatges del xat.
+
+En els moments de més trànsit d'un directe, desar cada missatge amb un
+insert propi fa que la BD marqui el límit de missatges per segon. Amb
+settings.CHAT_WRITE_BEHIND activat, chat_send_message:
+
+1. Assigna l'id del missatge amb IdAllocator, que reserva blocs d'ids amb
+   un $inc al mateix comptador que fa servir djongo (col·lecció __schema__),
+   de manera que no xoca amb els inserts normals ni amb altres processos
+2. Publica el missatge als espectadors immediatament
+3. Deixa el missatge en una cua; un fil el desa amb bulk_create per lots i
+   actualitza els comptadors del xat (counters) un cop per lot
+
+Amb trànsit, un missatge no fa cap viatge a la BD en el fil de la petició:
+una reserva d'ids com a molt cada ID_BLOCK_TTL segons per procés, i els
+inserts i els comptadors van per lots en segon pla.
+
+Límits de durabilitat: com a molt FLUSH_INTERVAL segons de missatges
+(o MAX_PENDING missatges) poden estar només en memòria. Si la cua s'omple
+s'escriu de forma síncrona, i en tancar el procés (atexit) es buida la cua.
+Una caiguda brusca del procés (kill -9) pot perdre els missatges pendents.
+
+Ordre dels ids amb diversos processos: el polling incremental, el buffer de
+missatges recents i la represa de l'SSE demanen els missatges amb id > cursor,
+així que els ids han de créixer amb el temps. Amb blocs per procés no és
+exacte (el procés B pot desar el 101 i després el procés A el 5), per això un
+bloc només es fa servir durant ID_BLOCK_TTL segons: la resta es descarta i
+els ids de processos diferents mai es desordenen més que aquest temps (més
+el del lot). chat_load_messages i el buffer tornen a enviar els missatges
+amb id per sota del cursor desats després de l'últim poll (created_at és el
+moment d'escriure'ls), de manera que cap client no se'ls perd.
+"""
+import atexit
+import logging
+import queue
+import threading
+import time
+
+from django.conf import settings
+from django.db import close_old_connections, connections, router
+from django.utils import timezone
+
+from ..models import ChatMessage
+from . import counters
+
+logger = logging.getLogger(__name__)
+
+# Màxim de missatges per lot
+BATCH_SIZE = 500
+
+# Segons que esperem que s'acumulin més missatges abans d'escriure
+FLUSH_INTERVAL = 0.02
+
+# Màxim de missatges pendents; si s'omple, escrivim en el mateix fil
+MAX_PENDING = 5000
+
+# Ids que reserva cada procés de cop
+ID_BLOCK_SIZE = 100
+
+# Segons que es fa servir un bloc d'ids; després es descarta el que en quedi
+# perquè els ids de diferents processos segueixin l'ordre d'enviament
+ID_BLOCK_TTL = 0.05
+
+# Segons que esperem el fil en tancar el procés
+SHUTDOWN_TIMEOUT = 10
+
+_queue = queue.Queue(maxsize=MAX_PENDING)
+_lock = threading.Lock()
+_worker = None
+_stopping = threading.Event()
+
+# Ids encuats però encara no desats (per a eliminar/destacar un missatge acabat d'enviar)
+_pending_ids = set()
+_pending_lock = threading.Lock()
+
+
+class IdAllocator:
+    """
+    Reserva ids (d'ID_BLOCK_SIZE en ID_BLOCK_SIZE) al comptador autoincremental
+    de djongo amb un sol $inc. Cada bloc caduca als ID_BLOCK_TTL segons.
+    """
+
+    def __init__(self, table, block_size=ID_BLOCK_SIZE, block_ttl=ID_BLOCK_TTL):
+        self.table = table
+        self.block_size = block_size
+        self.block_ttl = block_ttl
+        self._lock = threading.Lock()
+        self._next = 1
+        self._last = 0
+        self._expires = 0.0
+
+    def next_id(self):
+        with self._lock:
+            now = time.monotonic()
+            if self._next > self._last or now >= self._expires:
+                self._reserve()
+                self._expires = now + self.block_ttl
+            value = self._next
+            self._next += 1
+            return value
+
+    def _reserve(self):
+        from pymongo import ReturnDocument
+        from .mongo import get_collection
+
+        schema = get_collection('__schema__', router.db_for_write(ChatMessage))
+        document = schema.find_one_and_update(
+            {'name': self.table},
+            {'$inc': {'auto.seq': self.block_size}},
+            return_document=ReturnDocument.AFTER,
+        )
+        if document is None:
+            raise RuntimeError(f"No hi ha comptador d'ids per a {self.table} a __schema__")
+
+        self._last = document['auto']['seq']
+        self._next = self._last - self.block_size + 1
+
+
+_allocator = IdAllocator(ChatMessage._meta.db_table)
+
+
+def enabled():
+    """
+    Cert si el mode write-behind està activat. Només funciona amb djongo,
+    perquè l'assignació d'ids depèn del seu comptador
+    """
+    if not getattr(settings, 'CHAT_WRITE_BEHIND', False):
+        return False
+    return connections[router.db_for_write(ChatMessage)].vendor == 'djongo'
+
+
+def save(message):
+    """
+    Assigna id i data al missatge i l'encua per desar-lo.
+    Quan torna, el missatge ja es pot serialitzar i publicar.
+    """
+    message.id = _allocator.next_id()
+    message.created_at = message.updated_at = timezone.now()
+
+    if _stopping.is_set():
+        # Si ja estem tancant, no hi ha fil que el reculli
+        _write_batch([message])
+        return
+
+    _ensure_worker()
+
+    with _pending_lock:
+        _pending_ids.add(message.id)
+
+    try:
+        _queue.put_nowait(message)
+    except queue.Full:
+        logger.warning("Cua de missatges del xat plena: escrivint de forma síncrona")
+        _write_batch([message])
+
+
+def is_pending(message_id):
+    """
+    Cert si el missatge s'ha enviat però encara no s'ha desat a la BD
+    """
+    with _pending_lock:
+        return message_id in _pending_ids
+
+
+def ensure_saved(message_id, timeout=1.0):
+    """
+    Si el missatge encara no és a la BD, el desa ara (o espera el lot que l'està desant)
+    """
+    if not is_pending(message_id):
+        return
+
+    flush()
+
+    deadline = time.monotonic() + timeout
+    while is_pending(message_id) and time.monotonic() < deadline:
+        time.sleep(FLUSH_INTERVAL / 4)
+
+
+def flush():
+    """
+    Desa immediatament tot el que hi hagi pendent a la cua
+    """
+    while True:
+        batch = _drain(BATCH_SIZE)
+        if not batch:
+            return
+        _write_batch(batch)
+
+
+def _ensure_worker():
+    """
+    Arrenca el fil d'escriptura la primera vegada que cal
+    """
+    global _worker
+
+    if _worker is not None and _worker.is_alive():
+        return
+
+    with _lock:
+        if _worker is None or not _worker.is_alive():
+            _worker = threading.Thread(target=_run, name='chat-write-behind', daemon=True)
+            _worker.start()
+
+
+def _drain(limit):
+    """
+    Treu de la cua fins a `limit` missatges sense bloquejar
+    """
+    items = []
+    while len(items) < limit:
+        try:
+            items.append(_queue.get_nowait())
+        except queue.Empty:
+            break
+    return items
+
+
+def _run():
+    """
+    Bucle del fil: espera el primer missatge, agrupa els següents i escriu el lot
+    """
+    while not _stopping.is_set():
+        try:
+            first = _queue.get(timeout=FLUSH_INTERVAL)
+        except queue.Empty:
+            continue
+
+        _stopping.wait(FLUSH_INTERVAL)
+        batch = [first] + _drain(BATCH_SIZE - 1)
+
+        try:
+            _write_batch(batch)
+        finally:
+            # Aquest fil no passa pel cicle request/response de Django
+            close_old_connections()
+
+
+def _write_batch(batch):
+    """
+    Desa un lot de missatges amb un sol bulk_create
+    """
+    if not batch:
+        return
+
+    try:
+        ChatMessage.objects.bulk_create(batch)
+    except Exception:
+        logger.exception("Error desant %s missatges del xat", len(batch))
+    else:
+        counters.messages_sent([(message.event_id, message.user_id) for message in batch])
+    finally:
+        with _pending_lock:
+            _pending_ids.difference_update(message.id for message in batch)
+
+
+@atexit.register
+def _shutdown():
+    """
+    En tancar el procés, aturem el fil i desem el que quedi pendent
+    """
+    _stopping.set()
+
+    if _worker is not None and _worker.is_alive():
+        _worker.join(timeout=SHUTDOWN_TIMEOUT)
+
+    flush()
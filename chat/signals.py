@@ -0,0 +1,33 @@
+"""
+Signals del xat: quan un esdeveniment deixa d'estar en directe (o s'elimina)
+s'avisa tots els processos perquè oblidin els seus missatges recents en memòria
+(i s'esborra l'estat en directe guardat a la memòria cau).
+Si s'elimina, també se n'esborren els comptadors del xat.
+"""
+from django.core.cache import cache
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+
+from events.models import Event
+from .services import archive, counters
+from .services.broker import broker, KIND_CLOSED
+from .views import live_status_key
+
+
+@receiver(post_save, sender=Event)
+def event_saved(sender, instance, update_fields=None, **kwargs):
+    if instance.status == 'live':
+        return
+    if update_fields is not None and 'status' not in update_fields:
+        return
+    # Si la memòria cau és compartida, els altres processos ho veuen de seguida
+    cache.delete(live_status_key(instance.pk))
+    broker.publish(instance.pk, KIND_CLOSED, {'id': instance.pk})
+
+
+@receiver(post_delete, sender=Event)
+def event_deleted(sender, instance, **kwargs):
+    cache.delete(live_status_key(instance.pk))
+    cache.delete(archive.archived_key(instance.pk))
+    broker.publish(instance.pk, KIND_CLOSED, {'id': instance.pk})
+    counters.forget(instance.pk)
@@ -38,6 +38,9 @@ document.addEventListener('DOMContentLoaded', () => {
         if(msg.can_delete) actionsHtml += `<button class="btn btn-sm btn-danger delete-message">🗑</button>`;
         if(IS_CREATOR) actionsHtml += `<button class="btn btn-sm btn-warning highlight-message">${msg.is_highlighted ? '⭐' : '☆'}</button>`;
 
+        // Guardem les dades del missatge per poder-lo tornar a pintar
+        div._message = msg;
+
         div.innerHTML = `
             <div class="message-header d-flex justify-content-between">
                 <strong>${escapeHtml(msg.display_name)}</strong>
@@ -49,22 +52,119 @@ document.addEventListener('DOMContentLoaded', () => {
         return div;
     }
 
+    // Cursor del polling incremental: últim missatge rebut i hora de l'última consulta
+    let cursor = null;
+
+    // Missatges visibles de tot el xat (comptadors del servidor), no només els carregats.
+    // null si la pàgina no els porta: llavors comptem els de la llista
+    let visibleCount = null;
+    const deletedIds = new Set();
+
+    function countMessages() {
+        if(visibleCount !== null) updateMessageCount(Math.max(0, visibleCount));
+        else updateMessageCount(chatMessages.querySelectorAll('.chat-message').length);
+    }
+
+    function applyChanges(data) {
+        // Missatges eliminats des de l'última consulta
+        (data.deleted || []).forEach(id => {
+            // L'SSE i el polling poden avisar del mateix: només es descompta un cop
+            if(visibleCount !== null && !deletedIds.has(id)) visibleCount--;
+            deletedIds.add(id);
+
+            const el = chatMessages.querySelector(`.chat-message[data-message-id="${id}"]`);
+            if(el) el.remove();
+        });
+
+        // Missatges (des)destacats des de l'última consulta
+        (data.highlighted || []).forEach(change => {
+            const el = chatMessages.querySelector(`.chat-message[data-message-id="${change.id}"]`);
+            if(el) el.replaceWith(createMessageElement({...el._message, is_highlighted: change.is_highlighted}));
+        });
+    }
+
+    function prependMessages(messages) {
+        // Mantenim la posició de l'scroll en afegir missatges a dalt
+        const previousHeight = chatMessages.scrollHeight;
+        const fragment = document.createDocumentFragment();
+        messages.forEach(msg => {
+            if(chatMessages.querySelector(`.chat-message[data-message-id="${msg.id}"]`)) return;
+            fragment.appendChild(createMessageElement(msg));
+        });
+        chatMessages.insertBefore(fragment, chatMessages.firstChild);
+        chatMessages.scrollTop += chatMessages.scrollHeight - previousHeight;
+    }
+
+    function appendMessages(messages, counted = false) {
+        messages.forEach(msg => {
+            // Evitem duplicats si un missatge ja s'ha afegit
+            if(chatMessages.querySelector(`.chat-message[data-message-id="${msg.id}"]`)) return;
+
+            // Normalment va al final; un missatge desat tard (id més baix) va al seu lloc
+            let next = null;
+            for(let el = chatMessages.lastElementChild;
+                el && el.dataset.messageId && Number(el.dataset.messageId) > msg.id;
+                el = el.previousElementSibling) {
+                next = el;
+            }
+            chatMessages.insertBefore(createMessageElement(msg), next);
+            // Els missatges nous sumen; els inicials ja són als comptadors
+            if(!counted && visibleCount !== null) visibleCount++;
+        });
+    }
+
     async function loadMessages() {
         if(!eventId) return;
         try {
-            const res = await fetch(`/chat/load/${eventId}/`);
+            let url = `/chat/load/${eventId}/`;
+            if(cursor) {
+                url += `?after=${cursor.after}&since=${encodeURIComponent(cursor.since)}`;
+            }
+            const res = await fetch(url);
             if(!res.ok) throw new Error('Error cargando mensajes');
             const data = await res.json();
-            chatMessages.innerHTML = '';
-            data.messages.forEach(msg => chatMessages.appendChild(createMessageElement(msg)));
-            updateMessageCount(data.messages.length);
-            scrollToBottom();
+
+            if(!cursor) {
+                // Primera càrrega: pintem tota la llista
+                chatMessages.innerHTML = '';
+            }
+            applyChanges(data);
+            appendMessages(data.messages);
+            cursor = data.cursor;
+
+            countMessages();
+            if(data.messages.length) scrollToBottom();
         } catch(err) {
             console.error("Error cargando mensajes:", err);
             if(chatErrors) chatErrors.textContent = 'No se pudieron cargar los mensajes.';
         }
     }
 
+    // Historial antic: id del missatge més antic carregat (null si no n'hi ha més)
+    let historyBefore = null;
+    let loadingHistory = false;
+
+    async function loadOlderMessages() {
+        if(!historyBefore || loadingHistory) return;
+        loadingHistory = true;
+        try {
+            const res = await fetch(`/chat/history/${eventId}/?before=${historyBefore}`);
+            if(!res.ok) throw new Error('Error cargando historial');
+            const data = await res.json();
+            prependMessages(data.messages);
+            historyBefore = data.before;
+            countMessages();
+        } catch(err) {
+            console.error("Error cargando historial:", err);
+        } finally {
+            loadingHistory = false;
+        }
+    }
+
+    chatMessages.addEventListener('scroll', () => {
+        if(chatMessages.scrollTop < 50) loadOlderMessages();
+    });
+
     async function sendMessage(e) {
         e.preventDefault();
         if(!chatInput || !chatInput.value.trim() || !eventId) return;
@@ -131,6 +231,76 @@ document.addEventListener('DOMContentLoaded', () => {
     console.log('Chat form found:', chatForm);
     if(chatForm) chatForm.addEventListener('submit', sendMessage);
 
-    loadMessages();
-    setInterval(loadMessages, 3000); // polling cada 3 segundos
+    // Temps real: subscripció SSE al xat. Si el navegador no té EventSource
+    // fem polling incremental cada 3 segons
+    let pollingTimer = null;
+
+    function startPolling() {
+        if(!pollingTimer) pollingTimer = setInterval(loadMessages, 3000);
+    }
+
+    function stopPolling() {
+        if(pollingTimer) clearInterval(pollingTimer);
+        pollingTimer = null;
+    }
+
+    function subscribe() {
+        if(!window.EventSource) {
+            startPolling();
+            return;
+        }
+
+        const source = new EventSource(`/chat/stream/${eventId}/`);
+
+        source.addEventListener('open', () => {
+            // En connectar (o reconnectar) ens posem al dia del que s'hagi perdut
+            stopPolling();
+            loadMessages();
+        });
+
+        source.addEventListener('message', (e) => {
+            const msg = JSON.parse(e.data);
+            appendMessages([msg]);
+            if(cursor && msg.id > cursor.after) cursor.after = msg.id;
+            countMessages();
+            scrollToBottom();
+        });
+
+        source.addEventListener('deleted', (e) => {
+            applyChanges({deleted: [JSON.parse(e.data).id]});
+            countMessages();
+        });
+
+        source.addEventListener('highlighted', (e) => {
+            applyChanges({highlighted: [JSON.parse(e.data)]});
+        });
+
+        source.addEventListener('closed', () => {
+            // L'esdeveniment ha acabat: no cal mantenir la connexió
+            source.close();
+            stopPolling();
+        });
+
+        source.addEventListener('error', () => {
+            // El navegador es reconnecta sol; mentrestant fem polling
+            if(source.readyState !== EventSource.CLOSED) startPolling();
+        });
+    }
+
+    // Els últims missatges ja arriben amb la pàgina: no cal demanar-los
+    const initial = document.getElementById('chat-initial');
+    if(initial) {
+        const data = JSON.parse(initial.textContent);
+        chatMessages.innerHTML = '';
+        if(data.counts) visibleCount = data.counts.visible;
+        appendMessages(data.messages, true);
+        cursor = data.cursor;
+        historyBefore = data.before;
+        countMessages();
+        scrollToBottom();
+    } else {
+        loadMessages();
+    }
+    // Només els directes reben missatges nous
+    if(eventId && chatContainer.dataset.status === 'live') subscribe();
 });
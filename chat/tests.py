@@ -1,3 +1,513 @@
-from django.test import TestCase
+from datetime import timedelta, timezone as dt_timezone
+from unittest import mock
 
-# Create your tests here.
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.test import SimpleTestCase, TestCase
+from django.urls import reverse
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from django.utils.timesince import timesince
+
+from events.models import Event
+from .models import ChatArchiveBlock, ChatMessage
+from .services import archive, counters, export, ratelimit, write_behind
+from .services.broker import KIND_CLOSED, KIND_MESSAGE, broker
+from .services.moderation import ModerationEngine
+from .services.fanout import MongoChangeStreamTransport, get_config
+from .services.recent import EventBuffer, recent_messages
+
+
+class ChatLoadMessagesQueriesTest(TestCase):
+    """
+    chat_load_messages no ha de fer una consulta per missatge (N+1):
+    el nombre de consultes no depèn de quants missatges ni autors hi ha
+    """
+
+    def setUp(self):
+        User = get_user_model()
+        self.creator = User.objects.create_user(username='creador', password='contrasenya123')
+        self.viewer = User.objects.create_user(username='visitant', password='contrasenya123')
+        self.authors = [
+            User.objects.create_user(username=f'autor{i}', password='contrasenya123', display_name=f'Autor {i}')
+            for i in range(10)
+        ]
+
+        self.event = Event.objects.create(
+            title='Concert de prova',
+            description='Esdeveniment de prova',
+            creator=self.creator,
+            category='music',
+            scheduled_date=timezone.now() - timedelta(hours=1),
+            status='finished',
+        )
+        recent_messages.evict(self.event.pk)
+
+        for i in range(50):
+            ChatMessage.objects.create(
+                event=self.event,
+                user=self.authors[i % len(self.authors)],
+                message=f'Missatge {i}',
+            )
+
+        self.client.force_login(self.viewer)
+        self.url = reverse('chat:load_messages', args=[self.event.pk])
+        cache.clear()
+
+    def test_first_load_queries(self):
+        # sessió + usuari, esdeveniment, arxiu (després a la memòria cau), missatges, autors
+        with self.assertNumQueries(6):
+            response = self.client.get(self.url)
+
+        data = response.json()
+        self.assertEqual(len(data['messages']), 50)
+        self.assertEqual(data['messages'][0]['display_name'], 'Autor 0')
+        self.assertFalse(any(message['can_delete'] for message in data['messages']))
+
+    def test_incremental_load_queries(self):
+        cursor = self.client.get(self.url).json()['cursor']
+        ChatMessage.objects.create(event=self.event, user=self.viewer, message='Nou')
+
+        # sessió + usuari, esdeveniment, missatges nous, canvis, autors
+        with self.assertNumQueries(6):
+            response = self.client.get(self.url, cursor)
+
+        data = response.json()
+        self.assertEqual([message['message'] for message in data['messages']], ['Nou'])
+        self.assertTrue(data['messages'][0]['can_delete'])
+
+    def test_live_event_served_from_memory(self):
+        self.event.status = 'live'
+        self.event.save()
+
+        self.client.get(self.url)
+
+        # Només sessió + usuari: els missatges surten del buffer en memòria
+        with self.assertNumQueries(2):
+            response = self.client.get(self.url)
+
+        self.assertEqual(len(response.json()['messages']), 50)
+
+    def test_unchanged_poll_returns_not_modified(self):
+        self.event.status = 'live'
+        self.event.save()
+
+        response = self.client.get(self.url)
+        etag = response['ETag']
+
+        # Sense canvis: 304 sense cap consulta
+        with self.assertNumQueries(0):
+            response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+
+        # Un missatge nou canvia la versió
+        self.client.post(reverse('chat:send_message', args=[self.event.pk]), {'message': 'Hola'})
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+
+    def test_repeated_incremental_poll_returns_not_modified(self):
+        self.event.status = 'live'
+        self.event.save()
+
+        cursor = self.client.get(self.url).json()['cursor']
+
+        # Sense canvis el cursor no canvia: el següent poll té la mateixa URL
+        response = self.client.get(self.url, cursor)
+        self.assertEqual(response.json()['cursor'], cursor)
+
+        response = self.client.get(self.url, cursor, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, 304)
+
+
+class LateMessagesTest(TestCase):
+    """
+    Amb diversos processos un missatge es pot desar després d'un altre amb id
+    més alt. El polling incremental no l'ha de perdre encara que el cursor
+    ja l'hagi deixat enrere.
+    """
+
+    def setUp(self):
+        User = get_user_model()
+        self.creator = User.objects.create_user(username='creador', password='contrasenya123')
+        self.event = Event.objects.create(
+            title='Concert de prova',
+            description='Esdeveniment de prova',
+            creator=self.creator,
+            category='music',
+            scheduled_date=timezone.now() - timedelta(hours=1),
+            status='finished',
+        )
+        recent_messages.evict(self.event.pk)
+        self.first = ChatMessage.objects.create(event=self.event, user=self.creator, message='Primer')
+
+        self.client.force_login(self.creator)
+        self.url = reverse('chat:load_messages', args=[self.event.pk])
+
+    def test_poll_returns_message_saved_late_with_lower_id(self):
+        cursor = self.client.get(self.url).json()['cursor']
+
+        # El procés B desa l'id 11; el client avança el cursor fins a 11
+        ChatMessage.objects.create(id=self.first.pk + 10, event=self.event, user=self.creator, message='B')
+        data = self.client.get(self.url, cursor).json()
+        self.assertEqual([message['message'] for message in data['messages']], ['B'])
+        cursor = data['cursor']
+
+        # El procés A desa ara l'id 5, reservat abans
+        ChatMessage.objects.create(id=self.first.pk + 5, event=self.event, user=self.creator, message='A')
+        data = self.client.get(self.url, cursor).json()
+        self.assertEqual([message['message'] for message in data['messages']], ['A'])
+
+    def test_buffer_returns_message_delivered_late_with_lower_id(self):
+        def payload(message_id):
+            return {
+                'id': message_id, 'user_id': 1, 'user': 'u', 'display_name': 'u',
+                'message': f'Missatge {message_id}', 'created_at': 'fa 0 minuts',
+                'timestamp': timezone.now().isoformat(), 'is_highlighted': False,
+            }
+
+        buffer = EventBuffer(self.event.pk, self.creator.pk)
+        buffer.load([payload(1)], complete=True)
+        # Com si el buffer existís fa estona: els cursors recents es poden respondre
+        buffer._changes_floor -= timedelta(minutes=1)
+
+        buffer.apply(KIND_MESSAGE, payload(11))
+        since = timezone.now()
+        messages, _, _ = buffer.changes_since(0, since, 50)
+        self.assertEqual([message['id'] for message in messages], [1, 11])
+
+        # Arriba desordenat d'un altre procés: el client amb cursor 11 també el rep
+        buffer.apply(KIND_MESSAGE, payload(5))
+        messages, _, _ = buffer.changes_since(11, since, 50)
+        self.assertEqual([message['id'] for message in messages], [5])
+
+
+class MongoFanoutPayloadTest(TestCase):
+    """
+    Els documents del change stream porten dates sense zona (UTC):
+    el payload ha de tenir la mateixa hora que _serialize_message
+    """
+
+    def test_change_stream_dates_are_utc(self):
+        user = get_user_model().objects.create_user(username='autor', password='contrasenya123')
+        created_at = timezone.now() - timedelta(minutes=3)
+
+        transport = MongoChangeStreamTransport(broker=None, config=get_config())
+        payload = transport._message_payload({
+            'id': 1,
+            'user_id': user.pk,
+            'message': 'Hola',
+            # Com el retorna pymongo sense tz_aware
+            'created_at': created_at.astimezone(dt_timezone.utc).replace(tzinfo=None),
+            'is_highlighted': False,
+        })
+
+        self.assertEqual(payload['created_at'], f'fa {timesince(created_at)}')
+        self.assertEqual(parse_datetime(payload['timestamp']), created_at)
+
+    def test_display_name_changes_are_picked_up(self):
+        user = get_user_model().objects.create_user(username='autor', password='contrasenya123', display_name='Abans')
+        transport = MongoChangeStreamTransport(broker=None, config=get_config())
+        now = [1000.0]
+
+        with mock.patch('chat.services.fanout.time.monotonic', lambda: now[0]):
+            self.assertEqual(transport._user_names(user.pk), ('autor', 'Abans'))
+
+            get_user_model().objects.filter(pk=user.pk).update(display_name='Després')
+            self.assertEqual(transport._user_names(user.pk), ('autor', 'Abans'))
+
+            now[0] += transport.USER_NAMES_TTL
+            self.assertEqual(transport._user_names(user.pk), ('autor', 'Després'))
+
+
+class ArchiveBlocksTest(TestCase):
+    """
+    L'arxiu es llegeix per blocs: les pàgines han de ser les mateixes que
+    les de la BD
+    """
+
+    def setUp(self):
+        cache.clear()
+        self.addCleanup(cache.clear)
+
+        user = get_user_model().objects.create_user(username='autor', password='contrasenya123')
+        self.event = Event.objects.create(
+            title='Concert arxivat',
+            description='Esdeveniment de prova',
+            creator=user,
+            category='music',
+            scheduled_date=timezone.now() - timedelta(days=60),
+            status='finished',
+        )
+        for i in range(30):
+            ChatMessage.objects.create(event=self.event, user=user, message=f'Missatge {i}', is_deleted=i % 9 == 0)
+        self.visible_ids = list(
+            ChatMessage.objects.filter(event=self.event, is_deleted=False).order_by('id').values_list('id', flat=True)
+        )
+
+    def test_pages_read_from_blocks(self):
+        with mock.patch.object(archive, 'ARCHIVE_BLOCK_SIZE', 4):
+            archive.archive_event(self.event.pk)
+            self.assertFalse(ChatMessage.objects.filter(event=self.event).exists())
+            self.assertTrue(archive.is_archived(self.event.pk))
+
+            latest = archive.latest_payloads(self.event.pk, 5)
+            self.assertEqual([payload['id'] for payload in latest], self.visible_ids[-5:])
+
+            # Recorre tot l'historial pàgina a pàgina
+            before, pages = latest[0]['id'], []
+            while before is not None:
+                page, has_more = archive.payloads_before(self.event.pk, before, 5)
+                pages = [payload['id'] for payload in page] + pages
+                before = page[0]['id'] if has_more else None
+            self.assertEqual(pages + [payload['id'] for payload in latest], self.visible_ids)
+
+            # L'exportació recorre tots els blocs
+            exported = b''.join(export.export_chunks(self.event.pk)).decode('utf-8').splitlines()
+            self.assertEqual(len(exported), len(self.visible_ids))
+
+    def test_archive_goes_with_the_event(self):
+        archive.archive_event(self.event.pk)
+        self.event.delete()
+        self.assertFalse(ChatArchiveBlock.objects.exists())
+        self.assertFalse(archive.is_archived(self.event.pk))
+
+
+class ConcurrentModerationTest(TestCase):
+    """
+    Dues peticions que eliminen o destaquen el mateix missatge alhora
+    només han de canviar els comptadors una vegada
+    """
+
+    def setUp(self):
+        self.creator = get_user_model().objects.create_user(username='creador', password='contrasenya123')
+        self.event = Event.objects.create(
+            title='Concert de prova',
+            description='Esdeveniment de prova',
+            creator=self.creator,
+            category='music',
+            scheduled_date=timezone.now() - timedelta(hours=1),
+            status='live',
+        )
+        self.message = ChatMessage.objects.create(event=self.event, user=self.creator, message='Hola')
+        self.client.force_login(self.creator)
+
+    def stale_message(self):
+        # La còpia que havia llegit l'altra petició abans del canvi
+        return ChatMessage.objects.get(pk=self.message.pk)
+
+    def test_concurrent_delete_counts_once(self):
+        stale = self.stale_message()
+        ChatMessage.objects.filter(pk=self.message.pk).update(is_deleted=True)
+
+        with mock.patch('chat.views._get_message_or_404', return_value=stale), \
+                mock.patch('chat.views.counters.message_deleted') as message_deleted:
+            response = self.client.post(reverse('chat:delete_message', args=[self.message.pk]))
+
+        self.assertTrue(response.json()['success'])
+        message_deleted.assert_not_called()
+
+    def test_concurrent_toggle_counts_once(self):
+        stale = self.stale_message()
+        ChatMessage.objects.filter(pk=self.message.pk).update(is_highlighted=True)
+
+        with mock.patch('chat.views._get_message_or_404', return_value=stale), \
+                mock.patch('chat.views.counters.message_highlighted') as message_highlighted:
+            response = self.client.post(reverse('chat:toggle_highlight', args=[self.message.pk]))
+
+        self.assertTrue(response.json()['is_highlighted'])
+        message_highlighted.assert_not_called()
+        self.assertTrue(ChatMessage.objects.get(pk=self.message.pk).is_highlighted)
+
+
+class RateLimitTest(TestCase):
+    """
+    Un missatge rebutjat per un bucket no ha de gastar el token de l'altre
+    """
+
+    LIMITS = {'USER_RATE': 0.001, 'USER_BURST': 2, 'EVENT_RATE': 0.001, 'EVENT_BURST': 1}
+
+    def setUp(self):
+        cache.clear()
+        patcher = mock.patch.dict(ratelimit._backends, {'memory': ratelimit.MemoryBuckets()})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def assert_rejection_keeps_user_token(self):
+        self.assertEqual(ratelimit.check_send(1, 10, None), 0)
+        # L'esdeveniment 10 ja no té tokens: es rebutja sense tocar el bucket de l'usuari
+        self.assertGreater(ratelimit.check_send(1, 10, None), 0)
+        self.assertEqual(ratelimit.check_send(1, 20, None), 0)
+        # Ara és l'usuari qui no en té: l'esdeveniment 30 conserva el seu
+        self.assertGreater(ratelimit.check_send(1, 30, None), 0)
+        self.assertEqual(ratelimit.check_send(2, 30, None), 0)
+
+    def test_memory_backend(self):
+        with self.settings(CHAT_RATE_LIMITS={**self.LIMITS, 'BACKEND': 'memory'}):
+            self.assert_rejection_keeps_user_token()
+
+    def test_cache_backend(self):
+        with self.settings(CHAT_RATE_LIMITS={**self.LIMITS, 'BACKEND': 'cache'}):
+            self.assert_rejection_keeps_user_token()
+
+
+class ModerationEngineTest(SimpleTestCase):
+    """
+    Lèxic compilat: límits de paraula, accents, prefixos i termes de diverses paraules
+    """
+
+    def setUp(self):
+        self.engine = ModerationEngine(terms=['tonto', 'mierda', 'idiot*', 'hijo de puta', 'f*ck'])
+
+    def test_word_boundaries(self):
+        self.assertEqual(self.engine.find('Ets un tonto!'), 'tonto')
+        self.assertIsNone(self.engine.find('Quina tontería'))
+        self.assertIsNone(self.engine.find('atonto'))
+
+    def test_accent_and_case_folding(self):
+        self.assertEqual(self.engine.find('MIERDÁ de concert'), 'mierda')
+
+    def test_prefix_terms(self):
+        self.assertEqual(self.engine.find('quins idiotes'), 'idiotes')
+        self.assertEqual(self.engine.find('idiot'), 'idiot')
+        self.assertIsNone(self.engine.find('idio'))
+
+    def test_asterisk_inside_term_is_literal(self):
+        self.assertEqual(self.engine.find('quin F*CK'), 'f*ck')
+        self.assertIsNone(self.engine.find('fantastic concert'))
+        self.assertIsNone(self.engine.find('fuck'))
+
+    def test_multi_word_terms(self):
+        self.assertEqual(self.engine.find('hijo   de\nputa'), 'hijo   de\nputa')
+        self.assertIsNone(self.engine.find('hijo de putas'))
+        self.assertIsNone(self.engine.find('hijo de'))
+
+
+class SendToClosedEventTest(TestCase):
+    """
+    Un esdeveniment tancat des d'un altre procés (sense avís KIND_CLOSED en
+    aquest) deixa d'acceptar missatges encara que hi hagi buffer en memòria
+    """
+
+    def setUp(self):
+        cache.clear()
+        self.user = get_user_model().objects.create_user(username='espectador', password='contrasenya123')
+        self.event = Event.objects.create(
+            title='Concert de prova',
+            description='Esdeveniment de prova',
+            creator=self.user,
+            category='music',
+            scheduled_date=timezone.now() - timedelta(hours=1),
+            status='live',
+        )
+        self.client.force_login(self.user)
+        self.url = reverse('chat:send_message', args=[self.event.pk])
+        self.addCleanup(recent_messages.evict, self.event.pk)
+
+    def test_rejects_after_status_changes_elsewhere(self):
+        self.assertTrue(self.client.post(self.url, {'message': 'Hola'}).json()['success'])
+        self.assertIsNotNone(recent_messages.get(self.event.pk))
+
+        # Com update_event_statuses en un altre procés: cap signal en aquest
+        Event.objects.filter(pk=self.event.pk).update(status='finished')
+        cache.clear()
+
+        response = self.client.post(self.url, {'message': 'Encara hi ets?'})
+        self.assertEqual(response.status_code, 400)
+        self.assertIsNone(recent_messages.get(self.event.pk))
+
+
+class ChatStreamTest(TestCase):
+    """
+    La connexió SSE només es manté mentre l'esdeveniment és en directe
+    """
+
+    def setUp(self):
+        self.user = get_user_model().objects.create_user(username='espectador', password='contrasenya123')
+        self.event = Event.objects.create(
+            title='Concert de prova',
+            description='Esdeveniment de prova',
+            creator=self.user,
+            category='music',
+            scheduled_date=timezone.now() - timedelta(hours=1),
+            status='live',
+        )
+        self.url = reverse('chat:stream', args=[self.event.pk])
+
+    def test_not_live_event_has_no_stream(self):
+        Event.objects.filter(pk=self.event.pk).update(status='finished')
+        self.assertEqual(self.client.get(self.url).status_code, 204)
+
+    def test_stream_ends_when_event_closes(self):
+        response = self.client.get(self.url)
+        chunks = iter(response.streaming_content)
+        self.assertIn(b'retry:', next(chunks))
+
+        broker.publish(self.event.pk, KIND_CLOSED, {'id': self.event.pk})
+        self.assertTrue(next(chunks).startswith(b'event: closed'))
+        self.assertIsNone(next(chunks, None))
+
+
+class IdAllocatorTest(SimpleTestCase):
+    """
+    Els blocs d'ids es reserven de tant en tant, però caduquen als ID_BLOCK_TTL segons
+    """
+
+    def setUp(self):
+        self.now = 1000.0
+        self.seq = 0
+        self.allocator = write_behind.IdAllocator('chat_chatmessage', block_size=10, block_ttl=0.05)
+
+        def reserve():
+            # Com el $inc de __schema__: un altre procés pot haver reservat entremig
+            self.seq += self.allocator.block_size
+            self.allocator._last = self.seq
+            self.allocator._next = self.seq - self.allocator.block_size + 1
+
+        patchers = [
+            mock.patch.object(self.allocator, '_reserve', side_effect=reserve),
+            mock.patch.object(write_behind.time, 'monotonic', lambda: self.now),
+        ]
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_one_reservation_per_block(self):
+        ids = [self.allocator.next_id() for _ in range(25)]
+        self.assertEqual(ids, list(range(1, 26)))
+        self.assertEqual(self.allocator._reserve.call_count, 3)
+
+    def test_block_expires(self):
+        self.assertEqual(self.allocator.next_id(), 1)
+        self.seq += 10  # Un altre procés reserva 11-20
+
+        self.now += 0.05
+        # La resta del bloc (2-10) es descarta: l'id segueix l'ordre d'enviament
+        self.assertEqual(self.allocator.next_id(), 21)
+        self.assertEqual(self.allocator._reserve.call_count, 2)
+
+
+class BatchCountersTest(SimpleTestCase):
+    """
+    Els comptadors d'un lot write-behind: un $inc per esdeveniment
+    """
+
+    def test_messages_sent_groups_by_event(self):
+        seen = set()
+        collection = mock.Mock()
+
+        def upsert(query, update, upsert):
+            new = query['_id'] not in seen
+            seen.add(query['_id'])
+            return mock.Mock(upserted_id=query['_id'] if new else None)
+
+        collection.update_one.side_effect = upsert
+        with mock.patch.object(counters, 'enabled', return_value=True), \
+                mock.patch.object(counters, '_collection', return_value=collection), \
+                mock.patch.object(counters, '_inc') as inc:
+            counters.messages_sent([(1, 10), (1, 10), (1, 11), (2, 10)])
+
+        inc.assert_has_calls([
+            mock.call(1, total=3, visible=3, chatters=2),
+            mock.call(2, total=1, visible=1, chatters=1),
+        ])
+        self.assertEqual(inc.call_count, 2)
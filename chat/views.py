@@ -1,44 +1,127 @@
 # Create your views here.
-from django.http import JsonResponse
+import hashlib
+import json
+import math
+import queue
+
+from django.conf import settings
+from django.core.cache import cache
+
+from django.db.models import Q
+from django.http import HttpResponse, JsonResponse, StreamingHttpResponse
 from django.shortcuts import get_object_or_404
+from django.contrib.auth import get_user_model
 from django.contrib.auth.decorators import login_required
-from django.views.decorators.http import require_POST
+from django.views.decorators.cache import cache_control
+from django.views.decorators.http import require_POST, condition
+from django.views.decorators.vary import vary_on_cookie
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
 from events.models import Event
 from .models import ChatMessage
 from .forms import ChatMessageForm
+from .services.broker import broker, KIND_MESSAGE, KIND_DELETED, KIND_HIGHLIGHTED, KIND_CLOSED
+from .services.recent import recent_messages, RING_SIZE
+from .services.versions import get_chat_version
+from .services import archive, counters, ratelimit, write_behind
+from .services.export import FORMATS, export_chunks, export_filename
+
+# Màxim de missatges per resposta de chat_load_messages
+MAX_MESSAGES = 50
+
+# Missatges antics per pàgina de chat_history
+HISTORY_PAGE_SIZE = 50
+
+# Segons entre comentaris keep-alive de l'SSE (mantenen viva la connexió
+# i permeten detectar clients desconnectats)
+SSE_KEEPALIVE_SECONDS = 15
+
+# Segons que es recorda (a la memòria cau) que un esdeveniment és en directe.
+# L'avís KIND_CLOSED pot no arribar a aquest procés (p. ex. update_event_statuses
+# s'executa en un altre procés i el fan-out és 'local'): com a molt durant
+# aquest temps s'accepten missatges d'un esdeveniment que ja ha acabat.
+LIVE_STATUS_TTL = 5
+
 
+def live_status_key(event_pk):
+    return f'chat:live:{event_pk}'
+
+
+def _is_live(event_pk):
+    """
+    Cert si l'esdeveniment és en directe. Consulta la BD com a molt un cop
+    cada LIVE_STATUS_TTL segons (per procés, o per a tots si la memòria cau
+    és compartida).
+    """
+    key = live_status_key(event_pk)
+    live = cache.get(key)
+    if live is None:
+        live = Event.objects.filter(pk=event_pk, status='live').exists()
+        cache.set(key, live, LIVE_STATUS_TTL)
+    return live
+
+
+def _not_live_response():
+    return JsonResponse(
+        {'success': False, 'error': 'L\'esdeveniment no està en directe.'},
+        status=400
+    )
 
 
 @login_required
 @require_POST
 def chat_send_message(request, event_pk):
-    event = get_object_or_404(Event, pk=event_pk)
+    # Si l'esdeveniment és en directe ja el tenim en memòria: només cal
+    # comprovar l'estat (guardat a la memòria cau uns segons)
+    buffer = recent_messages.get(event_pk)
+    if buffer is not None:
+        if not _is_live(event_pk):
+            recent_messages.evict(event_pk)
+            return _not_live_response()
+        creator_id = buffer.creator_id
+    else:
+        event = get_object_or_404(Event, pk=event_pk)
 
-    if event.status != 'live':
-        return JsonResponse(
-            {'success': False, 'error': 'L\'esdeveniment no està en directe.'},
-            status=400
+        if event.status != 'live':
+            return _not_live_response()
+
+        creator_id = event.creator_id
+        _live_buffer(event)
+
+    # Límit de missatges per usuari i per esdeveniment, abans de validar i desar
+    wait = ratelimit.check_send(request.user.pk, event_pk, creator_id)
+    if wait:
+        retry_after = math.ceil(wait)
+        response = JsonResponse(
+            {
+                'success': False,
+                'error': f'Estàs enviant massa missatges. Torna-ho a provar d\'aquí a {retry_after} s.'
+            },
+            status=429
         )
+        response['Retry-After'] = str(retry_after)
+        return response
 
     form = ChatMessageForm(request.POST)
 
     if form.is_valid():
         message = form.save(commit=False)
         message.user = request.user
-        message.event = event
-        message.save()
+        message.event_id = event_pk
+
+        if write_behind.enabled():
+            # Es desa (i es compta) en segon pla per lots; l'id ja està assignat
+            write_behind.save(message)
+        else:
+            message.save()
+            counters.message_sent(event_pk, request.user.pk)
+
+        payload = _serialize_message(message, request.user)
+        broker.publish(event_pk, KIND_MESSAGE, payload)
 
         return JsonResponse({
             'success': True,
-            'message': {
-                'id': message.id,
-                'user': message.user.username,
-                'display_name': message.get_user_display_name(),
-                'message': message.message,
-                'created_at': message.get_time_since(),
-                'can_delete': message.can_delete(request.user),
-                'is_highlighted': message.is_highlighted,
-            }
+            'message': payload,
         })
 
     return JsonResponse(
@@ -46,46 +129,363 @@ def chat_send_message(request, event_pk):
         status=400
     )
 
+
+def _get_message_or_404(message_pk):
+    """
+    Com get_object_or_404, però té en compte els missatges encara pendents
+    d'escriure en mode write-behind
+    """
+    write_behind.ensure_saved(message_pk)
+    return get_object_or_404(ChatMessage, pk=message_pk)
+
+
+def _update_if(message, expected, **changes):
+    """
+    Desa `changes` només si a la BD el missatge encara té els valors `expected`
+    (una sola actualització condicional). Retorna cert si aquesta petició l'ha
+    canviat; si no, recarrega els valors actuals al missatge.
+    """
+    updated = ChatMessage.objects.filter(pk=message.pk, **expected).update(
+        updated_at=timezone.now(), **changes
+    )
+    if updated:
+        for field, value in changes.items():
+            setattr(message, field, value)
+    else:
+        message.refresh_from_db(fields=['is_deleted', 'is_highlighted'])
+    return updated == 1
+
+
+def _serialize_message(msg, user):
+    """
+    Converteix un missatge al format JSON que espera chat.js.
+    Amb user=None, can_delete queda a False (payload compartit entre visitants).
+    """
+    return {
+        'id': msg.id,
+        'user_id': msg.user_id,
+        'user': msg.user.username,
+        'display_name': msg.get_user_display_name(),
+        'message': msg.message,
+        'created_at': msg.get_time_since(),
+        'timestamp': msg.created_at.isoformat(),
+        'can_delete': msg.can_delete(user) if user is not None and user.is_authenticated else False,
+        'is_highlighted': msg.is_highlighted,
+    }
+
+
+def _serialize_messages(messages, user, creator_id):
+    """
+    Serialitza una llista de missatges amb una sola consulta per als autors.
+    can_delete es calcula amb creator_id, sense carregar l'esdeveniment.
+    Amb user=None, can_delete queda a False (payloads compartits entre visitants).
+    """
+    user_ids = {msg.user_id for msg in messages}
+    if user_ids:
+        authors = get_user_model().objects.filter(id__in=user_ids).only('id', 'username', 'display_name')
+        authors = {author.pk: author for author in authors}
+        for msg in messages:
+            if msg.user_id in authors:
+                # Evita la consulta de msg.user a _serialize_message
+                msg.user = authors[msg.user_id]
+
+    payloads = [_serialize_message(msg, None) for msg in messages]
+    if user is None:
+        return payloads
+    return _with_can_delete(payloads, user, creator_id)
+
+
+def _with_can_delete(payloads, user, creator_id):
+    """
+    Afegeix can_delete per al visitant als payloads compartits del buffer
+    """
+    viewer_id = user.pk if user.is_authenticated else None
+    viewer_is_staff = user.is_authenticated and user.is_staff
+
+    for payload in payloads:
+        payload['can_delete'] = viewer_id is not None and (
+            viewer_is_staff
+            or viewer_id == payload['user_id']
+            or viewer_id == creator_id
+        )
+    return payloads
+
+
+def _live_buffer(event):
+    """
+    Buffer de missatges recents d'un esdeveniment en directe.
+    El primer cop l'omple des de la BD. Retorna None si encara s'està omplint.
+    """
+    buffer, created = recent_messages.get_or_create(event.pk, event.creator_id)
+    if created:
+        latest = list(
+            ChatMessage.objects.filter(event_id=event.pk, is_deleted=False).order_by('-id')[:RING_SIZE]
+        )
+        latest.reverse()
+        buffer.load(_serialize_messages(latest, None, event.creator_id), complete=len(latest) < RING_SIZE)
+    return buffer if buffer.loaded else None
+
+
+def get_recent_messages(event, user, limit=MAX_MESSAGES):
+    """
+    Últims missatges visibles d'un esdeveniment, en ordre cronològic.
+    Si l'esdeveniment és en directe surten de memòria.
+    """
+    if event.status == 'live':
+        buffer = _live_buffer(event)
+        messages_list = buffer.snapshot(limit) if buffer is not None else None
+        if messages_list is not None:
+            return _with_can_delete(messages_list, user, event.creator_id)
+
+    if event.status in archive.ARCHIVABLE_STATUSES and archive.is_archived(event.pk):
+        return archive.latest_payloads(event.pk, limit)
+
+    latest = list(
+        ChatMessage.objects.filter(event_id=event.pk, is_deleted=False).order_by('-id')[:limit]
+    )
+    latest.reverse()
+    return _serialize_messages(latest, user, event.creator_id)
+
+
+def get_initial_chat(event, user):
+    """
+    Dades inicials del xat per pintar-les amb la pàgina de l'esdeveniment:
+    últims missatges, cursor del polling incremental i cursor de l'historial
+    (`before`, None si no hi ha missatges més antics), i els comptadors del xat
+    """
+    now = timezone.now()
+    messages_list = get_recent_messages(event, user)
+
+    return {
+        'messages': messages_list,
+        'cursor': {
+            'after': messages_list[-1]['id'] if messages_list else 0,
+            'since': now.isoformat(),
+        },
+        'before': messages_list[0]['id'] if len(messages_list) >= MAX_MESSAGES else None,
+        'counts': counters.get_counts(event.pk),
+    }
+
+
+def chat_history(request, event_pk):
+    """
+    Missatges més antics que ?before=<id>, en ordre cronològic.
+    Paginació per id (keyset): el cost no depèn de la mida del xat.
+    """
+    before = request.GET.get('before', '')
+    if not before.isdigit():
+        return JsonResponse({'error': 'Falta el paràmetre before.'}, status=400)
+
+    buffer = recent_messages.get(event_pk)
+    if buffer is not None:
+        creator_id = buffer.creator_id
+    else:
+        event = get_object_or_404(Event, pk=event_pk)
+        creator_id = event.creator_id
+
+        if event.status in archive.ARCHIVABLE_STATUSES and archive.is_archived(event_pk):
+            messages_list, has_more = archive.payloads_before(event_pk, int(before), HISTORY_PAGE_SIZE)
+            return JsonResponse({
+                'messages': messages_list,
+                'before': messages_list[0]['id'] if has_more else None,
+            })
+
+    # Un de més per saber si encara en queden
+    older = list(
+        ChatMessage.objects.filter(event_id=event_pk, is_deleted=False, id__lt=int(before))
+        .order_by('-id')[:HISTORY_PAGE_SIZE + 1]
+    )
+    has_more = len(older) > HISTORY_PAGE_SIZE
+    older = older[:HISTORY_PAGE_SIZE]
+    older.reverse()
+
+    messages_list = _serialize_messages(older, request.user, creator_id)
+
+    return JsonResponse({
+        'messages': messages_list,
+        'before': messages_list[0]['id'] if has_more else None,
+    })
+
+
+def _chat_etag(request, event_pk):
+    """
+    ETag de chat_load_messages: versió del xat + visitant.
+    El visitant s'identifica amb la cookie de sessió (no amb request.user)
+    perquè respondre 304 no necessiti cap consulta.
+    """
+    session_key = request.COOKIES.get(settings.SESSION_COOKIE_NAME, '')
+    viewer = hashlib.sha1(session_key.encode()).hexdigest()[:12]
+    return f'{get_chat_version(event_pk)}-{viewer}'
+
+
+def _poll_cursor(request, messages_list, changed, now):
+    """
+    Cursor de la resposta a un poll incremental. Si no hi ha res de nou es
+    retorna el mateix cursor que ha enviat el client: així la URL del
+    següent poll és la mateixa i el navegador pot enviar If-None-Match
+    (i rebre un 304) mentre el xat no canviï.
+    """
+    if not messages_list and not changed:
+        return {'after': int(request.GET['after']), 'since': request.GET['since']}
+    return {
+        'after': messages_list[-1]['id'] if messages_list else int(request.GET['after']),
+        'since': now.isoformat(),
+    }
+
+
+@cache_control(no_cache=True)
+@vary_on_cookie
+@condition(etag_func=_chat_etag)
 def chat_load_messages(request, event_pk):
-    event = get_object_or_404(Event, pk=event_pk)
+    """
+    Retorna els missatges del xat d'un esdeveniment.
+
+    Sense paràmetres retorna els últims MAX_MESSAGES missatges visibles.
+    Amb ?after=<id>&since=<data> (el cursor de la resposta anterior) només retorna
+    els missatges nous, els ids eliminats i els canvis de destacat des d'aleshores,
+    de manera que la majoria de consultes tornen llistes buides.
+
+    Si l'esdeveniment és en directe, es respon des del buffer en memòria
+    (chat/services/recent.py) sense consultar la BD. Si el xat no ha canviat
+    des de l'última resposta (If-None-Match), es respon 304.
+    """
+    # Agafem l'hora abans de consultar: el que canviï mentre consultem
+    # sortirà a la següent consulta (repetir un canvi no fa mal al client)
+    now = timezone.now()
+
+    after = request.GET.get('after')
+    since = parse_datetime(request.GET.get('since') or '')
+    incremental = after is not None and after.isdigit() and since is not None
+
+    buffer = recent_messages.get(event_pk)
+    if buffer is not None:
+        creator_id = buffer.creator_id
+    else:
+        event = get_object_or_404(Event, pk=event_pk)
+        creator_id = event.creator_id
+        if event.status == 'live':
+            buffer = _live_buffer(event)
 
-    all_messages = ChatMessage.objects.filter(event=event).order_by('created_at')[:50]
+    if buffer is not None:
+        if incremental:
+            changes = buffer.changes_since(int(after), since, MAX_MESSAGES)
+            if changes is not None:
+                messages_list, deleted, highlighted = changes
+                messages_list = _with_can_delete(messages_list, request.user, creator_id)
+                return JsonResponse({
+                    'messages': messages_list,
+                    'deleted': deleted,
+                    'highlighted': highlighted,
+                    'cursor': _poll_cursor(request, messages_list, deleted or highlighted, now),
+                })
+        else:
+            messages_list = buffer.snapshot(MAX_MESSAGES)
+            if messages_list is not None:
+                messages_list = _with_can_delete(messages_list, request.user, creator_id)
+                return JsonResponse({
+                    'messages': messages_list,
+                    'cursor': {
+                        'after': messages_list[-1]['id'] if messages_list else 0,
+                        'since': now.isoformat(),
+                    },
+                })
+            # Massa eliminacions: el tornarem a omplir a la següent consulta
+            recent_messages.evict(event_pk)
 
-    messages_list = []
+    if buffer is None and event.status in archive.ARCHIVABLE_STATUSES and archive.is_archived(event_pk):
+        # Xat arxivat: ja no canvia, només cal la primera càrrega
+        if incremental:
+            messages_list = []
+            cursor = _poll_cursor(request, messages_list, False, now)
+        else:
+            messages_list = archive.latest_payloads(event_pk, MAX_MESSAGES)
+            cursor = {'after': messages_list[-1]['id'] if messages_list else 0, 'since': now.isoformat()}
+        return JsonResponse({
+            'messages': messages_list,
+            'deleted': [],
+            'highlighted': [],
+            'cursor': cursor,
+        })
+
+    if incremental:
+        after = int(after)
+
+        # Missatges ja enviats al client que s'han eliminat o (des)destacat
+        changed = ChatMessage.objects.filter(
+            event_id=event_pk, id__lte=after, updated_at__gte=since
+        ).values('id', 'is_deleted', 'is_highlighted', 'created_at')
+
+        deleted = []
+        highlighted = []
+        late_ids = []
+        for change in changed:
+            if change['is_deleted']:
+                deleted.append(change['id'])
+                continue
+            highlighted.append({'id': change['id'], 'is_highlighted': change['is_highlighted']})
+            if change['created_at'] >= since:
+                # Id més baix que el cursor però desat després de l'últim poll
+                # (un altre procés o el write-behind l'han escrit tard).
+                # Compara rellotges de processos diferents: cal que estiguin sincronitzats (NTP)
+                late_ids.append(change['id'])
+
+        new_messages = list(
+            ChatMessage.objects.filter(
+                Q(id__gt=after) | Q(id__in=late_ids), event_id=event_pk, is_deleted=False
+            ).order_by('id')[:MAX_MESSAGES]
+        )
 
-    for msg in all_messages:
-        if msg.is_deleted:  # filtrar en Python
-            continue
+        messages_list = _serialize_messages(new_messages, request.user, creator_id)
 
-        messages_list.append({
-            'id': msg.id,
-            'user': msg.user.username,
-            'display_name': msg.get_user_display_name(),
-            'message': msg.message,
-            'created_at': msg.get_time_since(),
-            'can_delete': msg.can_delete(request.user) if request.user.is_authenticated else False,
-            'is_highlighted': msg.is_highlighted,
+        return JsonResponse({
+            'messages': messages_list,
+            'deleted': deleted,
+            'highlighted': highlighted,
+            'cursor': _poll_cursor(request, messages_list, deleted or highlighted, now),
         })
 
-    return JsonResponse({'messages': messages_list})
+    # Primera càrrega: els últims missatges, en ordre cronològic
+    latest = list(
+        ChatMessage.objects.filter(event_id=event_pk, is_deleted=False).order_by('-id')[:MAX_MESSAGES]
+    )
+    latest.reverse()
+
+    messages_list = _serialize_messages(latest, request.user, creator_id)
+    last_id = messages_list[-1]['id'] if messages_list else 0
+
+    return JsonResponse({
+        'messages': messages_list,
+        'cursor': {'after': last_id, 'since': now.isoformat()},
+    })
 
 @login_required
 @require_POST
 def chat_delete_message(request, message_pk):
-    message = get_object_or_404(ChatMessage, pk=message_pk)
+    message = _get_message_or_404(message_pk)
 
     if not message.can_delete(request.user):
         return JsonResponse({'success': False, 'error': 'No tens permisos per eliminar aquest missatge.'}, status=403)
 
-    message.is_deleted = True
-    message.save()
+    # Si dues peticions l'eliminen alhora (o el destaquen mentrestant) només una el compta
+    for _ in range(3):
+        if message.is_deleted:
+            return JsonResponse({'success': True})
+        was_highlighted = message.is_highlighted
+        if _update_if(message, {'is_deleted': False, 'is_highlighted': was_highlighted}, is_deleted=True):
+            break
+    else:
+        return JsonResponse({'success': False, 'error': 'El missatge està canviant. Torna-ho a provar.'}, status=409)
+
+    counters.message_deleted(message.event_id, was_highlighted)
+
+    broker.publish(message.event_id, KIND_DELETED, {'id': message.id})
 
     return JsonResponse({'success': True})
 
 @login_required
 @require_POST
 def chat_toggle_highlight(request, message_pk):
-    message = get_object_or_404(ChatMessage, pk=message_pk)
+    message = _get_message_or_404(message_pk)
     event = message.event
 
     if request.user != event.creator:
@@ -97,10 +497,107 @@ def chat_toggle_highlight(request, message_pk):
             status=403
         )
 
-    message.is_highlighted = not message.is_highlighted
-    message.save()
+    # Només canvia si ningú l'ha canviat mentrestant: si dues peticions el
+    # commuten alhora, la segona respon l'estat actual sense tornar-lo a canviar
+    current = {'is_highlighted': message.is_highlighted, 'is_deleted': message.is_deleted}
+    if not _update_if(message, current, is_highlighted=not message.is_highlighted):
+        return JsonResponse({'success': True, 'is_highlighted': message.is_highlighted})
+
+    if not message.is_deleted:
+        counters.message_highlighted(event.pk, message.is_highlighted)
+
+    broker.publish(event.pk, KIND_HIGHLIGHTED, {
+        'id': message.id,
+        'is_highlighted': message.is_highlighted,
+    })
 
     return JsonResponse({
         'success': True,
         'is_highlighted': message.is_highlighted
     })
+
+
+def chat_stream(request, event_pk):
+    """
+    Subscripció Server-Sent Events al xat d'un esdeveniment.
+
+    Envia en temps real els missatges nous (event: message), els eliminats
+    (event: deleted) i els canvis de destacat (event: highlighted).
+    Cada connexió oberta ocupa un fil del servidor mentre dura: quan
+    l'esdeveniment deixa d'estar en directe s'envia event: closed i es tanca.
+    """
+    event = get_object_or_404(Event, pk=event_pk)
+
+    # Un 204 fa que el navegador deixi de reconnectar-se
+    if event.status != 'live':
+        return HttpResponse(status=204)
+
+    # Dades del visitant per calcular can_delete de cada missatge,
+    # agafades abans d'entrar al generador
+    viewer_id = request.user.pk if request.user.is_authenticated else None
+    viewer_is_staff = request.user.is_authenticated and request.user.is_staff
+    creator_id = event.creator_id
+
+    def event_stream():
+        subscription = broker.subscribe(event.pk)
+        try:
+            # Temps de reconnexió del navegador si es talla la connexió
+            yield 'retry: 3000\n\n'
+
+            while True:
+                try:
+                    kind, payload = subscription.get(timeout=SSE_KEEPALIVE_SECONDS)
+                except queue.Empty:
+                    yield ': keepalive\n\n'
+                    continue
+
+                if kind is None:
+                    # Subscripció tancada: el navegador es reconnectarà
+                    return
+
+                if kind == KIND_MESSAGE:
+                    payload = dict(payload)
+                    payload['can_delete'] = viewer_id is not None and (
+                        viewer_is_staff
+                        or viewer_id == payload['user_id']
+                        or viewer_id == creator_id
+                    )
+
+                yield f'event: {kind}\ndata: {json.dumps(payload)}\n\n'
+
+                if kind == KIND_CLOSED:
+                    # L'esdeveniment ha acabat: alliberem el fil
+                    return
+        finally:
+            broker.unsubscribe(subscription)
+
+    response = StreamingHttpResponse(event_stream(), content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'
+    return response
+
+
+@login_required
+def chat_export(request, event_pk):
+    """
+    Descarrega el xat complet d'un esdeveniment (creador o staff).
+    ?format=ndjson|csv i ?gzip=1 per comprimir-lo al vol.
+    Es genera per lots mentre s'envia: la memòria no depèn de la mida del xat.
+    """
+    event = get_object_or_404(Event, pk=event_pk)
+
+    if not (request.user.is_staff or request.user.pk == event.creator_id):
+        return JsonResponse({'success': False, 'error': 'No tens permisos per exportar aquest xat.'}, status=403)
+
+    export_format = request.GET.get('format', 'ndjson')
+    if export_format not in FORMATS:
+        return JsonResponse({'success': False, 'error': 'Format no vàlid (ndjson o csv).'}, status=400)
+
+    compress = request.GET.get('gzip') in ('1', 'true')
+
+    response = StreamingHttpResponse(
+        export_chunks(event.pk, export_format, compress),
+        content_type='application/gzip' if compress else FORMATS[export_format]
+    )
+    response['Content-Disposition'] = f'attachment; filename="{export_filename(event.pk, export_format, compress)}"'
+    return response
@@ -114,3 +114,30 @@ MEDIA_ROOT = BASE_DIR / 'media'
 # CSRF_COOKIE_SECURE = True  # MOD
 # SESSION_COOKIE_SECURE = True  # MOD
 # SECURE_HSTS_SECONDS = 3600  # MOD
+
+# Fan-out del xat en directe entre processos (chat/services/fanout.py).
+# 'local' per a un sol worker; 'multicast' o 'mongo' (change streams, cal replica set)
+# quan hi ha diversos workers o servidors
+CHAT_FANOUT = {
+    'BACKEND': os.environ.get('CHAT_FANOUT_BACKEND', 'local'),
+    'MULTICAST_GROUP': '239.255.42.99',
+    'MULTICAST_PORT': 42099,
+}
+
+# Escriptura diferida dels missatges del xat (chat/services/write_behind.py):
+# els missatges es publiquen a l'instant i es desen per lots. Només amb djongo
+CHAT_WRITE_BEHIND = os.environ.get('CHAT_WRITE_BEHIND', '0') == '1'
+
+# Límits d'enviament del xat amb token buckets (chat/services/ratelimit.py).
+# 'CREATORS' permet límits propis pels esdeveniments d'un creador: {id_creador: {...}}
+CHAT_RATE_LIMITS = {
+    'BACKEND': 'memory',
+    'USER_RATE': 1.0,
+    'USER_BURST': 5,
+    'EVENT_RATE': 20.0,
+    'EVENT_BURST': 60,
+    'CREATORS': {},
+}
+
+# Lèxic de paraules prohibides del xat (chat/services/moderation.py), es recarrega en calent
+CHAT_MODERATION_LEXICON = BASE_DIR / 'chat' / 'lexicon' / 'forbidden_words.txt'
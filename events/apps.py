@@ -4,3 +4,9 @@ from django.apps import AppConfig
 class EventsConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'events'
+
+    def ready(self):
+        # Registra els signals que invaliden la versió de l'índex d'etiquetes
+        from . import signals  # noqa: F401
+        # Registra el listener del broker que compta l'activitat del xat (tendències)
+        from .services import trending  # noqa: F401
@@ -0,0 +1,143 @@
+"""
+Comando: ensure_indexes
+Crea en MongoDB los índices compuestos que necesitan las consultas más
+frecuentes y comprueba con `explain` que ninguna hace un recorrido completo
+de la colección (COLLSCAN).
+
+    python manage.py ensure_indexes
+    python manage.py ensure_indexes --check-only
+
+Los índices se declaran aquí (y no en los Meta de los modelos) porque con
+djongo los creamos directamente con pymongo, con el orden de cada campo.
+Si alguna consulta sigue haciendo COLLSCAN el comando termina con error,
+así se puede usar en el despliegue.
+"""
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from assistant_chat.models import ChatSession, ChatMessage as AssistantMessage
+from chat.models import ChatMessage
+from chat.services.mongo import get_collection
+from events.models import Event
+
+ASC = 1
+DESC = -1
+
+# (modelo, nombre del índice, [(campo, orden), ...])
+INDEXES = [
+    # chat_load_messages: últimos visibles y polling incremental por id
+    (ChatMessage, 'chat_msg_event_visible_id', [('event', ASC), ('is_deleted', ASC), ('id', DESC)]),
+    # Mensajes visibles en orden cronológico
+    (ChatMessage, 'chat_msg_event_visible_created', [('event', ASC), ('is_deleted', ASC), ('created_at', ASC)]),
+    # Polling incremental: eliminados y destacados desde `since`
+    (ChatMessage, 'chat_msg_event_updated', [('event', ASC), ('updated_at', ASC)]),
+    # update_event_statuses y listados por estado
+    (Event, 'event_status_scheduled', [('status', ASC), ('scheduled_date', ASC)]),
+    # my_events
+    (Event, 'event_creator_created', [('creator', ASC), ('created_at', DESC)]),
+    # events_by_category y filtro de categoría
+    (Event, 'event_category_created', [('category', ASC), ('created_at', DESC)]),
+    # Sesión más reciente de cada usuario del asistente
+    (ChatSession, 'assistant_session_user_activity', [('user', ASC), ('last_activity', DESC)]),
+    # cleanup_old_chats
+    (ChatSession, 'assistant_session_activity', [('last_activity', ASC), ('id', ASC)]),
+]
+
+
+def hot_queries():
+    """
+    Forma de las consultas frecuentes: (descripción, modelo, filtro, orden).
+    Los valores son de ejemplo; explain solo mira la forma.
+    """
+    now = timezone.now()
+    return [
+        ('chat: últims missatges', ChatMessage,
+         {'event': 1, 'is_deleted': False}, [('id', DESC)]),
+        ('chat: missatges nous', ChatMessage,
+         {'event': 1, 'is_deleted': False, 'id': {'$gt': 100}}, [('id', ASC)]),
+        ('chat: canvis des de since', ChatMessage,
+         {'event': 1, 'id': {'$lte': 100}, 'updated_at': {'$gte': now}}, []),
+        ('chat: ordre cronològic', ChatMessage,
+         {'event': 1, 'is_deleted': False}, [('created_at', ASC)]),
+        ('esdeveniments per estat', Event,
+         {'status': {'$in': ['scheduled', 'live']}}, [('scheduled_date', ASC)]),
+        ('esdeveniments del creador', Event,
+         {'creator': 1}, [('created_at', DESC)]),
+        ('esdeveniments per categoria', Event,
+         {'category': 'music'}, [('created_at', DESC)]),
+        ('assistent: sessió de l\'usuari', ChatSession,
+         {'user': 1}, [('last_activity', DESC)]),
+        ('assistent: sessions antigues', ChatSession,
+         {'last_activity': {'$lt': now - timedelta(days=15)}}, [('id', ASC)]),
+        ('assistent: historial', AssistantMessage,
+         {'session': 1}, [('timestamp', DESC), ('id', DESC)]),
+    ]
+
+
+def column(model, field_name):
+    """Nombre del campo en el documento de Mongo (las FK se guardan como <campo>_id)."""
+    return model._meta.get_field(field_name).column
+
+
+def plan_stages(plan):
+    """Recorre un plan de explain y devuelve todas sus etapas."""
+    stages = [plan.get('stage')]
+    for key in ('inputStage', 'queryPlan'):
+        if key in plan:
+            stages.extend(plan_stages(plan[key]))
+    for child in plan.get('inputStages', []):
+        stages.extend(plan_stages(child))
+    return stages
+
+
+class Command(BaseCommand):
+    help = "Crea els índexs de MongoDB de les consultes freqüents i comprova que cap fa COLLSCAN"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--check-only',
+            action='store_true',
+            help="No crea índexs, només comprova els plans amb explain"
+        )
+
+    def handle(self, *args, **options):
+        from pymongo import IndexModel
+        from pymongo.errors import OperationFailure
+
+        if not options['check_only']:
+            self.stdout.write('🧱 Creant índexs...')
+            for model, name, fields in INDEXES:
+                keys = [(column(model, field), direction) for field, direction in fields]
+                collection = get_collection(model._meta.db_table)
+                try:
+                    collection.create_indexes([IndexModel(keys, name=name)])
+                    self.stdout.write(f'   ✓ {model._meta.db_table}.{name} {keys}')
+                except OperationFailure as error:
+                    # Ya existe un índice con las mismas claves y otro nombre
+                    self.stdout.write(self.style.WARNING(f'   ⚠️  {model._meta.db_table}.{name}: {error}'))
+
+        self.stdout.write('🔎 Comprovant plans amb explain...')
+        collscans = []
+        for label, model, query, sort in hot_queries():
+            mongo_filter = {column(model, field): value for field, value in query.items()}
+            mongo_sort = [(column(model, field), direction) for field, direction in sort]
+
+            cursor = get_collection(model._meta.db_table).find(mongo_filter).limit(50)
+            if mongo_sort:
+                cursor = cursor.sort(mongo_sort)
+
+            winning_plan = cursor.explain()['queryPlanner']['winningPlan']
+            stages = [stage for stage in plan_stages(winning_plan) if stage]
+
+            if 'COLLSCAN' in stages:
+                collscans.append(label)
+                self.stdout.write(self.style.ERROR(f'   ✗ {label}: {" <- ".join(stages)}'))
+            else:
+                self.stdout.write(f'   ✓ {label}: {" <- ".join(stages)}')
+
+        if collscans:
+            raise CommandError(f"{len(collscans)} consultes fan COLLSCAN: {', '.join(collscans)}")
+
+        self.stdout.write(self.style.SUCCESS('✅ Totes les consultes freqüents usen índexs.'))
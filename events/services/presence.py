@@ -0,0 +1,248 @@
+"""
+Presència dels espectadors dels esdeveniments, en memòria.
+
+Cada espectador de la pàgina d'un esdeveniment envia un batec (heartbeat)
+cada HEARTBEAT_INTERVAL segons. Els batecs es guarden en memòria, repartits
+en SHARD_COUNT trossos per esdeveniment (cadascun amb el seu lock, perquè
+els batecs d'esdeveniments diferents no s'esperin entre ells). Un
+espectador que deixa de bategar caduca passats HEARTBEAT_TTL segons. Cap
+batec escriu a la BD.
+
+Quan un esdeveniment en directe arriba a `max_viewers`, els nous
+espectadors queden en una cua (per ordre d'arribada) i entren a mesura que
+se'n van els altres. El creador i el staff sempre entren. Cada batec costa
+el mateix sigui quina sigui la llargada de la cua: només es mira el
+principi de la cua i la posició surt dels números de seqüència.
+
+Els comptadors són els d'aquest procés: amb diversos workers cal que les
+peticions d'un mateix esdeveniment vagin al mateix worker (p. ex. balanceig
+per URL) perquè el límit i el recompte siguin globals.
+"""
+import threading
+import time
+from collections import OrderedDict
+
+# Segons entre batecs del client (presence.js)
+HEARTBEAT_INTERVAL = 10
+
+# Segons sense batec fins que un espectador deixa de comptar
+HEARTBEAT_TTL = 30
+
+# Trossos independents (esdeveniment % SHARD_COUNT)
+SHARD_COUNT = 16
+
+# Segons que es guarden els límits (max_viewers, creador, estat) d'un esdeveniment
+LIMITS_TTL = 60
+
+# Segons entre neteges completes d'un tros (esdeveniments sense espectadors)
+SWEEP_INTERVAL = 30
+
+# Màxim d'espectadors a la cua d'un esdeveniment
+MAX_QUEUED = 10000
+
+# Segons que dura la foto dels recomptes de tots els esdeveniments
+SNAPSHOT_TTL = 1
+
+ADMITTED = 'admitted'
+QUEUED = 'queued'
+FULL = 'full'
+
+
+class EventPresence:
+    """
+    Espectadors d'un esdeveniment: admesos (per ordre de caducitat) i en cua
+    (per ordre d'arribada, amb un número de seqüència)
+    """
+
+    def __init__(self):
+        # viewer_id -> caducitat
+        self.viewers = OrderedDict()
+        # viewer_id -> (seqüència, caducitat)
+        self.waiting = OrderedDict()
+        self.next_seq = 0
+        # (max_viewers o None si no hi ha límit, creator_id, moment de caducitat)
+        self.limits = None
+
+    def expire(self, now):
+        """
+        Treu els caducats del principi de cada llista. Els de la cua que caduquen
+        pel mig surten quan arriben al principi: cap batec recorre la cua sencera.
+        """
+        # Cada batec mou l'espectador al final: els caducats són al principi
+        while self.viewers and next(iter(self.viewers.values())) <= now:
+            self.viewers.popitem(last=False)
+
+        while self.waiting and next(iter(self.waiting.values()))[1] <= now:
+            self.waiting.popitem(last=False)
+
+    def promote(self, max_viewers, now):
+        """
+        Fa entrar els primers de la cua mentre hi hagi lloc
+        """
+        while self.waiting and len(self.viewers) < max_viewers:
+            viewer_id, (_, expires) = self.waiting.popitem(last=False)
+            if expires > now:
+                # Té un TTL sencer per fer el batec que li dirà que ja és a dins
+                self.viewers[viewer_id] = now + HEARTBEAT_TTL
+
+    def enqueue(self, viewer_id, expires):
+        """
+        Posa (o manté) l'espectador a la cua. Retorna la seva posició (1, 2...)
+        """
+        if viewer_id in self.waiting:
+            seq = self.waiting[viewer_id][0]
+        else:
+            seq = self.next_seq
+            self.next_seq += 1
+        # Reassignar una clau existent no en canvia l'ordre
+        self.waiting[viewer_id] = (seq, expires)
+
+        # Pot comptar forats dels que han marxat pel mig: és una cota superior
+        first_seq = next(iter(self.waiting.values()))[0]
+        return seq - first_seq + 1
+
+    def is_empty(self):
+        return not self.viewers and not self.waiting
+
+
+class PresenceTracker:
+    """
+    Espectadors de tots els esdeveniments d'aquest procés
+    """
+
+    def __init__(self, shard_count=SHARD_COUNT):
+        self._shards = [
+            {'lock': threading.Lock(), 'events': {}, 'next_sweep': 0.0}
+            for _ in range(shard_count)
+        ]
+        self._snapshot = ({}, 0.0)
+
+    def _shard(self, event_id):
+        return self._shards[event_id % len(self._shards)]
+
+    def limits(self, event_id, loader):
+        """
+        Límits de l'esdeveniment (max_viewers o None, creator_id).
+        Només crida loader() (que consulta la BD) si no els tenim o han caducat.
+        """
+        shard = self._shard(event_id)
+        now = time.monotonic()
+
+        with shard['lock']:
+            presence = shard['events'].get(event_id)
+            if presence is not None and presence.limits and presence.limits[2] > now:
+                return presence.limits[:2]
+
+        max_viewers, creator_id = loader()
+
+        with shard['lock']:
+            presence = shard['events'].setdefault(event_id, EventPresence())
+            presence.limits = (max_viewers, creator_id, now + LIMITS_TTL)
+        return max_viewers, creator_id
+
+    def heartbeat(self, event_id, viewer_id, max_viewers=None, priority=False):
+        """
+        Registra un batec. Retorna un dict amb 'status' (admitted, queued o full),
+        'position' a la cua (0 si és a dins) i 'viewers' admesos.
+        Amb priority=True (creador, staff) entra encara que s'hagi arribat al límit.
+        """
+        shard = self._shard(event_id)
+        now = time.monotonic()
+        expires = now + HEARTBEAT_TTL
+
+        with shard['lock']:
+            if now >= shard['next_sweep']:
+                self._sweep(shard, now)
+
+            presence = shard['events'].setdefault(event_id, EventPresence())
+            presence.expire(now)
+            if max_viewers is not None:
+                presence.promote(max_viewers, now)
+
+            viewers = presence.viewers
+
+            if viewer_id in viewers:
+                viewers[viewer_id] = expires
+                viewers.move_to_end(viewer_id)
+                return self._status(ADMITTED, 0, presence)
+
+            # Entra directament si hi ha lloc i ningú fa cua (promote ja ha buidat la cua si hi cabia)
+            if priority or max_viewers is None or len(viewers) < max_viewers:
+                presence.waiting.pop(viewer_id, None)
+                viewers[viewer_id] = expires
+                return self._status(ADMITTED, 0, presence)
+
+            if viewer_id not in presence.waiting and len(presence.waiting) >= MAX_QUEUED:
+                return self._status(FULL, 0, presence)
+
+            position = presence.enqueue(viewer_id, expires)
+            return self._status(QUEUED, position, presence)
+
+    def leave(self, event_id, viewer_id):
+        """
+        L'espectador ha tancat la pàgina: allibera el seu lloc de seguida
+        """
+        shard = self._shard(event_id)
+        with shard['lock']:
+            presence = shard['events'].get(event_id)
+            if presence is not None:
+                presence.viewers.pop(viewer_id, None)
+                presence.waiting.pop(viewer_id, None)
+
+    def count(self, event_id):
+        """
+        Espectadors admesos d'un esdeveniment ara mateix
+        """
+        shard = self._shard(event_id)
+        with shard['lock']:
+            presence = shard['events'].get(event_id)
+            if presence is None:
+                return 0
+            presence.expire(time.monotonic())
+            return len(presence.viewers)
+
+    def counts(self):
+        """
+        {event_id: espectadors} de tots els esdeveniments amb espectadors.
+        Es recalcula com a molt cada SNAPSHOT_TTL segons.
+        """
+        snapshot, taken = self._snapshot
+        now = time.monotonic()
+        if now - taken < SNAPSHOT_TTL:
+            return snapshot
+
+        snapshot = {}
+        for shard in self._shards:
+            with shard['lock']:
+                for event_id, presence in shard['events'].items():
+                    presence.expire(now)
+                    if presence.viewers:
+                        snapshot[event_id] = len(presence.viewers)
+
+        self._snapshot = (snapshot, now)
+        return snapshot
+
+    @staticmethod
+    def _status(status, position, presence):
+        return {
+            'status': status,
+            'position': position,
+            'viewers': len(presence.viewers),
+            'queued': len(presence.waiting),
+        }
+
+    @staticmethod
+    def _sweep(shard, now):
+        """
+        Treu els esdeveniments del tros que ja no tenen espectadors
+        """
+        shard['next_sweep'] = now + SWEEP_INTERVAL
+        events = shard['events']
+        for event_id in list(events):
+            presence = events[event_id]
+            presence.expire(now)
+            if presence.is_empty():
+                del events[event_id]
+
+
+tracker = PresenceTracker()
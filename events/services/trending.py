@@ -0,0 +1,199 @@
+"""
+Activitat del xat per esdeveniment i rànquing d'esdeveniments en tendència.
+
+Cada missatge nou del xat (avís KIND_MESSAGE del broker, en tots els
+processos) suma 1 al bucket del minut actual de l'esdeveniment. Amb els
+últims WINDOW_MINUTES buckets es calculen els missatges per minut de les
+finestres de WINDOWS (1, 5 i 15 minuts) sense tocar la BD.
+
+La puntuació de tendència és un comptador amb decaïment exponencial
+(vida mitjana HALF_LIFE_SECONDS), calculat amb "forward decay": cada
+missatge suma exp(λ·(t - L)), on L és un moment de referència fix. Com
+tots els esdeveniments decauen igual, l'ordre només canvia per a
+l'esdeveniment que rep un missatge. Així el rànquing és una llista
+ordenada que s'actualitza amb bisect a cada missatge, i els K primers són
+els K primers elements de la llista.
+
+Les dades són de cada procés i es perden en reiniciar-lo: el rànquing es
+refà sol amb l'activitat dels minuts següents.
+"""
+import math
+import threading
+import time
+from bisect import bisect_left, insort
+from collections import deque
+
+from chat.services.broker import broker, KIND_MESSAGE, KIND_CLOSED
+
+# Vida mitjana de la puntuació: un missatge de fa HALF_LIFE_SECONDS val la meitat
+HALF_LIFE_SECONDS = 600
+
+DECAY = math.log(2) / HALF_LIFE_SECONDS
+
+# Minuts de buckets guardats per esdeveniment
+WINDOW_MINUTES = 15
+
+# Finestres (minuts) dels missatges per minut
+WINDOWS = (1, 5, 15)
+
+# Esdeveniments seguits com a molt (els de menys puntuació surten primer)
+MAX_TRACKED = 1000
+
+# Puntuació actual (en missatges) per sota de la qual un esdeveniment deixa de comptar
+MIN_SCORE = 0.5
+
+# Quan l'exponent arriba aquí es mou el moment de referència (evita desbordaments)
+MAX_EXPONENT = 50
+
+# Segons entre neteges dels esdeveniments sense activitat
+SWEEP_INTERVAL = 60
+
+
+class EventActivity:
+    """
+    Buckets per minut d'un esdeveniment i la seva puntuació (relativa a la referència)
+    """
+
+    __slots__ = ('buckets', 'score')
+
+    def __init__(self):
+        # (minut, missatges)
+        self.buckets = deque(maxlen=WINDOW_MINUTES)
+        self.score = 0.0
+
+    def add(self, minute):
+        if self.buckets and self.buckets[-1][0] == minute:
+            self.buckets[-1] = (minute, self.buckets[-1][1] + 1)
+        else:
+            self.buckets.append((minute, 1))
+
+    def rates(self, minute):
+        """
+        Missatges per minut de cada finestra de WINDOWS, fins al minut actual
+        """
+        rates = {}
+        for window in WINDOWS:
+            first = minute - window + 1
+            total = sum(count for bucket, count in self.buckets if bucket >= first)
+            rates[window] = total / window
+        return rates
+
+
+class TrendingRanking:
+    """
+    Activitat i rànquing de tots els esdeveniments d'aquest procés
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._events = {}
+        # (-puntuació, event_id), ordenada: el primer és el de més tendència
+        self._ranking = []
+        self._landmark = time.time()
+        self._next_sweep = 0.0
+
+    def record(self, event_id, now=None):
+        """
+        Un missatge nou a l'esdeveniment
+        """
+        now = time.time() if now is None else now
+
+        with self._lock:
+            if DECAY * (now - self._landmark) > MAX_EXPONENT:
+                self._rebase(now)
+
+            activity = self._events.get(event_id)
+            if activity is None:
+                activity = self._events[event_id] = EventActivity()
+            else:
+                self._unrank(event_id, activity.score)
+
+            activity.add(int(now // 60))
+            activity.score += math.exp(DECAY * (now - self._landmark))
+            insort(self._ranking, (-activity.score, event_id))
+
+            if len(self._events) > MAX_TRACKED or now >= self._next_sweep:
+                self._sweep(now)
+
+    def forget(self, event_id):
+        """
+        L'esdeveniment ha acabat o s'ha eliminat: surt del rànquing
+        """
+        with self._lock:
+            activity = self._events.pop(event_id, None)
+            if activity is not None:
+                self._unrank(event_id, activity.score)
+
+    def top(self, k, now=None):
+        """
+        Els k esdeveniments amb més tendència: [(event_id, puntuació actual), ...]
+        """
+        now = time.time() if now is None else now
+        with self._lock:
+            factor = math.exp(-DECAY * (now - self._landmark))
+            top = [
+                (event_id, -negative_score * factor)
+                for negative_score, event_id in self._ranking[:k]
+            ]
+        return [(event_id, score) for event_id, score in top if score >= MIN_SCORE]
+
+    def stats(self, event_id, now=None):
+        """
+        Activitat d'un esdeveniment: puntuació actual i missatges per minut de cada finestra
+        """
+        now = time.time() if now is None else now
+        with self._lock:
+            activity = self._events.get(event_id)
+            if activity is None:
+                return {'score': 0.0, 'rates': {window: 0.0 for window in WINDOWS}}
+            return {
+                'score': activity.score * math.exp(-DECAY * (now - self._landmark)),
+                'rates': activity.rates(int(now // 60)),
+            }
+
+    def _unrank(self, event_id, score):
+        index = bisect_left(self._ranking, (-score, event_id))
+        if index < len(self._ranking) and self._ranking[index] == (-score, event_id):
+            del self._ranking[index]
+
+    def _rebase(self, now):
+        """
+        Mou el moment de referència a `now` i reescala totes les puntuacions
+        """
+        factor = math.exp(-DECAY * (now - self._landmark))
+        for activity in self._events.values():
+            activity.score *= factor
+        self._ranking = sorted((-activity.score, event_id) for event_id, activity in self._events.items())
+        self._landmark = now
+
+    def _sweep(self, now):
+        """
+        Treu els esdeveniments sense activitat recent i, si n'hi ha massa,
+        els de menys puntuació
+        """
+        self._next_sweep = now + SWEEP_INTERVAL
+        threshold = MIN_SCORE * math.exp(DECAY * (now - self._landmark))
+
+        # El rànquing és ordenat: els que no arriben al mínim són al final
+        keep = bisect_left(self._ranking, (-threshold, float('inf')))
+        keep = min(keep, MAX_TRACKED)
+        for _, event_id in self._ranking[keep:]:
+            del self._events[event_id]
+        del self._ranking[keep:]
+
+
+# Rànquing compartit per tot el procés
+trending = TrendingRanking()
+
+
+def on_deliver(event_id, kind, payload):
+    """
+    Listener del broker: compta els missatges nous i oblida els esdeveniments tancats
+    """
+    if kind == KIND_MESSAGE:
+        trending.record(event_id)
+    elif kind == KIND_CLOSED:
+        trending.forget(event_id)
+
+
+broker.add_listener(on_deliver)
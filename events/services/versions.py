@@ -0,0 +1,49 @@
+"""
+Comptadors de versió a la memòria cau de Django, per a les ETags.
+
+Cada recurs que es consulta sovint (el xat d'un esdeveniment, l'índex
+d'etiquetes) té un número de versió que s'incrementa quan canvia. Si el
+client envia la mateixa versió a If-None-Match, es respon 304 sense fer
+cap consulta ni generar el JSON.
+
+La versió inicial es basa en l'hora, de manera que si la clau caduca o el
+procés es reinicia no torna a sortir una versió antiga.
+Amb diversos workers convé una memòria cau compartida (settings.CACHES).
+"""
+import time
+
+from django.core.cache import cache
+
+# Segons que dura una versió a la memòria cau. En caducar es genera una versió
+# nova, així els canvis fets per fora de l'aplicació també acaben arribant
+VERSION_TIMEOUT = 300
+
+# Índex d'etiquetes (get_tags_autocomplete)
+TAGS_VERSION_KEY = 'events:tags:version'
+
+
+def _initial_version():
+    return int(time.time() * 1000)
+
+
+def get_version(key):
+    """
+    Versió actual d'un recurs
+    """
+    version = cache.get(key)
+    if version is None:
+        cache.add(key, _initial_version(), VERSION_TIMEOUT)
+        version = cache.get(key)
+    # Sense memòria cau (DummyCache) cada consulta és una versió nova
+    return version if version is not None else _initial_version()
+
+
+def bump_version(key):
+    """
+    Marca un recurs com a modificat
+    """
+    try:
+        cache.incr(key)
+    except ValueError:
+        # La clau no existia o ha caducat
+        cache.set(key, _initial_version(), VERSION_TIMEOUT)
@@ -0,0 +1,21 @@
+"""
+Signals d'esdeveniments: invaliden la versió de l'índex d'etiquetes
+quan es creen, s'editen o s'eliminen esdeveniments.
+"""
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+
+from .models import Event
+from .services.versions import bump_version, TAGS_VERSION_KEY
+
+
+@receiver(post_save, sender=Event)
+def event_saved(sender, instance, update_fields=None, **kwargs):
+    if update_fields is not None and 'tags' not in update_fields:
+        return
+    bump_version(TAGS_VERSION_KEY)
+
+
+@receiver(post_delete, sender=Event)
+def event_deleted(sender, instance, **kwargs):
+    bump_version(TAGS_VERSION_KEY)
@@ -0,0 +1,75 @@
+document.addEventListener('DOMContentLoaded', () => {
+    const presence = document.getElementById('presence');
+    if(!presence) return;
+
+    const url = presence.dataset.url;
+    const viewerId = presence.dataset.viewerId;
+    const interval = (parseInt(presence.dataset.interval, 10) || 10) * 1000;
+    const viewerCount = document.getElementById('viewer-count');
+    const queueBox = document.getElementById('presence-queue');
+    const queuePosition = document.getElementById('queue-position');
+    const player = document.getElementById('stream-player');
+    const csrfInput = document.querySelector('[name=csrfmiddlewaretoken]');
+
+    let timer = null;
+
+    function post(data, options = {}) {
+        const body = new URLSearchParams({viewer: viewerId, ...data});
+        return fetch(url, {
+            method: 'POST',
+            headers: csrfInput ? {'X-CSRFToken': csrfInput.value} : {},
+            body,
+            ...options
+        });
+    }
+
+    function showState(state) {
+        if(viewerCount) viewerCount.textContent = state.viewers;
+
+        const admitted = state.status === 'admitted';
+        if(queueBox) queueBox.classList.toggle('d-none', admitted);
+        if(queuePosition) queuePosition.textContent = state.position;
+
+        if(!player) return;
+        if(admitted && !player.getAttribute('src') && player.dataset.src) {
+            // Hi ha lloc: obrim el directe
+            player.setAttribute('src', player.dataset.src);
+        } else if(!admitted && player.getAttribute('src')) {
+            // Hem perdut el lloc (p. ex. la pestanya ha estat adormida massa estona)
+            player.dataset.src = player.getAttribute('src');
+            player.removeAttribute('src');
+        }
+    }
+
+    async function heartbeat() {
+        try {
+            const res = await post({});
+            if(!res.ok) throw new Error('Error enviant la presència');
+            showState(await res.json());
+        } catch(err) {
+            console.error("Error de presència:", err);
+        }
+    }
+
+    function start() {
+        if(timer) return;
+        timer = setInterval(heartbeat, interval);
+    }
+
+    function stop() {
+        clearInterval(timer);
+        timer = null;
+    }
+
+    // En tancar o amagar la pàgina alliberem el lloc; en tornar, bateguem de seguida
+    window.addEventListener('pagehide', () => {
+        stop();
+        post({leave: '1'}, {keepalive: true}).catch(() => {});
+    });
+    window.addEventListener('pageshow', (e) => {
+        if(e.persisted) heartbeat();
+        start();
+    });
+
+    start();
+});
@@ -1,3 +1,73 @@
-from django.test import TestCase
+import math
+from unittest import mock
 
-# Create your tests here.
+from django.test import SimpleTestCase
+
+from .services import trending as trending_module
+from .services.trending import DECAY, HALF_LIFE_SECONDS, TrendingRanking
+
+
+class TrendingRankingTest(SimpleTestCase):
+    """
+    Rànquing de tendència amb el moment (now) injectat
+    """
+
+    def setUp(self):
+        self.ranking = TrendingRanking()
+        self.ranking._landmark = 0.0
+
+    def record(self, event_id, now, times=1):
+        for _ in range(times):
+            self.ranking.record(event_id, now=now)
+
+    def test_top_orders_by_decayed_score(self):
+        self.record(1, now=0, times=3)
+        self.record(2, now=HALF_LIFE_SECONDS)
+
+        # Els 3 missatges de l'esdeveniment 1 valen la meitat una vida mitjana després
+        top = self.ranking.top(2, now=HALF_LIFE_SECONDS)
+        self.assertEqual([event_id for event_id, _ in top], [1, 2])
+        self.assertAlmostEqual(top[0][1], 1.5)
+        self.assertAlmostEqual(top[1][1], 1.0)
+
+        self.record(2, now=HALF_LIFE_SECONDS)
+        self.assertEqual([event_id for event_id, _ in self.ranking.top(1, now=HALF_LIFE_SECONDS)], [2])
+
+    def test_top_skips_scores_below_minimum(self):
+        self.record(1, now=0)
+        self.assertEqual(self.ranking.top(5, now=2 * HALF_LIFE_SECONDS), [])
+
+    def test_rebase_keeps_scores_and_order(self):
+        before = 49.5 / DECAY
+        after = 50.5 / DECAY
+        self.record(1, now=before, times=8)
+        self.record(2, now=before, times=4)
+
+        # L'exponent passa de MAX_EXPONENT: es mou el moment de referència
+        self.record(3, now=after)
+        self.assertEqual(self.ranking._landmark, after)
+
+        top = self.ranking.top(3, now=after)
+        self.assertEqual([event_id for event_id, _ in top], [1, 2, 3])
+        for (_, score), expected in zip(top, (8 / math.e, 4 / math.e, 1.0)):
+            self.assertAlmostEqual(score, expected, places=6)
+        self.assertTrue(all(-negative < 10 for negative, _ in self.ranking._ranking))
+
+    def test_sweep_drops_inactive_events(self):
+        self.record(1, now=0)
+        # Dues vides mitjanes després l'esdeveniment 1 val 0.25 < MIN_SCORE
+        self.record(2, now=2 * HALF_LIFE_SECONDS)
+
+        self.assertEqual(set(self.ranking._events), {2})
+        self.assertEqual([event_id for _, event_id in self.ranking._ranking], [2])
+        self.assertEqual(self.ranking.stats(1, now=2 * HALF_LIFE_SECONDS)['score'], 0.0)
+
+    def test_sweep_keeps_max_tracked(self):
+        with mock.patch.object(trending_module, 'MAX_TRACKED', 2):
+            self.record(1, now=0, times=3)
+            self.record(2, now=0, times=2)
+            self.record(3, now=0)
+
+        # Surt el de menys puntuació
+        self.assertEqual(set(self.ranking._events), {1, 2})
+        self.assertEqual([event_id for _, event_id in self.ranking._ranking], [1, 2])
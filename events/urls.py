@@ -13,6 +13,9 @@ urlpatterns = [
     # Detall d'esdeveniment
     path('<int:pk>/', views.event_detail_view, name='event_detail'),
     
+    # Presència dels espectadors (batecs de presence.js)
+    path('<int:pk>/presence/', views.event_presence_view, name='event_presence'),
+    
     # Editar esdeveniment
     path('<int:pk>/edit/', views.event_update_view, name='event_update'),
     
@@ -25,6 +28,9 @@ urlpatterns = [
     # Esdeveniments per categoria
     path('category/<str:category>/', views.events_by_category_view, name='events_by_category'),
     
+    # Esdeveniments en tendència (activitat del xat)
+    path('api/trending/', views.trending_events_api, name='trending_events'),
+    
     # URL para autocompletar etiquetas
     path('api/tags/autocomplete/', views.get_tags_autocomplete, name='tags_autocomplete'),
 ]
\ No newline at end of file
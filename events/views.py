@@ -5,15 +5,50 @@ from django.core.paginator import Paginator
 from django.db.models import Q
 from django.utils import timezone
 from .models import Event
-from chat.models import ChatMessage
+from chat.views import get_initial_chat
+from .services.versions import get_version, TAGS_VERSION_KEY
+from .services.presence import tracker, HEARTBEAT_INTERVAL
+from .services.trending import trending
 from .forms import EventCreationForm, EventUpdateForm, EventSearchForm
+import re
 import traceback
+import uuid
 from datetime import datetime
 from django.http import JsonResponse
+from django.views.decorators.cache import cache_control
+from django.views.decorators.http import condition, require_POST
 from django.db.models import Count
 from events.models import Event
 
 
+# Eventos del carril "En tendència"
+TRENDING_LIMIT = 6
+
+
+def get_trending_events(limit=TRENDING_LIMIT):
+    """
+    Eventos en directo con más actividad en el chat, de más a menos.
+    El ranking sale de memoria (services/trending.py); solo se consulta
+    la BD para cargar esos `limit` eventos.
+    """
+    top = trending.top(limit)
+    if not top:
+        return []
+
+    events = Event.objects.in_bulk([event_id for event_id, _ in top])
+    viewers = tracker.counts()
+
+    return [
+        {
+            'event': events[event_id],
+            'score': score,
+            'viewers': viewers.get(event_id, 0),
+        }
+        for event_id, score in top
+        if event_id in events and events[event_id].status == 'live'
+    ]
+
+
 def event_list_view(request):
     """
     Vista de llistat d'esdeveniments amb cerca i filtres
@@ -78,6 +113,7 @@ def event_list_view(request):
             'page_obj': page_obj,
             'search_form': search_form,
             'featured_events': featured_events,
+            'trending_events': get_trending_events(),
             'total_events': events_list.count(),
             'now': timezone.now(),
         }
@@ -106,16 +142,23 @@ def event_list_view(request):
 def event_detail_view(request, pk): 
     event = get_object_or_404(Event, pk=pk)
 
-    is_creator = request.user.is_authenticated and request.user == event.creator
+    is_creator = request.user.is_authenticated and request.user.pk == event.creator_id
 
     # Aquí pasamos el host al método para Twitch
     embed_url = event.get_stream_embed_url(host=request.get_host())
 
-    # Obtener mensajes de forma segura
+    # Primer latido de presencia: decide si el espectador entra o queda en cola
+    viewer_id = _new_viewer_id(request)
+    presence = _presence_heartbeat(request, event.pk, viewer_id, event)
+    presence['viewer_id'] = viewer_id
+
+    # Solo los últimos mensajes (si está en directo, desde memoria) con sus cursores;
+    # el historial más antiguo se carga al hacer scroll
+    chat_initial = None
     chat_messages = []
     try:
-        qs = ChatMessage.objects.filter(event=event, is_deleted=False).order_by('created_at')
-        chat_messages = list(qs)
+        chat_initial = get_initial_chat(event, request.user)
+        chat_messages = chat_initial['messages']
     except Exception as e:
         print("Error cargando mensajes:", e)
 
@@ -124,6 +167,8 @@ def event_detail_view(request, pk):
         'is_creator': is_creator,
         'embed_url': embed_url,   # Ya lista para iframe
         'chat_messages': chat_messages,
+        'chat_initial': chat_initial,
+        'presence': presence,
         'now': timezone.now(),
         'request_host': request.get_host(),  # Por si lo necesitas en el template
     }
@@ -131,6 +176,70 @@ def event_detail_view(request, pk):
     return render(request, 'events/event_detail.html', context)
 
 
+# Un id por pestaña, generado en event_detail_view: "a<hex>" si es anónimo o
+# "u<pk>-<hex>" si ha iniciado sesión (así cerrar una pestaña no echa a las demás)
+VIEWER_RE = re.compile(r'(?:a|u(\d+)-)[0-9a-f]{32}')
+
+
+def _new_viewer_id(request):
+    if request.user.is_authenticated:
+        return f'u{request.user.pk}-{uuid.uuid4().hex}'
+    return f'a{uuid.uuid4().hex}'
+
+
+def _viewer_id(request):
+    """
+    Identificador de la pestaña que envía presence.js. Un usuario solo puede
+    usar ids con su pk y un anónimo solo ids anónimos.
+    """
+    viewer_id = request.POST.get('viewer', '')
+    match = VIEWER_RE.fullmatch(viewer_id)
+    if match is None:
+        return None
+
+    user_pk = match.group(1)
+    if request.user.is_authenticated:
+        return viewer_id if user_pk == str(request.user.pk) else None
+    return viewer_id if user_pk is None else None
+
+
+def _presence_heartbeat(request, event_pk, viewer_id, event=None):
+    """
+    Registra un latido del espectador. Solo se consulta la BD (o se usa `event`,
+    si ya está cargado) cuando los límites del evento no están en memoria.
+    """
+    def load_limits():
+        current = event if event is not None else get_object_or_404(Event, pk=event_pk)
+        # max_viewers solo se aplica mientras el evento está en directo
+        return (current.max_viewers if current.status == 'live' else None), current.creator_id
+
+    max_viewers, creator_id = tracker.limits(event_pk, load_limits)
+
+    # El creador y el staff siempre entran
+    priority = request.user.is_authenticated and (request.user.is_staff or request.user.pk == creator_id)
+    state = tracker.heartbeat(event_pk, viewer_id, max_viewers, priority)
+    state['max_viewers'] = max_viewers
+    state['interval'] = HEARTBEAT_INTERVAL
+    return state
+
+
+@require_POST
+def event_presence_view(request, pk):
+    """
+    Latido de presencia de un espectador (presence.js). Con leave=1 el
+    espectador se va y libera su plaza. No escribe nada en la BD.
+    """
+    viewer_id = _viewer_id(request)
+    if viewer_id is None:
+        return JsonResponse({'error': 'Espectador no vàlid.'}, status=400)
+
+    if request.POST.get('leave'):
+        tracker.leave(pk, viewer_id)
+        return JsonResponse({'success': True})
+
+    return JsonResponse(_presence_heartbeat(request, pk, viewer_id))
+
+
 @login_required
 def event_create_view(request):
     """
@@ -277,9 +386,35 @@ def events_by_category_view(request, category):
     
     return render(request, 'events/events_by_category.html', context)
 
+@cache_control(max_age=5)
+def trending_events_api(request):
+    """
+    Ranking de eventos en tendencia en JSON, con los mensajes por minuto
+    de cada ventana y los espectadores conectados
+    """
+    results = []
+    for item in get_trending_events():
+        event = item['event']
+        stats = trending.stats(event.pk)
+        results.append({
+            'id': event.pk,
+            'title': event.title,
+            'url': event.get_absolute_url(),
+            'score': round(item['score'], 2),
+            'messages_per_minute': {
+                f'{window}m': round(rate, 2) for window, rate in stats['rates'].items()
+            },
+            'viewers': item['viewers'],
+        })
+    return JsonResponse({'results': results})
+
+
+@cache_control(no_cache=True)
+@condition(etag_func=lambda request: str(get_version(TAGS_VERSION_KEY)))
 def get_tags_autocomplete(request):
     """
-    API para autocompletar etiquetas
+    API para autocompletar etiquetas.
+    Si las etiquetas no han cambiado desde la última respuesta (If-None-Match) devuelve 304.
     """
     query = request.GET.get('q', '')
     
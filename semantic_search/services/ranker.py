@@ -64,4 +64,54 @@ def cosine_top_k(query_vec: list[float], items: list[tuple], k: int = 20):
     scored.sort(key=lambda x: x[1], reverse=True)
     
     # Retornar solo los primeros K elementos
-    return scored[:k]
\ No newline at end of file
+    return scored[:k]
+
+
+def cosine_scores(query_vec: list[float], vectors: list[list[float]]) -> np.ndarray:
+    """
+    Versión vectorizada de la similitud coseno: calcula el score de todos
+    los vectores de una sola vez con un producto matriz-vector.
+
+    Args:
+        query_vec: Vector de la búsqueda del usuario (384 números)
+        vectors: Lista de embeddings, todos con la misma dimensión que query_vec
+
+    Returns:
+        np.ndarray con un score por vector (en el mismo orden).
+        Los vectores a cero reciben -inf para que nunca pasen un umbral.
+    """
+    if not query_vec or not vectors:
+        return np.empty(0, dtype=np.float32)
+
+    q = np.asarray(query_vec, dtype=np.float32)
+    matrix = np.asarray(vectors, dtype=np.float32)
+
+    q_norm = np.linalg.norm(q)
+    if q_norm == 0:
+        return np.full(len(vectors), -np.inf, dtype=np.float32)
+
+    norms = np.linalg.norm(matrix, axis=1)
+    scores = matrix @ q
+
+    # Normalizamos por si algún embedding no venía normalizado
+    with np.errstate(divide="ignore", invalid="ignore"):
+        scores = scores / (norms * q_norm)
+    scores[norms == 0] = -np.inf
+
+    return scores
+
+
+def top_k_indices(scores: np.ndarray, mask: np.ndarray, k: int) -> list[int]:
+    """
+    Devuelve los índices de los K mejores scores entre los que cumplen `mask`,
+    ordenados de mayor a menor, sin ordenar todo el array (argpartition).
+    """
+    candidates = np.flatnonzero(mask)
+    if candidates.size == 0 or k <= 0:
+        return []
+
+    if candidates.size > k:
+        best = np.argpartition(-scores[candidates], k - 1)[:k]
+        candidates = candidates[best]
+
+    return candidates[np.argsort(-scores[candidates], kind="stable")].tolist()